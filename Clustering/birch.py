@@ -1,10 +1,10 @@
 import torch
+import torch.nn.functional as F
 from sklearn.cluster import Birch
 import numpy as np
 
 import tqdm
 import joblib
-from copy import deepcopy
 import json
 import os
 
@@ -14,26 +14,19 @@ class BIRCH(object):
         self.args = args
         self.model = None
 
+    @torch.no_grad()
     def get_partitioned_batch(self, data):
         # Under the premise that images are in the form of square matrix
         _size = data.shape[-1]
         n_part = int((self.args.partition / 2) if self.args.partition % 2 == 0 else (self.args.partition / 3))  # Per row or col
         n_data = int(_size / n_part)  # Per part
-        rst = None
-        for i in range(n_part):
-            r_start = n_data * i
-            for j in range(n_part):
-                c_start = n_data * j
-                _min = torch.min(data[:, :, r_start:r_start + n_data, c_start:c_start + n_data], -1).values
-                _max = torch.max(data[:, :, r_start:r_start + n_data, c_start:c_start + n_data], -1).values
-                _min = torch.min(_min, -1, keepdim=True).values
-                _max = torch.max(_max, -1, keepdim=True).values
-                tmp = torch.cat([_min, _max], dim=-1)
-                if rst is None:
-                    rst = tmp
-                else:
-                    rst = torch.cat([rst, tmp], dim=-1)
-        return rst.view(rst.size(0), -1).cpu().numpy()
+        # (batch, channel, row, col, [min, max]) of n_data x n_data parts
+        # Rows/cols past the last whole part aren't in any part, even when they'd make another pooling window
+        data = data[..., :n_part * n_data, :n_part * n_data]
+        _max = F.max_pool2d(data, n_data)
+        _min = -F.max_pool2d(-data, n_data)
+        rst = torch.stack([_min, _max], dim=-1)
+        return rst.reshape(rst.size(0), -1).cpu().numpy()
 
     def load_clustering_model(self):
         # Load k-means model's hparams, and check dependencies
@@ -50,31 +43,37 @@ class BIRCH(object):
     def predict_cluster_of_batch(self, input):
         partitioned_input = self.get_partitioned_batch(input)
         cluster_info = self.model.predict(partitioned_input)
-        return torch.cuda.LongTensor(cluster_info).cuda()
+        return torch.from_numpy(cluster_info).long().to(input.device)
 
-    def train_clustering_model(self, train_loader):
-        def check_convergence(prev, cur, tol):
-            """
-                Relative tolerance with regards to Frobenius norm of the difference in the cluster centers
-                of two consecutive iterations to declare convergence.
-            """
-            diff = np.subtract(prev, cur)
-            normed = np.linalg.norm(diff)
-            if normed > tol:
-                return False
-            return True
+    def train_clustering_model(self, nonaug_loader, aug_loader=None):
+        """
+            Builds the CF-tree with partial_fit batch by batch, so the dataset's features are never held at once,
+            and clusters its subclusters into args.cluster clusters with one global step at the end.
+            Like K-means, non-augmented data is mixed with mixrate passes over augmented data except for ImageNet.
+        """
+        loaders = [nonaug_loader]
+        if aug_loader is not None and self.args.dataset != 'imagenet':
+            loaders += [aug_loader] * self.args.mixrate
 
-        model = None
         print("Train BIRCH model")
-        t_epoch = tqdm.tqdm(total=1, desc="BIRCH", position=0, ncols=90)
-        for image, _ in train_loader:
-            train_data = self.get_partitioned_batch(image)
-            model = Birch(n_clusters=self.args.cluster)
-            model.fit(train_data)
-            t_epoch.update(1)
-            t_epoch.close()
-        print("Birch n_cluster: {}".format(model.subcluster_centers_.shape))
-        #joblib.dump(model, os.path.join(self.args.kmeans_path + '/checkpoint.pkl'))
+        model = Birch(n_clusters=None)
+        for i, loader in enumerate(loaders):
+            with tqdm.tqdm(loader, desc="BIRCH {}/{}".format(i + 1, len(loaders)), ncols=90) as t:
+                for image, _ in t:
+                    model.partial_fit(self.get_partitioned_batch(image))
+        print("Birch n_subclusters: {}".format(model.subcluster_centers_.shape[0]))
+        model.set_params(n_clusters=self.args.cluster)
+        model.partial_fit()
+
+        path = self.args.clustering_path
+        joblib.dump(model, os.path.join(path, 'checkpoint.pkl'))
+        with open(os.path.join(path, "params.json"), 'w') as f:
+            json.dump({
+                'dataset': self.args.dataset,
+                'clustering_method': self.args.clustering_method,
+                'num_partitions': self.args.partition,
+                'k': self.args.cluster
+            }, f, indent=4)
         self.model = model
 
 
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+class ClusterStatistics(object):
+    """
+        Per-cluster statistics of inputs assigned to the clusters:
+        number of inputs, distance to the centroid, and input range as PCQ tracks it
+        (mean of per-sample min/max), along with the extremes seen.
+    """
+    def __init__(self, n_clusters):
+        self.count = np.zeros(n_clusters, dtype=np.int64)
+        self.dist_sum = np.zeros(n_clusters)
+        self.dist_sq_sum = np.zeros(n_clusters)
+        self.low_sum = np.zeros(n_clusters)
+        self.high_sum = np.zeros(n_clusters)
+        self.low = np.full(n_clusters, np.inf)
+        self.high = np.full(n_clusters, -np.inf)
+
+    def update(self, clusters, dists, ranges):
+        n_clusters = len(self.count)
+        self.count += np.bincount(clusters, minlength=n_clusters)
+        self.dist_sum += np.bincount(clusters, weights=dists, minlength=n_clusters)
+        self.dist_sq_sum += np.bincount(clusters, weights=dists ** 2, minlength=n_clusters)
+        self.low_sum += np.bincount(clusters, weights=ranges[:, 0], minlength=n_clusters)
+        self.high_sum += np.bincount(clusters, weights=ranges[:, 1], minlength=n_clusters)
+        np.minimum.at(self.low, clusters, ranges[:, 0])
+        np.maximum.at(self.high, clusters, ranges[:, 1])
+
+    def summary(self):
+        count = np.maximum(self.count, 1)
+        dist_mean = self.dist_sum / count
+        seen = self.count > 0
+        return {
+            'count': self.count.tolist(),
+            'frequency': (self.count / max(self.count.sum(), 1)).tolist(),
+            'dist_mean': dist_mean.tolist(),
+            'dist_std': np.sqrt(np.maximum(self.dist_sq_sum / count - dist_mean ** 2, 0)).tolist(),
+            'range_low': (self.low_sum / count).tolist(),
+            'range_high': (self.high_sum / count).tolist(),
+            'min': np.where(seen, self.low, 0).tolist(),
+            'max': np.where(seen, self.high, 0).tolist(),
+        }
+
+
+def detect_drift(baseline, current, threshold, eps=1e-6):
+    """
+        Compares current cluster statistics with the training-time baseline (both ClusterStatistics summaries).
+        psi        : population stability index of cluster frequencies (> 0.2 is usually taken as a major shift)
+        flags per cluster,
+            frequency : frequency changed by more than threshold times
+            distance  : mean distance to the centroid grew by more than threshold times
+            range     : mean input range got out of the baseline range by more than (threshold - 1) of its width,
+                        so the cluster's qparams need recalibration
+    """
+    base_freq = np.maximum(np.array(baseline['frequency']), eps)
+    freq = np.maximum(np.array(current['frequency']), eps)
+    psi = float(((freq - base_freq) * np.log(freq / base_freq)).sum())
+
+    clusters, recalibrate = [], []
+    margin = threshold - 1
+    for c in range(len(base_freq)):
+        flags = []
+        ratio = freq[c] / base_freq[c]
+        if ratio > threshold or ratio < 1 / threshold:
+            flags.append('frequency')
+
+        dist_ratio = None
+        if current['count'][c]:
+            dist_ratio = current['dist_mean'][c] / max(baseline['dist_mean'][c], eps)
+            if dist_ratio > threshold:
+                flags.append('distance')
+            width = baseline['range_high'][c] - baseline['range_low'][c]
+            if current['range_low'][c] < baseline['range_low'][c] - margin * width or \
+                    current['range_high'][c] > baseline['range_high'][c] + margin * width:
+                flags.append('range')
+                recalibrate.append(c)
+        clusters.append({'cluster': c, 'base_frequency': baseline['frequency'][c],
+                         'frequency': current['frequency'][c], 'dist_ratio': dist_ratio, 'flags': flags})
+    return {'psi': psi, 'clusters': clusters, 'recalibrate': recalibrate}
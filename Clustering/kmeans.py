@@ -10,12 +10,23 @@ import json
 import os
 import csv
 
+from .drift import ClusterStatistics, detect_drift
+
+
+def get_input_ranges(data):
+    """ (min, max) of each sample """
+    data = data.reshape(data.size(0), -1)
+    return torch.stack([data.min(dim=1).values, data.max(dim=1).values], dim=1)
+
 
 class KMeansClustering(object):
     def __init__(self, args):
         self.args = args
         self.model = None
         self.final_cluster = None  # Used in NN-aware Clustering only
+        self.baseline = None  # Training-time ClusterStatistics summary
+        self.monitor = None
+        self.trained_centers = None
 
     @torch.no_grad()
     def get_partitioned_batch(self, data):
@@ -91,15 +102,141 @@ class KMeansClustering(object):
                     self.final_cluster[int(sub)] = int(final)
 
         self.model = joblib.load(os.path.join(self.args.clustering_path, 'checkpoint.pkl'))
+        baseline_path = os.path.join(self.args.clustering_path, 'baseline.json')
+        if os.path.exists(baseline_path):
+            with open(baseline_path, 'r') as f:
+                self.baseline = json.load(f)
+        if self.args.drift_monitor:
+            self.start_monitoring()
+
+    def start_monitoring(self):
+        self.monitor = ClusterStatistics(self.model.n_clusters)
+        self.trained_centers = self.model.cluster_centers_.copy()
+        if self.baseline is None:
+            print("Warning: clustering model has no training-time baseline (baseline.json), "
+                  "so drift can't be detected and centroids won't be refreshed")
+
+    def update_statistics(self, stats, model, x, ranges):
+        dists = model.transform(x)
+        clusters = dists.argmin(axis=1)
+        stats.update(clusters, dists[np.arange(len(x)), clusters], ranges)
+        return clusters
+
+    def refresh_centroids(self, x, clusters):
+        """
+            Moves centroids by centroid_lr toward the mean of their inputs in the batch.
+            A centroid stays within centroid_max_shift x (its training-time mean distance) of its trained position.
+        """
+        centers = self.model.cluster_centers_
+        for c in np.unique(clusters):
+            moved = centers[c] + self.args.centroid_lr * (x[clusters == c].mean(axis=0) - centers[c])
+            shift = moved - self.trained_centers[c]
+            bound = self.args.centroid_max_shift * self.baseline['dist_mean'][c]
+            norm = np.linalg.norm(shift)
+            if norm > bound:
+                moved = self.trained_centers[c] + shift * (bound / norm)
+            centers[c] = moved
 
     def predict_cluster_of_batch(self, input):
-        kmeans_input = self.get_partitioned_batch(input)
-        cluster_info = self.model.predict(np.float64(kmeans_input))
+        kmeans_input = np.float64(self.get_partitioned_batch(input))
+        if self.monitor is None:
+            cluster_info = self.model.predict(kmeans_input)
+        else:
+            cluster_info = self.update_statistics(self.monitor, self.model, kmeans_input,
+                                                  get_input_ranges(input).numpy())
+            if self.args.centroid_lr and self.baseline is not None:
+                self.refresh_centroids(kmeans_input, cluster_info)
         if self.final_cluster is not None:  # make output as merged cluster form
             return torch.index_select(self.final_cluster, 0, torch.LongTensor(cluster_info))
         return torch.LongTensor(cluster_info)
 
+    def get_representations(self, nonaug_loader, aug_loader=None):
+        """
+            Representations of the non-augmented data, then of mixrate passes over the augmented data.
+            Also returns each non-augmented image's (min, max), the statistics of PCQ's input ranges.
+        """
+        x, ranges = [], []
+        print(">> Load Non-augmented dataset & get representations for clustering..")
+        with tqdm(nonaug_loader, unit="batch", ncols=90) as t:
+            for image, _ in t:
+                x.append(torch.tensor(self.get_partitioned_batch(image)))
+                ranges.append(get_input_ranges(image))
+
+        if aug_loader is not None:
+            print(">> Load augmented datasets & mix dataset..")
+            for _ in range(self.args.mixrate):
+                with tqdm(aug_loader, unit="batch", ncols=90) as t:
+                    for image, _ in t:
+                        x.append(torch.tensor(self.get_partitioned_batch(image)))
+        return torch.cat(x), torch.cat(ranges)
+
+    def get_baseline(self, model, x, ranges):
+        stats = ClusterStatistics(model.n_clusters)
+        self.update_statistics(stats, model, np.float64(x), ranges)
+        return stats.summary()
+
+    def report_drift(self):
+        """ Prints statistics of inputs seen since monitoring started against the baseline, and saves them """
+        report = {'current': self.monitor.summary()}
+        current = report['current']
+        if self.baseline is not None:
+            report.update(detect_drift(self.baseline, current, self.args.drift_threshold))
+            report['centroid_shift'] = np.linalg.norm(self.model.cluster_centers_ - self.trained_centers,
+                                                      axis=1).tolist()
+
+        print('\n>>> Cluster drift (inputs seen: {})'.format(sum(current['count'])))
+        print('{:>7}  {:>17}  {:>10}  {:>17}  {:>17}  {}'.format('Cluster', 'Frequency', 'Dist ratio',
+                                                                 'Range', 'Baseline range', 'Flags'))
+        for c in range(len(current['count'])):
+            if self.baseline is None:
+                print('{:>7}  {:>17.4f}  {:>10}  {:>17}'.format(
+                    c, current['frequency'][c], '-',
+                    '{:.3f}, {:.3f}'.format(current['range_low'][c], current['range_high'][c])))
+                continue
+            info = report['clusters'][c]
+            print('{:>7}  {:>17}  {:>10}  {:>17}  {:>17}  {}'.format(
+                c, '{:.4f} -> {:.4f}'.format(info['base_frequency'], info['frequency']),
+                '{:.3f}'.format(info['dist_ratio']) if info['dist_ratio'] is not None else '-',
+                '{:.3f}, {:.3f}'.format(current['range_low'][c], current['range_high'][c]),
+                '{:.3f}, {:.3f}'.format(self.baseline['range_low'][c], self.baseline['range_high'][c]),
+                ', '.join(info['flags'])))
+        if self.baseline is not None:
+            print('PSI of cluster frequencies: {:.4f}'.format(report['psi']))
+            print('Clusters to recalibrate: {}'.format(report['recalibrate']))
+
+        path = os.path.join(self.args.clustering_path, 'drift.json')
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print('Saved drift report to {}'.format(path))
+        return report
+
+    def save_clustering_model(self, model, baseline=None):
+        path = self.args.clustering_path
+        joblib.dump(model, os.path.join(path + '/checkpoint.pkl'))
+        with open(os.path.join(path, "params.json"), 'w') as f:
+            args_to_save = {
+                'dataset': self.args.dataset,
+                'clustering_method': self.args.clustering_method,
+                'repr_method': self.args.repr_method,
+                'partition_method': self.args.partition_method,
+                'num_partitions': self.args.partition,
+                'k': self.args.cluster
+            }
+            if self.args.dataset == 'imagenet':
+                args_to_save.update({
+                    'tol': self.args.kmeans_tol,
+                    'n_inits': self.args.kmeans_init,
+                    'epoch': self.args.kmeans_epoch,
+                })
+            json.dump(args_to_save, f, indent=4)
+        if baseline is not None:
+            with open(os.path.join(path, 'baseline.json'), 'w') as f:
+                json.dump(baseline, f, indent=4)
+        self.model = model
+        self.baseline = baseline
+
     def train_clustering_model(self, nonaug_loader, aug_loader):
+        from utils.torch_dataset import set_loader_epoch
         print('Train K-means clustering model..')
         best_model = None
         if self.args.dataset == 'imagenet':
@@ -124,6 +261,7 @@ class KMeansClustering(object):
                 model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=self.args.batch,
                                         tol=self.args.kmeans_tol, random_state=0)
                 for epoch in range(self.args.kmeans_epoch):
+                    set_loader_epoch(nonaug_loader, trial * self.args.kmeans_epoch + epoch)
                     with tqdm(nonaug_loader, desc="Trial-{} Epoch {}".format(trial, epoch), position=0, ncols=90) as t:
                         for image, _ in t:
                             train_data = torch.tensor(self.get_partitioned_batch(image))
@@ -139,24 +277,15 @@ class KMeansClustering(object):
                 if model.inertia_ < best_model_inertia:
                     best_model = model
                     best_model_inertia = model.inertia_
-        else:
-            x = None
-            print(">> Load Non-augmented dataset & get representations for clustering..")
-            with tqdm(nonaug_loader, unit="batch", ncols=90) as t:
-                for image, _ in t:
-                    batch = torch.tensor(self.get_partitioned_batch(image))
-                    if x is None:
-                        x = batch
-                    else:
-                        x = torch.cat((x, batch))
-
-            print(">> Load augmented datasets & mix dataset..")
-            for _ in range(self.args.mixrate):
-                with tqdm(aug_loader, unit="batch", ncols=90) as t:
-                    for image, _ in t:
-                        batch = torch.tensor(self.get_partitioned_batch(image))
-                        x = torch.cat((x, batch))
 
+            stats = ClusterStatistics(best_model.n_clusters)
+            with tqdm(nonaug_loader, desc="Baseline", ncols=90) as t:
+                for image, _ in t:
+                    self.update_statistics(stats, best_model, np.float64(self.get_partitioned_batch(image)),
+                                           get_input_ranges(image).numpy())
+            baseline = stats.summary()
+        else:
+            x, ranges = self.get_representations(nonaug_loader, aug_loader)
             n_prediction_cluster = self.args.sub_cluster if self.args.sub_cluster else self.args.cluster
             best_model_inertia = 9999999999999999
             print("Train K-means model 5 times, and choose the best model")
@@ -166,26 +295,9 @@ class KMeansClustering(object):
                     best_model = model
                     best_model_inertia = model.inertia_
                 print("Trial-{} done".format(trial))
+            baseline = self.get_baseline(best_model, x[:len(ranges)].numpy(), ranges.numpy())
 
-        path = self.args.clustering_path
-        joblib.dump(best_model, os.path.join(path + '/checkpoint.pkl'))
-        with open(os.path.join(path, "params.json"), 'w') as f:
-            args_to_save = {
-                'dataset': self.args.dataset,
-                'clustering_method': self.args.clustering_method,
-                'repr_method': self.args.repr_method,
-                'partition_method': self.args.partition_method,
-                'num_partitions': self.args.partition,
-                'k': self.args.cluster
-            }
-            if self.args.dataset == 'imagenet':
-                args_to_save.update({
-                    'tol': self.args.kmeans_tol,
-                    'n_inits': self.args.kmeans_init,
-                    'epoch': self.args.kmeans_epoch,
-                })
-            json.dump(args_to_save, f, indent=4)
-        self.model = best_model
+        self.save_clustering_model(best_model, baseline)
 
     @torch.no_grad()
     def nn_aware_clustering(self, dnn_model, train_loader, arch):
@@ -0,0 +1,117 @@
+import json
+import os
+from copy import deepcopy
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+
+from .kmeans import KMeansClustering
+
+
+def parse_k_range(k_range):
+    """ '2,4,8' or '2-8' (every K in between) """
+    if '-' in k_range:
+        low, high = k_range.split('-')
+        ks = list(range(int(low), int(high) + 1))
+    else:
+        ks = [int(k) for k in k_range.split(',')]
+    ks = sorted(set(ks))
+    assert ks[0] > 1, "Number of clusters must be larger than 1"
+    return ks
+
+
+def fit_kmeans(args, x, n_clusters, init=None):
+    """ K-means as train_clustering_model fits it, started from given centers if any """
+    kwargs = {'init': init, 'n_init': 1} if init is not None else {'n_init': args.kmeans_init}
+    if args.dataset == 'imagenet':
+        return MiniBatchKMeans(n_clusters=n_clusters, batch_size=args.batch, tol=args.kmeans_tol,
+                               max_iter=args.kmeans_epoch, random_state=0, **kwargs).fit(x)
+    return KMeans(n_clusters=n_clusters, random_state=0, **kwargs).fit(x)
+
+
+def split_clusters(x, labels, centers, n_clusters):
+    """ Bisects the cluster with the largest SSE with 2-means until there are n_clusters centers """
+    centers, labels = centers.copy(), labels.copy()
+    while len(centers) < n_clusters:
+        sse = np.bincount(labels, weights=((x - centers[labels]) ** 2).sum(axis=1), minlength=len(centers))
+        for c in np.argsort(-sse):
+            members = np.nonzero(labels == c)[0]
+            if len(members) > 1:
+                break
+        halves = KMeans(n_clusters=2, n_init=3, random_state=0).fit(x[members])
+        centers[c] = halves.cluster_centers_[0]
+        centers = np.concatenate([centers, halves.cluster_centers_[1:]])
+        labels[members[halves.labels_ == 1]] = len(centers) - 1
+    return centers
+
+
+def score_clustering(x, labels, centers, ranges, n_silhouette, rng):
+    """
+        inertia      : sum of squared distances to the assigned centers
+        silhouette   : on a random subsample of n_silhouette representations
+        range_ratio  : how far samples' input ranges (per-sample min/max) are from their cluster's range, which PCQ
+                       tracks as the mean of them, relative to how far they are from the range of the whole data.
+                       Lower is tighter, 1 means the clusters' ranges are no better than a single one.
+        min_fraction : smallest cluster's share of the data, as small clusters fill batches slowly
+    """
+    n_clusters = len(centers)
+    inertia = float(((x - centers[labels]) ** 2).sum())
+    idx = rng.choice(len(x), size=min(n_silhouette, len(x)), replace=False)
+    silhouette = float(silhouette_score(x[idx], labels[idx])) if len(np.unique(labels[idx])) > 1 else 0.0
+
+    range_labels = labels[:len(ranges)]
+    counts = np.bincount(range_labels, minlength=n_clusters)
+    low = np.bincount(range_labels, weights=ranges[:, 0], minlength=n_clusters) / np.maximum(counts, 1)
+    high = np.bincount(range_labels, weights=ranges[:, 1], minlength=n_clusters) / np.maximum(counts, 1)
+    mismatch = np.abs(ranges - np.stack([low, high], axis=1)[range_labels]).sum()
+    range_ratio = float(mismatch / np.abs(ranges - ranges.mean(axis=0)).sum())
+    return {'k': n_clusters, 'inertia': inertia, 'silhouette': silhouette, 'range_ratio': range_ratio,
+            'min_fraction': float(counts.min() / counts.sum())}
+
+
+def select_num_clusters(args, arch, data_loaders, n_silhouette=10000):
+    """
+        Fits K-means for every K of args.k_range in one job.
+        Representations are extracted once. The smallest K is fitted from scratch (kmeans_init restarts),
+        and each larger K starts from the previous solution with its largest clusters bisected.
+        Every model is saved as train_clustering_model saves it, so it can be used with --clustering_path,
+        and scores of all K are saved in a summary next to them.
+    """
+    from utils.misc import set_clustering_dir
+    ks = parse_k_range(args.k_range)
+    base = KMeansClustering(args)
+    x, ranges = base.get_representations(data_loaders['non_aug_train'],
+                                         data_loaders['aug_train'] if args.dataset != 'imagenet' else None)
+    x, ranges = np.float64(x.numpy()), ranges.numpy()
+    rng = np.random.default_rng(0)
+
+    summary, model = [], None
+    for k in ks:
+        print(">> Fit K-means with {} clusters".format(k))
+        if model is None:
+            model = fit_kmeans(args, x, k)
+        else:
+            model = fit_kmeans(args, x, k, init=split_clusters(x, model.labels_, model.cluster_centers_, k))
+
+        k_args = deepcopy(args)
+        k_args.cluster = k
+        k_args.clustering_path = set_clustering_dir(k_args, arch)
+        k_clustering = KMeansClustering(k_args)
+        k_clustering.save_clustering_model(model, k_clustering.get_baseline(model, x[:len(ranges)], ranges))
+
+        scores = score_clustering(x, model.labels_, model.cluster_centers_, ranges, n_silhouette, rng)
+        scores['path'] = k_args.clustering_path
+        summary.append(scores)
+
+    print('{:>4}  {:>14}  {:>10}  {:>11}  {:>12}'.format('K', 'Inertia', 'Silhouette', 'Range ratio', 'Min fraction'))
+    for s in summary:
+        print('{:>4}  {:>14.2f}  {:>10.4f}  {:>11.4f}  {:>12.4f}'.format(s['k'], s['inertia'], s['silhouette'],
+                                                                       s['range_ratio'], s['min_fraction']))
+
+    summary_path = os.path.join(os.path.dirname(summary[0]['path']),
+                                'kselect.k{}-{}.part{}.{}.json'.format(ks[0], ks[-1], args.partition, args.repr_method))
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=4)
+    print("Saved summary to {}".format(summary_path))
+    return summary
@@ -30,6 +30,10 @@ warnings.filterwarnings("ignore")
 from HAWQ.utils.models.q_alexnet import q_alexnet
 from HAWQ.utils.models.q_densenet import q_densenet
 from utils.misc import RuntimeHelper, pcq_epoch, pcq_validate, get_time_cost_in_string, load_dnn_model, set_save_dir
+from utils.profiler import get_profiler, start_profiler
+from utils.distributed import is_main_process, broadcast_object, wrap_ddp_model, get_distributed_train_loader, ddp_pcq_epoch
+from utils.torch_dataset import get_normalizer, get_non_augmented_train_dataset, get_data_loader
+from utils.calibration import get_calibration_batches
 from .bit_config import *
 from .utils import *
 from pytorchcv.model_provider import get_model as ptcv_get_model
@@ -87,6 +91,9 @@ parser.add_argument('--multiprocessing-distributed', action='store_true',
                          'N processes per node, which has N GPUs. This is the '
                          'fastest way to use PyTorch for either single node or '
                          'multi node data parallel training')
+parser.add_argument('--procs-per-node', default=0, type=int,
+                    help='Processes per node of --multiprocessing-distributed (default: one per GPU, '
+                         'needed to run more than one on CPU with gloo)')
 parser.add_argument('--act-range-momentum',
                     type=float,
                     default=-1,
@@ -223,14 +230,15 @@ def main(args_daq, data_loaders, clustering_model):
 
     args.distributed = args.world_size > 1 or args.multiprocessing_distributed
 
-    ngpus_per_node = torch.cuda.device_count()
+    # Without GPUs, spawned processes run on CPU (gloo)
+    ngpus_per_node = args.procs_per_node or torch.cuda.device_count() or 1
     if args.multiprocessing_distributed:
         # Since we have ngpus_per_node processes per node, the total world_size
         # needs to be adjusted accordingly
         args.world_size = ngpus_per_node * args.world_size
         # Use torch.multiprocessing.spawn to launch distributed processes: the
         # main_worker process function
-        mp.spawn(main_worker, nprocs=ngpus_per_node, args=(ngpus_per_node, args))
+        mp.spawn(main_worker, nprocs=ngpus_per_node, args=(ngpus_per_node, args, data_loaders, clustering_model))
     else:
         # Simply call main_worker function
         main_worker(args.gpu, ngpus_per_node, args, data_loaders, clustering_model)
@@ -352,7 +360,7 @@ def main_worker(gpu, ngpus_per_node, args, data_loaders, clustering_model):
     def set_runtime_helper(args):
         if args.cluster > 1:
             runtime_helper = RuntimeHelper()
-            runtime_helper.set_pcq_arguments(args)
+            runtime_helper.set_pcq_arguments(args, device)
             return runtime_helper
         return None
 
@@ -403,10 +411,13 @@ def main_worker(gpu, ngpus_per_node, args, data_loaders, clustering_model):
 
 
     global best_acc1
-    args.gpu = gpu
+    args.gpu = gpu if torch.cuda.is_available() else None
 
     if args.gpu is not None:
         logging.info("Use GPU: {} for training".format(args.gpu))
+    device = 'cuda' if args.gpu is None else torch.device('cuda', args.gpu)
+    if not torch.cuda.is_available():
+        device = torch.device('cpu')
 
     if args.distributed:
         if args.dist_url == "env://" and args.rank == -1:
@@ -443,7 +454,7 @@ def main_worker(gpu, ngpus_per_node, args, data_loaders, clustering_model):
             teacher = teacher.cuda(args.gpu)
 
     # define loss function (criterion) and optimizer
-    criterion = nn.CrossEntropyLoss().cuda(args.gpu)
+    criterion = nn.CrossEntropyLoss().to(device)
 
     optimizer = torch.optim.SGD(model.parameters(), args.lr,
                                 momentum=args.momentum,
@@ -453,6 +464,10 @@ def main_worker(gpu, ngpus_per_node, args, data_loaders, clustering_model):
     optimizer = resume_optimizer(args, optimizer)
 
     cudnn.benchmark = True
+    if args.profile:
+        profiler = start_profiler(args.profile, args.profile_steps,
+                                  runtime_helper=runtime_helper if args.cluster > 1 else None)
+        profiler.attach(model)
 
     train_loader = data_loaders['aug_train']
     test_loader = data_loaders['test']
@@ -464,27 +479,75 @@ def main_worker(gpu, ngpus_per_node, args, data_loaders, clustering_model):
 
     if args.evaluate:
         validate(test_loader, model, criterion, args)
+        get_profiler().finish()
         return
 
+    if args.mode == 'ptq':
+        calibration_start_time = time.time()
+        calibration_dataset = get_non_augmented_train_dataset(args, get_normalizer(args.dataset))
+        calibration_loader = get_data_loader(calibration_dataset, batch_size=args.batch, shuffle=True,
+                                             workers=args.worker)
+        batches = get_calibration_batches(calibration_loader, clustering_model if args.cluster > 1 else None,
+                                          runtime_helper, args, args.calib_batches)
+        n_batches = calibrate(batches, model, runtime_helper, args)
+        time_cost = get_time_cost_in_string(time.time() - calibration_start_time)
+
+        if args.cluster > 1:
+            acc1 = pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper, logging,
+                                device=device)
+        else:
+            acc1 = validate(test_loader, model, criterion, args)
+        get_profiler().finish()
+
+        ptq_path = set_save_dir(args)
+        save_checkpoint({'arch': args.arch, 'state_dict': model.state_dict(), 'best_acc1': acc1}, False, ptq_path)
+        with open(f'hawq_ptq_{args.arch}_{args.data}_cluster_{args.cluster}.txt', 'a') as f:
+            f.write('Bit:{}, Acc:{:.2f}, Batches:{}x{}, Act-range-momentum:{}, Act-percentile:{}, Cluster:{}, Time:{}, Data:{}\n'.format(
+                args.quant_scheme, acc1, n_batches, args.batch, args.act_range_momentum, args.act_percentile,
+                args.cluster, time_cost, args.data))
+        return
+
+    eval_model = model
+    if args.distributed:
+        # Each rank trains on its shard of every cluster, all ranks on the same cluster per step
+        model = wrap_ddp_model(model.to(device), torch.device(device), find_unused_parameters=True)
+        train_loader = get_distributed_train_loader(args, clustering_model, train_loader.dataset)
+        range_reduce = 'minmax' if args.act_range_momentum == -1 else 'mean'
+
     best_epoch = 0
     register_acc = 0
     tuning_start_time = time.time()
     tuning_fin_time = None
     one_epoch_time = None
 
-    finetune_path = set_save_dir(args)
+    # Rank 0 makes the timestamped directory, and the other ranks get its path
+    finetune_path = set_save_dir(args) if not args.distributed or is_main_process() else None
+    if args.distributed:
+        finetune_path = broadcast_object(finetune_path)
     if not os.path.exists(finetune_path):
         os.mkdir(finetune_path)
 
     for epoch in range(args.start_epoch, args.epochs):
         adjust_learning_rate(optimizer, epoch, args)
 
-        if args.cluster > 1:
+        if args.distributed:
+            ddp_pcq_epoch(model, train_loader, criterion, optimizer, runtime_helper, epoch, logging,
+                          fix_BN=args.fix_BN, range_reduce=range_reduce, device=device)
+            tuning_fin_time = time.time()
+            one_epoch_time = get_time_cost_in_string(tuning_fin_time - tuning_start_time)
+            if args.cluster > 1:
+                acc1 = pcq_validate(eval_model, clustering_model, test_loader, criterion, runtime_helper, logging,
+                                    device=device)
+            else:
+                acc1 = validate(test_loader, eval_model, criterion, args)
+
+        elif args.cluster > 1:
             pcq_epoch(model, clustering_model, train_loader, criterion, optimizer, runtime_helper, epoch, logging,
                       fix_BN=args.fix_BN)
             tuning_fin_time = time.time()
             one_epoch_time = get_time_cost_in_string(tuning_fin_time - tuning_start_time)
-            acc1 = pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper, logging)
+            acc1 = pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper, logging,
+                                device=device)
 
         else:
             train(train_loader, model, criterion, optimizer, epoch, logging, args)
@@ -502,14 +565,19 @@ def main_worker(gpu, ngpus_per_node, args, data_loaders, clustering_model):
             best_epoch = epoch
             register_acc = best_acc1
 
-        if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
+        if not args.distributed or is_main_process():
             save_checkpoint({
                 'epoch': epoch + 1,
                 'arch': args.arch,
-                'state_dict': model.state_dict(),
+                # Without DDP's 'module.' prefix, so loaders find the keys
+                'state_dict': eval_model.state_dict(),
                 'best_acc1': best_acc1,
                 'optimizer': optimizer.state_dict(),
             }, is_best, finetune_path)
+    get_profiler().finish()
+
+    if args.distributed and not is_main_process():
+        return
 
     test_score = register_acc
 
@@ -541,19 +609,23 @@ def train(train_loader, model, criterion, optimizer, epoch, logger, args):
     else:
         model.train()
 
+    profiler = get_profiler()
+    device = next(model.parameters()).device
     end = time.time()
     with tqdm(train_loader, desc="Epoch {}".format(epoch), ncols=105) as t:
-        for i, (images, target) in enumerate(t):
+        for i, (images, target) in enumerate(profiler.iterate(t)):
             # measure data loading time
             data_time.update(time.time() - end)
 
-            if args.gpu is not None:
-                images = images.cuda(args.gpu, non_blocking=True)
-            target = target.cuda(args.gpu, non_blocking=True)
+            with profiler.phase('data'):
+                if args.gpu is not None:
+                    images = images.cuda(args.gpu, non_blocking=True)
+                target = target.to(device, non_blocking=True)
 
             # compute output
-            output = model(images)
-            loss = criterion(output, target)
+            with profiler.phase('forward'):
+                output = model(images)
+                loss = criterion(output, target)
 
             # measure accuracy and record loss
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -562,13 +634,16 @@ def train(train_loader, model, criterion, optimizer, epoch, logger, args):
             top5.update(acc5[0].item(), images.size(0))
 
             # compute gradient and do SGD step
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with profiler.phase('backward'):
+                optimizer.zero_grad()
+                loss.backward()
+            with profiler.phase('optimizer'):
+                optimizer.step()
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
+            profiler.step()
 
             logger.debug("[Epoch] {}, step {}/{} [Loss] {:.5f} ({:.5f}) [Acc@1] {:.3f} ({:.3f}) [Acc@5] {:3f} ({:.3f})"
                          .format(epoch, i + 1, len(train_loader), loss.item(), losses.avg, acc1.item(), top1.avg, acc5.item(), top5.avg))
@@ -670,6 +745,30 @@ def train_kd(train_loader, model, teacher, criterion, optimizer, epoch, val_load
                 }, is_best, args.save_path)
 
 
+def calibrate(batches, model, runtime_helper, args):
+    """
+        PTQ: only the activation quantizers collect ranges (of each cluster), with their own observers
+        (act_range_momentum -1 for min/max, act_percentile for percentiles). Weights and BN statistics stay fixed.
+    """
+    freeze_model(model)
+    for m in model.modules():
+        if isinstance(m, QuantAct):
+            m.unfix()
+    model.eval()
+
+    n_batches = 0
+    with torch.no_grad():
+        for images, _, cluster in tqdm(batches, desc="Calibrate", ncols=90):
+            if runtime_helper is not None:
+                runtime_helper.batch_cluster = cluster
+            if args.gpu is not None:
+                images = images.cuda(args.gpu, non_blocking=True)
+            model(images)
+            n_batches += 1
+    freeze_model(model)
+    return n_batches
+
+
 def validate(val_loader, model, criterion, args):
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
@@ -684,16 +783,20 @@ def validate(val_loader, model, criterion, args):
     freeze_model(model)
     model.eval()
 
+    profiler = get_profiler()
+    device = next(model.parameters()).device
     with torch.no_grad():
         end = time.time()
-        for i, (images, target) in enumerate(val_loader):
-            if args.gpu is not None:
-                images = images.cuda(args.gpu, non_blocking=True)
-            target = target.cuda(args.gpu, non_blocking=True)
+        for i, (images, target) in enumerate(profiler.iterate(val_loader)):
+            with profiler.phase('data'):
+                if args.gpu is not None:
+                    images = images.cuda(args.gpu, non_blocking=True)
+                target = target.to(device, non_blocking=True)
 
             # compute output
-            output = model(images)
-            loss = criterion(output, target)
+            with profiler.phase('forward'):
+                output = model(images)
+                loss = criterion(output, target)
 
             # measure accuracy and record loss
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -704,6 +807,7 @@ def validate(val_loader, model, criterion, args):
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
+            profiler.step()
 
             if i % args.print_freq == 0:
                 progress.display(i)
@@ -0,0 +1,271 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+import torch
+from numpy.lib.stride_tricks import sliding_window_view
+
+###############################################################################
+# TVM-free CPU reference of mixed_precision_models/quantized_resnet_v1.py
+# -----------------
+# Same NHWC data / HWOI kernel layout, same names in weights.npy & bias.npy and
+# the same scaling factors as hawq_utils_resnet50.load_qconfig, so exports can
+# be checked on machines without a GPU or a TVM build.
+
+# Same fields and defaults as mixed_precision_models.layers.QConfig, which can't be imported without tvm
+QConfig = namedtuple('QConfig', 'from_dtype, from_scale, from_zero_point, \
+                                input_dtype, input_scale, input_zero_point, \
+                                kernel_dtype, kernel_scale, kernel_zero_point, \
+                                output_dtype, output_scale, output_zero_point',
+                      defaults=('int32', 65.0, 0.0, 'int8', 8.0, 0.0, 'int8', 8.0, 0.0, 'int32', 74.0, 0.0))
+
+DTYPE_RANGE = {
+    'int4': (-8, 7),
+    'uint4': (0, 15),
+    'int8': (-128, 127),
+    'uint8': (0, 255),
+    'int32': (-2 ** 31, 2 ** 31 - 1),
+}
+
+
+def unpack_int4_to_int32(a_int4):
+    """Vectorized, sign-extending inverse of hawq_utils_resnet50.pack_int32_to_int4."""
+    shifts = (7 - np.arange(8, dtype=np.int32)) * 4
+    nibbles = (a_int4[..., None] >> shifts) & 0xf
+    nibbles = nibbles.reshape(a_int4.shape[:-1] + (a_int4.shape[-1] * 8,))
+    return np.where(nibbles > 7, nibbles - 16, nibbles).astype(np.int32)
+
+
+def load_qconfig(data_dtype, kernel_dtype, num_stages, units, file_name=None, scaling_factors=None):
+    """Same scale bookkeeping as hawq_utils_resnet50.load_qconfig, returned as a dict instead of QuantizeContext."""
+    if scaling_factors is None:
+        model = torch.load(file_name, map_location='cpu')
+        scaling_factors = {**model['convbn_scaling_factor'], **model['fc_scaling_factor'], **model['act_scaling_factor']}
+
+    params = {}
+    for (key, tensor) in scaling_factors.items():
+        tensor_np = tensor.cpu().numpy().reshape((-1))
+        if "act_scaling_factor" in key:
+            tensor_np = tensor_np[0]
+        params[key] = tensor_np
+
+    qconfig_dict = dict()
+    conv0_input_scale = params["module.quant_input.act_scaling_factor"]
+    conv0_kernel_scale = params["module.quant_init_convbn.convbn_scaling_factor"]
+    conv0_output_scale = params["module.quant_act_int32.act_scaling_factor"]
+    qconfig_dict["conv0_qconfig"] = QConfig(from_scale=1.0, input_dtype='int8', input_scale=conv0_input_scale,
+                                            kernel_dtype='int8', kernel_scale=conv0_kernel_scale,
+                                            output_scale=conv0_output_scale)
+
+    last_add = "conv0_qconfig"
+    for i in range(num_stages):
+        for j in range(units[i]):
+            prefix = "stage%d_unit%d" % (i + 1, j + 1)
+            hawq_prefix = "module.stage%d.unit%d" % (i + 1, j + 1)
+            for k in range(3):
+                kernel_scale = params["%s.quant_convbn%d.convbn_scaling_factor" % (hawq_prefix, k + 1)]
+                if k == 0:
+                    from_scale = qconfig_dict[last_add].output_scale
+                    input_scale = params["%s.quant_act.act_scaling_factor" % hawq_prefix]
+                else:
+                    from_scale = qconfig_dict["%s_qconfig%d" % (prefix, k)].output_scale
+                    input_scale = params["%s.quant_act%d.act_scaling_factor" % (hawq_prefix, k)]
+                qconfig_dict["%s_qconfig%d" % (prefix, k + 1)] = \
+                    QConfig(from_scale=from_scale, input_dtype=data_dtype, input_scale=input_scale,
+                            kernel_dtype=kernel_dtype, kernel_scale=kernel_scale, output_scale=kernel_scale * input_scale)
+
+            if j == 0:
+                kernel_scale = params["%s.quant_identity_convbn.convbn_scaling_factor" % hawq_prefix]
+                input_scale = qconfig_dict["%s_qconfig1" % prefix].input_scale
+                qconfig_dict["%s_qconfig_sc" % prefix] = \
+                    QConfig(input_dtype=data_dtype, input_scale=input_scale, kernel_dtype=kernel_dtype,
+                            kernel_scale=kernel_scale, output_scale=kernel_scale * input_scale)
+
+            output_scale = params["%s.quant_act_int32.act_scaling_factor" % hawq_prefix]
+            last_add = "%s_qconfig_add" % prefix
+            qconfig_dict[last_add] = QConfig(output_scale=output_scale)
+
+    fc_input_scale = params["module.quant_act_output.act_scaling_factor"]
+    fc_kernel_scale = params["module.quant_output.fc_scaling_factor"]
+    qconfig_dict["fc_qconfig"] = QConfig(from_scale=qconfig_dict[last_add].output_scale, input_dtype='int8',
+                                         input_scale=fc_input_scale, kernel_dtype='int8', kernel_scale=fc_kernel_scale,
+                                         output_scale=fc_input_scale * fc_kernel_scale)
+    return qconfig_dict
+
+
+def load_params(params_dir, kernel_dtype):
+    weights = np.load(os.path.join(params_dir, "weights.npy"), allow_pickle=True)[()]
+    bias = np.load(os.path.join(params_dir, "bias.npy"), allow_pickle=True)[()]
+
+    params = {}
+    for (key, tensor) in weights.items():
+        # conv0 and fc are always saved as int8, the others are packed 8 per int32 when int4
+        if kernel_dtype == 'int4' and tensor.dtype == np.int32:
+            tensor = unpack_int4_to_int32(tensor)
+        params[key] = tensor.astype(np.int64)
+    for (key, tensor) in bias.items():
+        params[key] = tensor.astype(np.int64)
+    return params
+
+
+###############################################################################
+# Integer ops
+# -----------------
+
+def round_with(x, rounding):
+    """Rounding of relay.qnn.op.requantize: TONEAREST rounds halves away from zero, UPWARD towards +inf,
+    and TRUNCATE adds no rounding offset before the right shift, so it floors."""
+    if rounding == "TONEAREST":
+        return np.sign(x) * np.floor(np.abs(x) + 0.5)
+    elif rounding == "UPWARD":
+        return np.floor(x + 0.5)
+    elif rounding == "TRUNCATE":
+        return np.floor(x)
+    raise RuntimeError("Unsupported rounding method {}".format(rounding))
+
+
+def round_image(x, rounding):
+    """Rounding of test_resnet_accuracy_imagenet.quantize_image, numpy's: TONEAREST rounds halves to even."""
+    if rounding == "TONEAREST":
+        return np.round(x)
+    elif rounding == "TRUNCATE":
+        return np.trunc(x)
+    raise RuntimeError("Unsupported rounding method {}".format(rounding))
+
+
+def requantize(data, input_scale, output_scale, out_dtype, input_zero_point=0.0, output_zero_point=0.0,
+               rounding="TONEAREST"):
+    # Per-channel scales broadcast over the last (C) axis of NHWC, as with axis=-1 in relay
+    multiplier = np.float64(np.float32(input_scale)) / np.float64(np.float32(output_scale))
+    out = round_with((data - input_zero_point) * multiplier, rounding) + output_zero_point
+    low, high = DTYPE_RANGE[out_dtype]
+    return np.clip(out, low, high).astype(np.int64)
+
+
+def quantized_add(lhs, rhs, lhs_scale, rhs_scale, output_scale):
+    # qnn.add lowers to requantize with TVM's default (UPWARD) rounding on both sides
+    if np.ndim(output_scale) == 1:
+        output_scale = output_scale[0]
+    lhs = requantize(lhs, lhs_scale, output_scale, 'int32', rounding="UPWARD")
+    rhs = requantize(rhs, rhs_scale, output_scale, 'int32', rounding="UPWARD")
+    low, high = DTYPE_RANGE['int32']
+    return np.clip(lhs + rhs, low, high)
+
+
+def conv2d_nhwc(data, weight, bias=None, stride=1, padding=0, input_zero_point=0, kernel_zero_point=0):
+    """im2col + one matmul per layer; data is NHWC, weight is HWOI (as in weights.npy).
+
+    The matmul runs in float64 so BLAS is used, which is exact for int8/int4 accumulations
+    (|sum| stays far below 2 ** 53).
+    """
+    kernel_h, kernel_w, out_channel, in_channel = weight.shape
+    if padding:
+        data = np.pad(data, ((0, 0), (padding, padding), (padding, padding), (0, 0)),
+                      constant_values=input_zero_point)
+    batch = data.shape[0]
+
+    # (N, OH, OW, C, KH, KW) view without copying, the reshape below materializes the columns
+    windows = sliding_window_view(data, (kernel_h, kernel_w), axis=(1, 2))[:, ::stride, ::stride]
+    out_height, out_width = windows.shape[1], windows.shape[2]
+    cols = windows.reshape(batch * out_height * out_width, in_channel * kernel_h * kernel_w)
+    kernel = weight.transpose((3, 0, 1, 2)).reshape(in_channel * kernel_h * kernel_w, out_channel)
+
+    out = np.matmul(cols.astype(np.float64) - input_zero_point, kernel.astype(np.float64) - kernel_zero_point)
+    out = np.rint(out).astype(np.int64).reshape(batch, out_height, out_width, out_channel)
+    if bias is not None:
+        out = out + bias.reshape(1, 1, 1, -1)
+    return out
+
+
+def max_pool2d_nhwc(data, pool_size=3, stride=2, padding=1):
+    data = np.pad(data, ((0, 0), (padding, padding), (padding, padding), (0, 0)),
+                  constant_values=np.iinfo(data.dtype).min)
+    windows = sliding_window_view(data, (pool_size, pool_size), axis=(1, 2))[:, ::stride, ::stride]
+    return windows.max(axis=(-2, -1))
+
+
+def global_avg_pool2d_nhwc(data):
+    # Integer average pooling divides the int32 sum by the window size
+    height, width = data.shape[1], data.shape[2]
+    return data.sum(axis=(1, 2), keepdims=True) // (height * width)
+
+
+###############################################################################
+# Graph
+# -----------------
+
+class NumpyQuantizedResNet(object):
+    """
+        rounding       : of every requantize, as get_net's rounding argument (get_workload passes TONEAREST)
+        image_rounding : of quantize_image, as test_resnet_accuracy_imagenet.quantize_image's
+    """
+    def __init__(self, params, qconfig_dict, units=(3, 4, 6, 3), rounding="TRUNCATE", image_rounding="TONEAREST"):
+        self.params = params
+        self.qconfig_dict = qconfig_dict
+        self.units = units
+        self.rounding = rounding
+        self.image_rounding = image_rounding
+
+    def quantize_image(self, image):
+        """Float NCHW images -> int8 NHWC input, same as test_resnet_accuracy_imagenet.quantize_image."""
+        image = np.transpose(image, (0, 2, 3, 1)) / self.qconfig_dict["conv0_qconfig"].input_scale
+        return round_image(np.clip(image, -128, 127), self.image_rounding).astype(np.int64)
+
+    def _conv(self, data, name, qconfig, stride=1, padding=0):
+        return conv2d_nhwc(data, self.params[name + '_weight'], self.params.get(name + '_bias'),
+                           stride=stride, padding=padding,
+                           input_zero_point=qconfig.input_zero_point, kernel_zero_point=qconfig.kernel_zero_point)
+
+    def _requantize(self, data, input_scale, qconfig, input_zero_point=0.0, out_dtype=None):
+        return requantize(data, input_scale, qconfig.input_scale, out_dtype or qconfig.input_dtype,
+                          input_zero_point=input_zero_point, output_zero_point=qconfig.input_zero_point,
+                          rounding=self.rounding)
+
+    def _residual_unit(self, data, stride, dim_match, name):
+        qconfig1 = self.qconfig_dict[name + '_qconfig1']
+        qconfig2 = self.qconfig_dict[name + '_qconfig2']
+        qconfig3 = self.qconfig_dict[name + '_qconfig3']
+
+        req1 = self._requantize(data, qconfig1.from_scale, qconfig1, qconfig1.from_zero_point)
+        act1 = np.maximum(self._conv(req1, name + '_qconv1', qconfig1, stride=stride), 0)
+
+        req2 = self._requantize(act1, qconfig1.output_scale, qconfig2)
+        act2 = np.maximum(self._conv(req2, name + '_qconv2', qconfig2, padding=1), 0)
+
+        req3 = self._requantize(act2, qconfig2.output_scale, qconfig3)
+        conv3 = self._conv(req3, name + '_qconv3', qconfig3)
+
+        if dim_match:
+            shortcut, shortcut_scale = data, qconfig1.from_scale
+        else:
+            qconfig_sc = self.qconfig_dict[name + '_qconfig_sc']
+            shortcut = conv2d_nhwc(req1, self.params[name + '_qsc_weight'], self.params.get(name + '_qsc_bias'),
+                                   stride=stride, input_zero_point=qconfig1.input_zero_point,
+                                   kernel_zero_point=qconfig_sc.kernel_zero_point)
+            shortcut_scale = qconfig_sc.output_scale
+
+        out = quantized_add(conv3, shortcut, qconfig3.output_scale, shortcut_scale,
+                            self.qconfig_dict[name + '_qconfig_add'].output_scale)
+        return np.maximum(out, 0)
+
+    def __call__(self, data):
+        qconfig_conv0 = self.qconfig_dict['conv0_qconfig']
+        body = self._conv(data, 'conv0', qconfig_conv0, stride=2, padding=3)
+        body = requantize(body, qconfig_conv0.input_scale * qconfig_conv0.kernel_scale, qconfig_conv0.output_scale,
+                          'int32', rounding=self.rounding)
+        body = max_pool2d_nhwc(np.maximum(body, 0))
+
+        for i in range(len(self.units)):
+            for j in range(self.units[i]):
+                stride = 2 if i > 0 and j == 0 else 1
+                body = self._residual_unit(body, stride, j > 0, name='stage%d_unit%d' % (i + 1, j + 1))
+
+        qconfig_fc = self.qconfig_dict['fc_qconfig']
+        body = global_avg_pool2d_nhwc(body)
+        body = requantize(body, qconfig_fc.from_scale, qconfig_fc.input_scale, 'int8',
+                          input_zero_point=qconfig_fc.from_zero_point, output_zero_point=qconfig_fc.input_zero_point,
+                          rounding=self.rounding)
+        flat = body.reshape(body.shape[0], -1).astype(np.float64) - qconfig_fc.input_zero_point
+        fc = np.rint(np.matmul(flat, self.params['fc_weight'].T.astype(np.float64) - qconfig_fc.kernel_zero_point))
+        fc = fc.astype(np.int64) + self.params['fc_bias']
+        return fc * np.float32(qconfig_fc.output_scale)
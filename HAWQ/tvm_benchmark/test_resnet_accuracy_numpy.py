@@ -0,0 +1,103 @@
+import torch
+
+import os
+import time
+import argparse
+
+import numpy as np
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+
+import hawq_numpy_runtime
+
+
+def get_model(params_dir, model_type, rounding, image_rounding):
+    if model_type == 'int4':
+        data_dtype = 'uint4'
+        kernel_dtype = 'int4'
+    elif model_type == 'int8':
+        kernel_dtype = data_dtype = 'int8'
+    else:
+        raise RuntimeError("Model type {} not supported".format(model_type))
+
+    num_stages = 4
+    units = [3, 4, 6, 3]
+
+    params = hawq_numpy_runtime.load_params(params_dir, kernel_dtype)
+    qconfig_dict = hawq_numpy_runtime.load_qconfig(data_dtype, kernel_dtype, num_stages=num_stages, units=units,
+                                                   file_name=os.path.join(params_dir, "quantized_checkpoint.pth.tar"))
+    return hawq_numpy_runtime.NumpyQuantizedResNet(params, qconfig_dict, units=units, rounding=rounding,
+                                                   image_rounding=image_rounding)
+
+
+def validate(val_dir, params_dir, batch_size, model_type, num_samples=None, rounding="TONEAREST",
+             image_rounding="TONEAREST", log_interval=10):
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                     std=[0.229, 0.224, 0.225])
+    dataset = datasets.ImageFolder(val_dir, transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        normalize,
+    ]))
+    if num_samples:
+        # ImageFolder is sorted by class, so evenly spaced indices cover every class
+        step = max(len(dataset) // num_samples, 1)
+        dataset = torch.utils.data.Subset(dataset, list(range(0, len(dataset), step))[:num_samples])
+    val_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+
+    model = get_model(params_dir, model_type, rounding, image_rounding)
+
+    top1, top5, nsamples, run_time = 0, 0, 0, 0.0
+    for i, (images, target) in enumerate(val_loader):
+        target = target.numpy()
+
+        start = time.time()
+        output = model(model.quantize_image(images.numpy()))
+        run_time += time.time() - start
+
+        pred = np.argsort(-output, axis=1)[:, :5]
+        top1 += (pred[:, 0] == target).sum()
+        top5 += (pred == target[:, None]).any(axis=1).sum()
+        nsamples += target.shape[0]
+
+        if not (i + 1) % log_interval:
+            print("[%d samples] validation: acc-top1=%f acc-top5=%f, %.2f images/sec"
+                  % (nsamples, top1 / nsamples, top5 / nsamples, nsamples / run_time))
+
+    print("[%d samples] final: acc-top1=%f acc-top5=%f, %.2f images/sec (%.1f ms/batch)"
+          % (nsamples, top1 / nsamples, top5 / nsamples, nsamples / run_time, run_time * 1000 / (i + 1)))
+    return top1 / nsamples, top5 / nsamples
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Resnet50 imagenet accuracy test on CPU, without TVM',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--model-dir', required=True,
+                        help='Model data directory (weights.npy, bias.npy, quantized_checkpoint.pth.tar)')
+
+    parser.add_argument('--val-dir', required=True, default=None,
+                        help='Validation dataset directory')
+
+    parser.add_argument('--model-type', default='int8',
+                        help='Model type (int4, int8)')
+
+    parser.add_argument('--rounding', default='TONEAREST',
+                        help='Round scheme of requantize (TONEAREST, UPWARD, TRUNCATE), '
+                             'TONEAREST as test_resnet_accuracy_imagenet builds its graph with get_workload')
+
+    parser.add_argument('--image-rounding', default='TONEAREST',
+                        help='Round scheme of the input image (TONEAREST, TRUNCATE)')
+
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='Batch size')
+
+    parser.add_argument('--num-samples', type=int, default=None,
+                        help='Validate on an evenly spaced subset of this many images')
+
+    args = parser.parse_args()
+
+    validate(args.val_dir, args.model_dir, args.batch_size, args.model_type,
+             num_samples=args.num_samples, rounding=args.rounding, image_rounding=args.image_rounding)
@@ -275,7 +275,7 @@ class SymmetricQuantFunction(Function):
         else:
             raise ValueError("The SymmetricQuantFunction requires a pre-calculated scaling factor")
 
-        zero_point = torch.tensor(0.).cuda()
+        zero_point = torch.tensor(0., device=x.device)
 
         new_quant_x = linear_quantize(x, scale, zero_point, inplace=False)
 
@@ -323,7 +323,7 @@ class AsymmetricQuantFunction(Function):
         if specified_zero_point is not None:
             zero_point = specified_zero_point
         else:
-            zero_point = torch.tensor(0).cuda()
+            zero_point = torch.tensor(0, device=x.device)
 
         new_quant_x = linear_quantize(x, scale, zero_point, inplace=False)
         n = 2 ** k - 1
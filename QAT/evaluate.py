@@ -1,3 +1,8 @@
+import argparse
+import json
+import os
+from copy import deepcopy
+
 from torch import nn
 import torch.backends.cudnn as cudnn
 from torchsummary import summary
@@ -5,10 +10,6 @@ from .models import *
 from utils import *
 from tqdm import tqdm
 
-from pytorchcv.models.common import ConvBlock
-from pytorchcv.models.shufflenetv2 import ShuffleUnit, ShuffleInitBlock
-from pytorchcv.model_provider import get_model as ptcv_get_model
-
 
 def _evaluate(args, tools):
     runtime_helper = RuntimeHelper()
@@ -18,6 +19,8 @@ def _evaluate(args, tools):
         arg_dict['runtime_helper'] = runtime_helper
     model = load_dnn_model(arg_dict, tools)
     model.cuda()
+    if args.channels_last:
+        model.to(memory_format=torch.channels_last)
     if not args.quantized:
         if args.dataset == 'imagenet':
             summary(model, (3, 224, 224))
@@ -26,6 +29,10 @@ def _evaluate(args, tools):
 
     criterion = nn.CrossEntropyLoss().cuda()
     cudnn.benchmark = True
+    if args.profile:
+        profiler = start_profiler(args.profile, args.profile_steps,
+                                  runtime_helper=runtime_helper if args.cluster > 1 else None)
+        profiler.attach(model)
 
 
     # ptcv_model = ptcv_get_model(args.arch, pretrained=True)
@@ -44,5 +51,172 @@ def _evaluate(args, tools):
             clustering_model = tools.clustering_method(args)
             clustering_model.load_clustering_model()
             pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper)
+            if getattr(clustering_model, 'monitor', None) is not None:
+                clustering_model.report_drift()
         else:
             validate(model, test_loader, criterion)
+    get_profiler().finish()
+
+
+class EvalEntry(object):
+    """
+        A checkpoint of an eval spec.
+        clustering_path : clustering model its PCQ layers run with ('' for non-PCQ models)
+        table_path      : clustering model its accuracy is broken down by
+    """
+    def __init__(self, name, args, tools, table_path):
+        self.name = name
+        self.args = args
+        self.tools = tools
+        self.clustering_path = args.clustering_path if args.cluster > 1 else ''
+        self.table_path = table_path
+        self.runtime_helper = None
+        self.model = None
+        self.correct = None
+        self.total = None
+
+    def load(self):
+        self.runtime_helper = RuntimeHelper()
+        self.runtime_helper.set_pcq_arguments(self.args)
+        arg_dict = deepcopy(vars(self.args))
+        arg_dict['runtime_helper'] = self.runtime_helper
+        self.model = load_dnn_model(arg_dict, self.tools).cuda()
+        if self.args.channels_last:
+            self.model.to(memory_format=torch.channels_last)
+        self.model.eval()
+
+    def unload(self):
+        self.model = None
+        self.runtime_helper = None
+
+    @torch.no_grad()
+    def update(self, input, target, clusters, table_clusters, num_table_clusters):
+        """ clusters (on CPU) pick the PCQ models' cluster of each sample, table_clusters (on the GPU) the column """
+        if self.clustering_path:
+            correct = torch.zeros(target.size(0), dtype=torch.bool, device=target.device)
+            for c in torch.unique(clusters).tolist():
+                idx = (clusters == c).nonzero(as_tuple=True)[0].to(target.device)
+                self.runtime_helper.batch_cluster = c
+                self.runtime_helper.qat_batch_cluster = torch.tensor(c, dtype=torch.int64, device='cuda',
+                                                                     requires_grad=False)
+                correct[idx] = self.model(input[idx]).argmax(dim=1) == target[idx]
+        else:
+            correct = self.model(input).argmax(dim=1) == target
+
+        if self.correct is None:
+            self.correct = torch.zeros(num_table_clusters, dtype=torch.int64, device=target.device)
+            self.total = torch.zeros(num_table_clusters, dtype=torch.int64, device=target.device)
+        self.correct += torch.bincount(table_clusters, weights=correct.double(), minlength=num_table_clusters).long()
+        self.total += torch.bincount(table_clusters, minlength=num_table_clusters)
+
+
+def get_eval_entries(args):
+    """ Spec: {"models": [{"name": ..., "dnn_path": ..., <args overriding the command line's>}, ...]} """
+    from .qat import specify_target_arch
+    with open(args.eval_spec, 'r') as f:
+        spec = json.load(f)
+
+    entries, clustering_paths = [], []
+    for overrides in spec['models']:
+        overrides = dict(overrides)
+        name = overrides.pop('name', None)
+        assert 'dataset' not in overrides, "Models of an eval spec are evaluated on the command line's dataset"
+        entry_args = argparse.Namespace(**dict(deepcopy(vars(args)), **overrides))
+        for key in ['bit_first', 'bit_classifier']:
+            if 'bit' in overrides and key not in overrides:
+                setattr(entry_args, key, entry_args.bit)
+        entry_args.arch, tools = specify_target_arch(entry_args.arch, entry_args.dataset, entry_args.cluster)
+        if entry_args.cluster > 1:
+            assert entry_args.clustering_path, "PCQ model {} needs its clustering_path".format(name)
+            if entry_args.clustering_path not in clustering_paths:
+                clustering_paths.append(entry_args.clustering_path)
+        entries.append(EvalEntry(name if name else os.path.basename(entry_args.dnn_path), entry_args, tools, ''))
+
+    # Non-PCQ models are broken down by the spec's first clustering model, to compare them with PCQ models
+    for entry in entries:
+        entry.table_path = entry.clustering_path if entry.clustering_path else \
+            (clustering_paths[0] if clustering_paths else '')
+    return entries
+
+
+def _evaluate_many(args, test_loader):
+    """
+        Evaluates the checkpoints of args.eval_spec in shared passes over the test set.
+        Each batch is loaded once and its clusters are predicted once per clustering model, then every resident
+        model runs on it (PCQ models once per cluster in the batch).
+        At most args.max_resident models are on the GPU at a time. With more models, every group loads the test set
+        again, and only the clusters predicted in the first pass are kept for the next groups.
+    """
+    from Clustering import get_clustering_model
+    entries = get_eval_entries(args)
+    clustering_models, num_clusters = {}, {}
+    for entry in entries:
+        if entry.table_path and entry.table_path not in clustering_models:
+            cluster_args = entries[[e.clustering_path for e in entries].index(entry.table_path)].args
+            clustering_models[entry.table_path] = get_clustering_model(cluster_args)
+            num_clusters[entry.table_path] = cluster_args.cluster
+
+    groups = [entries[i:i + args.max_resident] for i in range(0, len(entries), args.max_resident)]
+    # Clusters of each batch, a few bytes per sample, instead of the decoded batches
+    cached_clusters = []
+
+    def batches():
+        predict = not cached_clusters
+        for i, (input, target) in enumerate(test_loader):
+            if predict:
+                clusters = {path: model.predict_cluster_of_batch(input).cpu()
+                            for path, model in clustering_models.items()}
+                if len(groups) > 1:
+                    cached_clusters.append(clusters)
+            else:
+                clusters = cached_clusters[i]
+            yield input, target, clusters
+
+    for g, group in enumerate(groups):
+        for entry in group:
+            entry.load()
+        with tqdm(batches(), desc="Validate {}/{}".format(g + 1, len(groups)), total=len(test_loader), ncols=90) as t:
+            for input, target, clusters in t:
+                input, target = input.cuda(), target.cuda()
+                table_clusters = {path: c.cuda() for path, c in clusters.items()}
+                for entry in group:
+                    entry.update(input, target, clusters.get(entry.clustering_path),
+                                 table_clusters.get(entry.table_path, torch.zeros_like(target)),
+                                 num_clusters.get(entry.table_path, 1))
+        for entry in group:
+            entry.unload()
+        torch.cuda.empty_cache()
+
+    results = []
+    for entry in entries:
+        correct, total = entry.correct.cpu(), entry.total.cpu()
+        results.append({'name': entry.name, 'clustering': entry.table_path,
+                        'score': correct.sum().item() / total.sum().item() * 100,
+                        'per_cluster': [c / n * 100 if n else None for c, n in zip(correct.tolist(), total.tolist())],
+                        'count': total.tolist()})
+    print_eval_table(results)
+    save_eval_table(results, os.path.splitext(args.eval_spec)[0] + '_results.csv')
+    return results
+
+
+def print_eval_table(results):
+    width = max(len(r['name']) for r in results)
+    max_k = max(len(r['per_cluster']) for r in results)
+    print('{:<{w}}  {:>7}  '.format('Model', 'Acc', w=width) + '  '.join('{:>7}'.format('C{}'.format(c))
+                                                                      for c in range(max_k)))
+    for r in results:
+        cells = ['{:7.2f}'.format(acc) if acc is not None else '{:>7}'.format('-') for acc in r['per_cluster']]
+        print('{:<{w}}  {:7.2f}  '.format(r['name'], r['score'], w=width) + '  '.join(cells))
+
+
+def save_eval_table(results, path):
+    max_k = max(len(r['per_cluster']) for r in results)
+    with open(path, 'w') as f:
+        f.write(','.join(['model', 'clustering', 'acc'] + ['acc_c{}'.format(c) for c in range(max_k)]
+                         + ['n_c{}'.format(c) for c in range(max_k)]) + '\n')
+        for r in results:
+            pad = max_k - len(r['per_cluster'])
+            accs = ['{:.3f}'.format(acc) if acc is not None else '' for acc in r['per_cluster']] + [''] * pad
+            counts = [str(n) for n in r['count']] + [''] * pad
+            f.write(','.join([r['name'], r['clustering'], '{:.3f}'.format(r['score'])] + accs + counts) + '\n')
+    print('Saved per-cluster accuracies to {}'.format(path))
@@ -1,10 +1,17 @@
 from copy import deepcopy
 
 import torch
+import torch.distributed as dist
 from torchsummary import summary
 
 from utils import *
+from utils.distributed import init_distributed, is_main_process, broadcast_object, wrap_ddp_model, \
+    get_distributed_train_loader, ddp_pcq_epoch
+from utils.checkpoint_writer import AsyncCheckpointWriter
+from utils.proxy_validation import ProxyValidator
+from utils.calibration import get_calibration_batches, calibrate_activation_ranges
 from .models import *
+from .models.quantization_utils import IncrementalQuantizer
 from tqdm import tqdm
 from time import time
 
@@ -14,14 +21,18 @@ warnings.filterwarnings("ignore")
 def _finetune(args, tools, data_loaders, clustering_model):
     tuning_start_time = time()
 
+    device = 'cuda'
+    if args.ddp:
+        device = init_distributed(args.ddp_backend)
+
     runtime_helper = RuntimeHelper()
-    runtime_helper.set_pcq_arguments(args)
+    runtime_helper.set_pcq_arguments(args, device)
 
     arg_dict = deepcopy(vars(args))
     arg_dict['runtime_helper'] = runtime_helper
 
     pretrained_model = load_dnn_model(arg_dict, tools)
-    pretrained_model.cuda()
+    pretrained_model.to(device)
 
     train_loader = data_loaders['aug_train']
     #val_loader = data_loaders['val']
@@ -32,11 +43,21 @@ def _finetune(args, tools, data_loaders, clustering_model):
     model = get_finetuning_model(arg_dict, tools, pretrained_model)
     if pretrained_model:
         del pretrained_model
-    model.cuda()
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    model.to(device, memory_format=memory_format)
+    if args.profile:
+        profiler = start_profiler(args.profile, args.profile_steps,
+                                  runtime_helper=runtime_helper if args.cluster > 1 else None)
+        profiler.attach(model)
+
+    ddp_model = None
+    if args.ddp:
+        ddp_model = wrap_ddp_model(model, device, find_unused_parameters=args.cluster > 1)
+        train_loader = get_distributed_train_loader(args, clustering_model, train_loader.dataset)
 
     optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
     opt_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=30, gamma=0.1)
-    criterion = torch.nn.CrossEntropyLoss().cuda()
+    criterion = torch.nn.CrossEntropyLoss().to(device)
 
     save_path_fp = ''
     epoch_to_start = 1
@@ -47,38 +68,61 @@ def _finetune(args, tools, data_loaders, clustering_model):
         save_path_fp, best_epoch, best_int_val_score = load_tuning_info(args.dnn_path)
 
     if not save_path_fp:
-        save_path_fp = set_save_dir(args, allow_existence=False)
+        if is_main_process():
+            save_path_fp = set_save_dir(args, allow_existence=False)
+        if args.ddp:
+            save_path_fp = broadcast_object(save_path_fp)
         args.dnn_path = save_path_fp
         print("Save dir: " + args.dnn_path)
     save_path_int = add_path(save_path_fp, 'quantized')
     logger = set_logger(save_path_fp)
 
     quantized_model = None
+    quantizer = IncrementalQuantizer(tools.quantizer, memory_format)
+    writer = AsyncCheckpointWriter() if is_main_process() else None
+    proxy = None
+    if args.proxy_val and is_main_process():
+        proxy = ProxyValidator(args, clustering_model if args.cluster > 1 else None, test_loader.dataset, args.proxy_val)
+    proxy_helper = runtime_helper if args.cluster > 1 else None
     for e in range(epoch_to_start, args.epoch + 1):
         if e > args.fq:
             runtime_helper.apply_fake_quantization = True
 
-        if args.cluster > 1:
+        if args.ddp:
+            ddp_pcq_epoch(ddp_model, train_loader, criterion, optimizer, runtime_helper if args.cluster > 1 else None,
+                          e, logger, device=device)
+        elif args.cluster > 1:
             pcq_epoch(model, clustering_model, train_loader, criterion, optimizer, runtime_helper, e, logger)
         else:
             train_epoch(model, train_loader, criterion, optimizer, e, logger)
         opt_scheduler.step()
+        if args.act_checkpoint and torch.cuda.is_available():
+            logger.debug("[Epoch {}] Peak GPU memory: {:.0f}MB".format(e, torch.cuda.max_memory_allocated() / 2 ** 20))
+            torch.cuda.reset_peak_memory_stats()
+
+        if args.ddp and not is_main_process():
+            # Validation, quantization and checkpoints are done by rank 0
+            dist.barrier()
+            continue
 
         fp_score = 0
         if args.dataset != 'imagenet':
-            if args.cluster > 1:
+            if proxy is not None:
+                fp_score, _, _ = proxy.validate(model, proxy_helper, logger, device)
+            elif args.cluster > 1:
                 #fp_score = pcq_validate(model, clustering_model, val_loader, criterion, runtime_helper, logger)
-                fp_score = pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper, logger)
+                fp_score = pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper, logger,
+                                        device=device)
             else:
                 #fp_score = validate(model, val_loader, criterion, logger)
-                fp_score = validate(model, test_loader, criterion, logger)
+                fp_score = validate(model, test_loader, criterion, logger, device=device)
 
         state = {
             'epoch': e,
             'state_dict': model.state_dict(),
             'optimizer': optimizer.state_dict(),
         }
-        save_checkpoint(state, False, save_path_fp)
+        writer.save(state, os.path.join(save_path_fp, 'checkpoint.pth'))
 
         # Test quantized model, and save if performs the best
         if e > args.fq:
@@ -88,17 +132,25 @@ def _finetune(args, tools, data_loaders, clustering_model):
                     quantized_model = tools.quantized_model_initializer(arg_dict, num_classes=100)
                 else:
                     quantized_model = tools.quantized_model_initializer(arg_dict)
-            quantized_model = tools.quantizer(model, quantized_model)
-            quantized_model.cuda()
+            quantized_model = quantizer(model, quantized_model)
+
+            full_val = True
+            if proxy is not None:
+                proxy_score, half_width, _ = proxy.validate(quantized_model, proxy_helper, logger, device)
+                print('Proxy INT-val Score: {:.2f} +- {:.2f}'.format(proxy_score, half_width))
+                # Full validation if the proxy can't rule out a new best, at the cadence, and at the last epoch
+                full_val = proxy_score + half_width > best_int_val_score or e == args.epoch or \
+                    (args.full_val_every and not e % args.full_val_every)
 
-            if args.cluster > 1:
+            int_score = 0
+            if full_val and args.cluster > 1:
                 #int_score = pcq_validate(quantized_model, clustering_model, val_loader, criterion, runtime_helper,
                 #                         logger)
                 int_score = pcq_validate(quantized_model, clustering_model, test_loader, criterion, runtime_helper,
-                                         logger)
-            else:
+                                         logger, device=device)
+            elif full_val:
                 #int_score = validate(quantized_model, val_loader, criterion, logger)
-                int_score = validate(quantized_model, test_loader, criterion, logger)
+                int_score = validate(quantized_model, test_loader, criterion, logger, device=device)
 
             if int_score > best_int_val_score:
                 best_epoch = e
@@ -108,7 +160,7 @@ def _finetune(args, tools, data_loaders, clustering_model):
                     tmp['best_epoch'] = e
                     tmp['best_score'] = fp_score
                     json.dump(tmp, f, indent=4)
-                shutil.copyfile(os.path.join(save_path_fp, 'checkpoint.pth'), os.path.join(save_path_fp, 'best.pth'))
+                writer.copy(os.path.join(save_path_fp, 'checkpoint.pth'), os.path.join(save_path_fp, 'best.pth'))
 
                 # Save best model's INT model
                 best_int_val_score = int_score
@@ -118,8 +170,15 @@ def _finetune(args, tools, data_loaders, clustering_model):
                     tmp['best_int_val_score'] = best_int_val_score
                     json.dump(tmp, f, indent=4)
                 filepath = os.path.join(save_path_int, 'checkpoint.pth')
-                torch.save({'state_dict': quantized_model.state_dict()}, filepath)
+                writer.save({'state_dict': quantized_model.state_dict()}, filepath)
             print('Best INT-val Score: {:.2f} (Epoch: {})'.format(best_int_val_score, best_epoch))
+        if args.ddp:
+            dist.barrier()
+    get_profiler().finish()
+
+    if args.ddp and not is_main_process():
+        return
+    writer.close()
 
     test_score = best_int_val_score
     '''
@@ -163,6 +222,7 @@ def _finetune(args, tools, data_loaders, clustering_model):
                 .format(test_score, args.arch, args.dataset, method, args.lr, args.weight_decay, args.epoch, args.batch,
                         pc, args.bit, args.bit_first, args.bit_classifier, args.bit_addcat, args.smooth, best_epoch,
                         tuning_time_cost, args.gpu, save_path_fp))
+    return {'score': test_score, 'best_epoch': best_epoch, 'time': time() - tuning_start_time, 'path': save_path_fp}
 
     # range_fname = None
     # for i in range(9999999):
@@ -179,3 +239,77 @@ def _finetune(args, tools, data_loaders, clustering_model):
     #                 for c in range(args.cluster):
     #                     f.write('{:.4f}, {:.4f}\n'.format(param[c][0].item(), param[c][1].item()))
     # save_fused_network_in_darknet_form(model, args)
+
+
+def _calibrate(args, tools, data_loaders, clustering_model):
+    """
+        Post-training quantization: activation ranges of every cluster from a few calibration batches,
+        then the integer model is made from the calibrated model without any training.
+    """
+    calibration_start_time = time()
+
+    runtime_helper = RuntimeHelper()
+    runtime_helper.set_pcq_arguments(args)
+
+    arg_dict = deepcopy(vars(args))
+    arg_dict['runtime_helper'] = runtime_helper
+
+    pretrained_model = load_dnn_model(arg_dict, tools)
+    pretrained_model.cuda()
+
+    test_loader = data_loaders['test']
+    if args.nnac and clustering_model.final_cluster is None:
+        clustering_model.nn_aware_clustering(pretrained_model, data_loaders['aug_train'], args.arch)
+
+    model = get_finetuning_model(arg_dict, tools, pretrained_model)
+    del pretrained_model
+    model.cuda()
+    if args.channels_last:
+        model.to(memory_format=torch.channels_last)
+
+    calibration_dataset = get_non_augmented_train_dataset(args, get_normalizer(args.dataset))
+    calibration_loader = get_data_loader(calibration_dataset, batch_size=args.batch, shuffle=True, workers=args.worker)
+    batches = get_calibration_batches(calibration_loader, clustering_model if args.cluster > 1 else None,
+                                      runtime_helper, args, args.calib_batches)
+    n_batches = calibrate_activation_ranges(model, batches, runtime_helper if args.cluster > 1 else None,
+                                            method=args.calib_observer, percentile=args.calib_percentile)
+
+    model.set_quantization_params()
+    if args.dataset == 'cifar100':
+        quantized_model = tools.quantized_model_initializer(arg_dict, num_classes=100)
+    else:
+        quantized_model = tools.quantized_model_initializer(arg_dict)
+    quantized_model = tools.quantizer(model, quantized_model)
+    quantized_model.cuda()
+    if args.channels_last:
+        quantized_model.to(memory_format=torch.channels_last)
+    calibration_time_cost = get_time_cost_in_string(time() - calibration_start_time)
+
+    save_path_fp = set_save_dir(args)
+    save_path_int = add_path(save_path_fp, 'quantized')
+    logger = set_logger(save_path_fp)
+
+    criterion = torch.nn.CrossEntropyLoss().cuda()
+    if args.cluster > 1:
+        int_score = pcq_validate(quantized_model, clustering_model, test_loader, criterion, runtime_helper, logger)
+    else:
+        int_score = validate(quantized_model, test_loader, criterion, logger)
+
+    torch.save({'state_dict': model.state_dict()}, os.path.join(save_path_fp, 'checkpoint.pth'))
+    torch.save({'state_dict': quantized_model.state_dict()}, os.path.join(save_path_int, 'checkpoint.pth'))
+    with open(os.path.join(save_path_int, "params.json"), 'w') as f:
+        tmp = vars(args)
+        tmp['calibration_batches'] = n_batches
+        tmp['int_test_score'] = int_score
+        json.dump(tmp, f, indent=4)
+
+    if args.cluster > 1:
+        method = f'PTQ+DAQ+{args.quant_base}({args.clustering_method}, K{args.cluster}S{args.sub_cluster}P{args.partition}-{args.repr_method})'
+    else:
+        method = f'PTQ+{args.quant_base}'
+    with open(f'./ptq_{args.arch}_{args.dataset}_{args.bit}_F{args.bit_first}L{args.bit_classifier}_{args.gpu}.txt', 'a') as f:
+        f.write('{:.2f} # {}, {}, {}, Observer: {}, Batches: {}x{}, Bit(First/Last/AddCat): {}({}/{}/{}), Time: {}, GPU: {}, Path: {}\n'
+                .format(int_score, args.arch, args.dataset, method, args.calib_observer, n_batches, args.batch,
+                        args.bit, args.bit_first, args.bit_classifier, args.bit_addcat, calibration_time_cost,
+                        args.gpu, save_path_fp))
+    return {'score': int_score, 'best_epoch': 0, 'time': time() - calibration_start_time, 'path': save_path_fp}
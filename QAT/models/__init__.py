@@ -1,26 +1,27 @@
-from .mlp import *
-from .alexnet import *
-from .resnet import *
-from .mobilenet import *
-from .densenet import *
+from importlib import import_module
 
-from .fused_mlp import *
-from .fused_alexnet import *
-from .fused_resnet import *
-from .fused_mobilenet import *
-from .fused_densenet import *
+from .quantization_utils import *
+from .layers import *
 
-from .pcq_mlp import *
-from .pcq_alexnet import *
-from .pcq_resnet import *
-from .pcq_densenet import *
+# Model families are imported on first use of one of their names, e.g. `from QAT.models import fused_resnet20`.
+# Jobs get the functions of their architecture from QAT/registry.py, which imports only the modules they need.
+_FAMILIES = [
+    'mlp', 'alexnet', 'resnet', 'mobilenet', 'densenet',
+    'fused_mlp', 'fused_alexnet', 'fused_resnet', 'fused_mobilenet', 'fused_densenet',
+    'pcq_mlp', 'pcq_alexnet', 'pcq_resnet', 'pcq_densenet',
+    'quantized_mlp', 'quantized_alexnet', 'quantized_resnet', 'quantized_mobilenet', 'quantized_densenet',
+]
 
-from .quantized_mlp import *
-from .quantized_alexnet import *
-from .quantized_resnet import *
-from .quantized_mobilenet import *
-from .quantized_densenet import *
 
-from .quantization_utils import *
+def __getattr__(name):
+    # `from QAT.models import *` looks up __all__, which would otherwise import every family.
+    # Star-importers get quantization_utils and layers only, and import what they need from the families
+    if name.startswith('__'):
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    for family in _FAMILIES:
+        module = import_module('.' + family, __name__)
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
 
 # from .bert import *
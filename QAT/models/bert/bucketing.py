@@ -0,0 +1,74 @@
+from functools import partial
+
+import numpy as np
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+class LengthBucketSampler(Sampler):
+    """
+        Batch sampler grouping sequences of similar lengths.
+        Indices are (shuffled and) split into buckets of bucket_size batches, sorted by length within each bucket,
+        and cut into batches. Batches are shuffled again, so their order stays random while each of them is padded
+        only up to its own longest sequence (with trim_padding).
+    """
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True, drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        bucket_length = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), bucket_length):
+            bucket = indices[start:start + bucket_length]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches += [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter([batch.tolist() for batch in batches])
+
+    def __len__(self):
+        bucket_length = self.batch_size * self.bucket_size
+        sizes = [min(bucket_length, len(self.lengths) - start) for start in range(0, len(self.lengths), bucket_length)]
+        if self.drop_last:
+            return sum(size // self.batch_size for size in sizes)
+        return sum(-(-size // self.batch_size) for size in sizes)
+
+
+def trim_padding(batch, mask_index=1):
+    """
+        Cuts the sequences of a batch padded to max_seq_length down to the longest one in the batch.
+        batch : tensors as in run_classifier's TensorDataset, (input_ids, input_mask, segment_ids, label_ids),
+                with the attention mask at mask_index
+    """
+    max_seq_length = batch[mask_index].size(1)
+    length = int(batch[mask_index].sum(dim=1).max())
+    return [t[:, :length] if t.dim() == 2 and t.size(1) == max_seq_length else t for t in batch]
+
+
+def collate_trimmed(batch, mask_index=1):
+    return trim_padding(default_collate(batch), mask_index)
+
+
+def get_sequence_lengths(dataset, mask_index=1):
+    """ Number of real tokens of each sequence of a TensorDataset """
+    return dataset.tensors[mask_index].sum(dim=1).numpy()
+
+
+def get_bucketed_data_loader(dataset, batch_size, bucket_size=100, shuffle=True, mask_index=1, workers=0):
+    """ DataLoader of a BERT TensorDataset with length-bucketed batches, each trimmed to its longest sequence """
+    sampler = LengthBucketSampler(get_sequence_lengths(dataset, mask_index), batch_size, bucket_size, shuffle)
+    return DataLoader(dataset, batch_sampler=sampler, num_workers=workers,
+                      collate_fn=partial(collate_trimmed, mask_index=mask_index))
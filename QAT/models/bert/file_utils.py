@@ -17,9 +17,7 @@ from functools import wraps
 
 from tqdm import tqdm
 
-import boto3
-from botocore.exceptions import ClientError
-import requests
+# boto3 and requests are imported where files are downloaded, so tokenization and models import without them
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -118,6 +116,7 @@ def s3_request(func: Callable):
 
     @wraps(func)
     def wrapper(url: str, *args, **kwargs):
+        from botocore.exceptions import ClientError
         try:
             return func(url, *args, **kwargs)
         except ClientError as exc:
@@ -132,6 +131,7 @@ def s3_request(func: Callable):
 @s3_request
 def s3_etag(url: str) -> Optional[str]:
     """Check ETag on S3 object."""
+    import boto3
     s3_resource = boto3.resource("s3")
     bucket_name, s3_path = split_s3_path(url)
     s3_object = s3_resource.Object(bucket_name, s3_path)
@@ -141,12 +141,14 @@ def s3_etag(url: str) -> Optional[str]:
 @s3_request
 def s3_get(url: str, temp_file: IO) -> None:
     """Pull a file directly from S3."""
+    import boto3
     s3_resource = boto3.resource("s3")
     bucket_name, s3_path = split_s3_path(url)
     s3_resource.Bucket(bucket_name).download_fileobj(s3_path, temp_file)
 
 
 def http_get(url: str, temp_file: IO) -> None:
+    import requests
     req = requests.get(url, stream=True)
     content_length = req.headers.get('Content-Length')
     total = int(content_length) if content_length is not None else None
@@ -172,6 +174,7 @@ def get_from_cache(url: str, cache_dir: str = None) -> str:
     if url.startswith("s3://"):
         etag = s3_etag(url)
     else:
+        import requests
         response = requests.head(url, allow_redirects=True)
         if response.status_code != 200:
             raise IOError("HEAD request failed for url {} with status code {}"
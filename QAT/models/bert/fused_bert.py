@@ -19,7 +19,7 @@ from torch.nn import CrossEntropyLoss
 
 from .bert import BertForSequenceClassification
 from .file_utils import cached_path
-from .. import FusedLinear, ema, calc_qparams, fake_quantize, KMeans
+from .. import FusedLinear, ema, calc_qparams, fake_quantize, get_range
 
 from sklearn.cluster import MiniBatchKMeans
 import numpy as np
@@ -302,7 +302,9 @@ class FusedBertSelfAttention(nn.Module):
 
         self.bit, self.smooth, self.use_ste, self.quant_noise, self.qn_prob, self.runtime_helper = \
                 itemgetter('bit', 'smooth', 'ste', 'quant_noise', 'qn_prob', 'runtime_helper')(arg_dict)
-        self.apply_ema = False
+        self.q_max = 2 ** self.bit - 1
+        # Range of the context layer, the output of the integer attention
+        self.apply_ema = nn.Parameter(torch.tensor(0, dtype=torch.bool), requires_grad=False)
         self.act_range = nn.Parameter(torch.zeros(2), requires_grad=False)
 
 
@@ -337,15 +339,32 @@ class FusedBertSelfAttention(nn.Module):
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
+
+        if self.training:
+            if self.apply_ema:
+                self.act_range[0], self.act_range[1] = ema(context_layer, self.act_range, self.smooth)
+                if self.runtime_helper.apply_fake_quantization:
+                    s, z = calc_qparams(self.act_range[0], self.act_range[1], self.bit)
+                    context_layer = fake_quantize(context_layer, s, z, self.bit, use_ste=self.use_ste)
+            else:
+                self.act_range[0], self.act_range[1] = get_range(context_layer)
+                self.apply_ema.data = torch.tensor(True, dtype=torch.bool)
         return context_layer
 
     def set_qparams(self, s1, z1):
+        """
+            Query, key and value share their output qparams (over the union of their ranges),
+            as the integer model computes them with one fused QKV projection.
+        """
         self.s1, self.z1 = nn.Parameter(s1, requires_grad=False), nn.Parameter(z1, requires_grad=False)
-        prev_s_q, prev_z_q = self.query.set_qparams(s1, z1)
-        prev_s_k, prev_z_k = self.key.set_qparams(s1, z1)
-        prev_s_v, prev_z_v = self.value.set_qparams(s1, z1)
+        ranges = torch.stack([self.query.act_range, self.key.act_range, self.value.act_range])
+        s_qkv, z_qkv = calc_qparams(ranges[:, 0].min(), ranges[:, 1].max(), self.bit)
+        self.query.set_qparams(s1, z1, s_qkv, z_qkv)
+        self.key.set_qparams(s1, z1, s_qkv, z_qkv)
+        self.value.set_qparams(s1, z1, s_qkv, z_qkv)
 
-        # return prev_s, prev_z
+        self.s3, self.z3 = calc_qparams(self.act_range[0], self.act_range[1], self.bit)
+        return self.s3, self.z3
 
 
 
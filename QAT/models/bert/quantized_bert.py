@@ -184,58 +184,88 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 class QuantizedBertSelfAttention(nn.Module):
+    """
+        Self-attention on integer codes.
+        Query, key and value come from one fused projection (sharing its output qparams), and the attention runs
+        in integers: scores QK^T of scale s_qkv^2 / sqrt(head_size), integer_softmax to probabilities of scale
+        2^-prob_bit, and the context, probs x V, requantized per cluster to its own qparams (s3, z3).
+        Probabilities get up to 16 bits, as 8-bit ones are too coarse for attention over tens of tokens,
+        while their products with value codes stay exact in float (2^prob_bit * 2^bit <= 2^24).
+    """
     def __init__(self, config, arg_dict=None):
         super(QuantizedBertSelfAttention, self).__init__()
         if config.hidden_size % config.num_attention_heads != 0:
             raise ValueError(
                 "The hidden size (%d) is not a multiple of the number of attention "
                 "heads (%d)" % (config.hidden_size, config.num_attention_heads))
+        self.layer_type = 'QuantizedBertSelfAttention'
         self.num_attention_heads = config.num_attention_heads
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-        # self.query = nn.Linear(config.hidden_size, self.all_head_size)
-        # self.key = nn.Linear(config.hidden_size, self.all_head_size)
-        # self.value = nn.Linear(config.hidden_size, self.all_head_size)
-
-        self.query = QuantizedLinear(config.hidden_size, self.all_head_size, arg_dict=arg_dict)
-        self.key = QuantizedLinear(config.hidden_size, self.all_head_size, arg_dict=arg_dict)
-        self.value = QuantizedLinear(config.hidden_size, self.all_head_size, arg_dict=arg_dict)
-
-        self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
-
-    def transpose_for_scores(self, x):
-        new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
-        x = x.view(*new_x_shape)
-        return x.permute(0, 2, 1, 3)
+        self.qkv = QuantizedLinear(config.hidden_size, 3 * self.all_head_size, arg_dict=arg_dict)
 
-    def forward(self, hidden_states, attention_mask):
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(hidden_states)
-        mixed_value_layer = self.value(hidden_states)
-
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-        key_layer = self.transpose_for_scores(mixed_key_layer)
-        value_layer = self.transpose_for_scores(mixed_value_layer)
-
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        attention_scores = attention_scores + attention_mask
+        bit, self.num_clusters, self.runtime_helper = itemgetter('bit', 'cluster', 'runtime_helper')(arg_dict)
+        self.a_bit = nn.Parameter(torch.tensor(bit, dtype=torch.int8), requires_grad=False)
+        self.prob_bit = min(max(24 - bit, 8), 16)
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+        t_init = list(range(self.num_clusters)) if self.num_clusters > 1 else 0
+        # Constants of integer_softmax, by get_softmax_constants
+        self.exp_up = nn.Parameter(torch.tensor(t_init, dtype=torch.int64), requires_grad=False)
+        self.exp_ln2 = nn.Parameter(torch.tensor(t_init, dtype=torch.int64), requires_grad=False)
+        self.exp_ln2_inv = nn.Parameter(torch.tensor(t_init, dtype=torch.int64), requires_grad=False)
+        self.exp_b = nn.Parameter(torch.tensor(t_init, dtype=torch.int64), requires_grad=False)
+        self.exp_c = nn.Parameter(torch.tensor(t_init, dtype=torch.int64), requires_grad=False)
+        self.s3 = nn.Parameter(torch.tensor(t_init, dtype=torch.float32), requires_grad=False)
+        self.z3 = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
+        self.M0 = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
+        self.shift = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
+
+    def _get_qparam(self, param, batch_cluster):
+        # Broadcastable to (batch, heads, seq, seq)
+        if batch_cluster is not None:
+            param = torch.index_select(param, 0, batch_cluster.reshape(-1))
+        return param.reshape(-1, 1, 1, 1)
+
+    def _project_qkv(self, x, batch_cluster, seq_length):
+        # QuantizedLinear selects per-cluster qparams by row, and rows are tokens: one cluster index per token
+        if batch_cluster is None or batch_cluster.dim() == 0:
+            return self.qkv(x)
+        self.runtime_helper.qat_batch_cluster = batch_cluster.reshape(-1).repeat_interleave(seq_length)
+        try:
+            return self.qkv(x)
+        finally:
+            self.runtime_helper.qat_batch_cluster = batch_cluster
 
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        attention_probs = self.dropout(attention_probs)
+    def forward(self, hidden_states, attention_mask=None):
+        """
+            hidden_states  : codes of (batch, seq, hidden)
+            attention_mask : bool of (batch, 1, 1, seq), False at padding
+        """
+        batch, seq_length = hidden_states.size(0), hidden_states.size(1)
+        bc = self.runtime_helper.qat_batch_cluster if self.num_clusters > 1 else None
+
+        mixed = self._project_qkv(hidden_states.reshape(batch * seq_length, -1).float(), bc, seq_length)
+        mixed = mixed.view(batch, seq_length, 3, self.num_attention_heads, self.attention_head_size)
+        # Broadcastable to (3, batch, heads, seq, head_size)
+        z_qkv = self._get_qparam(self.qkv.z3, bc).unsqueeze(0)
+        query_layer, key_layer, value_layer = mixed.permute(2, 0, 3, 1, 4).sub(z_qkv).float()
+
+        # Products of codes are exact in float: |QK^T| <= 2^(2 * bit) * head_size, |probs x V| <= 2^(prob_bit + bit)
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2)).long()
+        attention_probs = integer_softmax(attention_scores, self._get_qparam(self.exp_up, bc),
+                                          self._get_qparam(self.exp_ln2, bc), self._get_qparam(self.exp_ln2_inv, bc),
+                                          self._get_qparam(self.exp_b, bc), self._get_qparam(self.exp_c, bc),
+                                          self.prob_bit, attention_mask)
+
+        context_layer = torch.matmul(attention_probs.float(), value_layer).long()
+        M0, shift = self._get_qparam(self.M0, bc), self._get_qparam(self.shift, bc)
+        neg_shift = torch.clamp(- shift, min=0)
+        context_layer = mul_and_shift(context_layer << neg_shift, M0, torch.clamp(shift, min=0))
+        context_layer = clamp_matrix(context_layer.add(self._get_qparam(self.z3, bc)), self.a_bit)
 
-        context_layer = torch.matmul(attention_probs, value_layer)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
-        context_layer = context_layer.view(*new_context_layer_shape)
-        return context_layer
+        return context_layer.view(batch, seq_length, self.all_head_size)
 
 class QuantizedBertAttention(nn.Module):
     def __init__(self, config, arg_dict=None):
@@ -266,7 +296,7 @@ class QuantizedBertOutput(nn.Module):
     def __init__(self, config, arg_dict=None):
         super(QuantizedBertOutput, self).__init__()
         # self.dense = nn.Linear(config.intermediate_size, config.hidden_size)
-        self.dense = QuantizedLinear(config.intermediate_size, config.hidden_sizem, arg_dict=arg_dict)
+        self.dense = QuantizedLinear(config.intermediate_size, config.hidden_size, arg_dict=arg_dict)
         self.LayerNorm = BertLayerNorm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
@@ -284,8 +314,8 @@ class QuantizedBertIntermediate(nn.Module):
 
         self.intermediate_act_fn = ACT2FN[config.hidden_act] \
             if isinstance(config.hidden_act, str) else config.hidden_act
-        self.dense = QuantizedLinear(config.hiddensize, config.intermediate_size, activation=self.intermediate_act_fn
-                                     , arg_dict=arg_dict)
+        # Without activation: its lookup table needs the pre-activation qparams, which FusedLinear doesn't track
+        self.dense = QuantizedLinear(config.hidden_size, config.intermediate_size, arg_dict=arg_dict)
 
     def forward(self, hidden_states):
         hidden_states = self.dense(hidden_states)
@@ -327,8 +357,8 @@ class QuantizedBertPooler(nn.Module):
         super(QuantizedBertPooler, self).__init__()
         # self.dense = nn.Linear(config.hidden_size, config.hidden_size)
         self.activation = nn.Tanh()
-        self.dense = QuantizedLinear(config.hidden_size, config.hidden_size, activation=self.activation,
-                                     arg_dict=arg_dict)
+        # Without activation: its lookup table needs the pre-activation qparams, which FusedLinear doesn't track
+        self.dense = QuantizedLinear(config.hidden_size, config.hidden_size, arg_dict=arg_dict)
 
     def forward(self, hidden_states):
         # We "pool" the model by simply taking the hidden state corresponding
@@ -543,13 +573,9 @@ class QuantizedBertModel(PreTrainedBertModel):
         # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
         extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
 
-        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
-        # masked positions, this operation will create a tensor which is 0.0 for
-        # positions we want to attend and -10000.0 for masked positions.
-        # Since we are adding it to the raw scores before the softmax, this is
-        # effectively the same as removing these entirely.
-        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)  # fp16 compatibility
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        # The integer softmax takes the mask as bool, dropping keys where it is False
+        # instead of adding -10000.0 to their scores.
+        extended_attention_mask = extended_attention_mask.bool()
 
         embedding_output = self.embeddings(input_ids, token_type_ids)
         encoded_layers = self.encoder(embedding_output,
@@ -638,6 +664,48 @@ def quantized_bert_small(config, arg_dict):
     return QuantizedBertForSequenceClassification(config=config, arg_dict=arg_dict)
 
 
+def _quantize_M(M):
+    # quantize_M of each cluster's M
+    if M.dim() == 0:
+        return quantize_M(M)
+    quantized = [quantize_M(m) for m in M]
+    return torch.stack([q for q, _ in quantized]), torch.stack([shift for _, shift in quantized])
+
+
+def quantize_self_attention(_fp, _int):
+    """
+        _fp  : FusedBertSelfAttention with its qparams set
+        _int : QuantizedBertSelfAttention
+        Query, key and value weights are quantized together, with the qparams of their union's range.
+    """
+    with torch.no_grad():
+        qkv = _int.qkv
+        fp_layers = [_fp.query, _fp.key, _fp.value]
+        weight = torch.cat([layer.fc.weight for layer in fp_layers])
+        s2, z2 = calc_qparams(weight.min(), weight.max(), _fp.query.w_bit, symmetric=_fp.query.symmetric)
+        qkv.s1.data, qkv.z1.data = _fp.query.s1, _fp.query.z1
+        qkv.s2.data, qkv.z2.data = s2, z2
+        qkv.s3.data, qkv.z3.data = _fp.query.s3, _fp.query.z3
+        qkv.M0.data, qkv.shift.data = _quantize_M(qkv.s1.type(torch.double) * s2.type(torch.double) / qkv.s3.type(torch.double))
+        qkv.is_shift_neg.data = torch.tensor(bool((qkv.shift < 0).any()), dtype=torch.bool)
+        qkv.weight.copy_(quantize_matrix(weight, s2, z2, qkv.w_bit, symmetric=_fp.query.symmetric))
+        qkv.sum_a2.copy_(torch.sum(qkv.weight, dim=1).reshape(1, qkv.out_features))
+        if _fp.query.fc.bias is not None:
+            bias = torch.cat([layer.fc.bias for layer in fp_layers])
+            qkv.is_bias.data = torch.tensor(True, dtype=torch.bool)
+            qkv.quantized_bias.copy_(quantize_matrix(bias[None, :], qkv.s1.reshape(-1, 1) * s2, 0, bit=32, symmetric=True))
+
+        s_score = qkv.s3.type(torch.double) ** 2 / math.sqrt(_int.attention_head_size)
+        params = [_int.exp_up, _int.exp_ln2, _int.exp_ln2_inv, _int.exp_b, _int.exp_c]
+        for param, constant in zip(params, get_softmax_constants(s_score)):
+            param.data = constant.reshape(param.shape).to(param.device)
+
+        _int.s3.data, _int.z3.data = _fp.s3, _fp.z3
+        _int.M0.data, _int.shift.data = _quantize_M(qkv.s3.type(torch.double) / (2 ** _int.prob_bit)
+                                                   / _int.s3.type(torch.double))
+    return _int
+
+
 def quantize_bert(fp_model, int_model:QuantizedBertForSequenceClassification):
 
     int_model.scale = torch.nn.Parameter(fp_model.bert.scale, requires_grad=False)
@@ -649,19 +717,14 @@ def quantize_bert(fp_model, int_model:QuantizedBertForSequenceClassification):
     for i in range(num_transformer):
         # Bert Attention
         ## Self Attention
-        int_model.bert.encoder.layer[i].attention.self.query.fc = quantize(fp_model.encoder.layer[i].attention.self.query,
-                                                                        int_model.bert.encoder.layer[i].attention.self.query.fc)
-        int_model.bert.encoder.layer[i].attention.self.key.fc = quantize(fp_model.encoder.layer[i].attention.self.key.fc,
-                                                                        int_model.bert.encoder.layer[i].attention.self.key.fc)
-
-        int_model.bert.encoder.layer[i].attention.self.value.fc = quantize(fp_model.encoder.layer[i].attention.self.value.fc,
-                                                                        int_model.encoder.layer[i].attention.self.value.fc)
+        quantize_self_attention(fp_model.bert.encoder.layer[i].attention.self,
+                                int_model.bert.encoder.layer[i].attention.self)
         ## Self Output
         int_model.bert.encoder.layer[i].attention.output.dense.fc = quantize(fp_model.bert.encoder.layer[i].attention.output.dense.fc,
                                                                         int_model.bert.encoder.layer[i].attention.output.dense.fc)
         # BertIntermediate
         int_model.bert.encoder.layer[i].intermediate.dense.fc = quantize(fp_model.bert.encoder.layer[i].intermediate.dense.fc,
-                                                                        int_model.bert.encoder.layer[i].intermeidate.dense.fc)
+                                                                        int_model.bert.encoder.layer[i].intermediate.dense.fc)
         # BertOutput
         int_model.bert.encoder.layer[i].output.dense.fc = quantize(fp_model.bert.encoder.layer[i].output.dense.fc,
                                                                    int_model.bert.encoder.layer[i].output.dense.fc)
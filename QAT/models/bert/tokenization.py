@@ -22,6 +22,7 @@ import collections
 import unicodedata
 import os
 import logging
+from multiprocessing import Pool
 
 from .file_utils import cached_path
 
@@ -79,6 +80,10 @@ class BertTokenizer(object):
             [(ids, tok) for tok, ids in self.vocab.items()])
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+        self.wordpiece_trie = WordpieceTrie(vocab=self.vocab)
+        # Characters' outputs of cleaning and CJK spacing, and (wordpieces, ids) of whitespace-split words
+        self.char_cache = {}
+        self.word_cache = {}
 
     def tokenize(self, text):
         split_tokens = []
@@ -87,6 +92,59 @@ class BertTokenizer(object):
                 split_tokens.append(sub_token)
         return split_tokens
 
+    def _clean_char(self, char):
+        cp = ord(char)
+        if cp == 0 or cp == 0xfffd or _is_control(char):
+            out = ""
+        elif _is_whitespace(char):
+            out = " "
+        elif self.basic_tokenizer._is_chinese_char(cp):
+            out = " " + char + " "
+        else:
+            out = char
+        self.char_cache[char] = out
+        return out
+
+    def _tokenize_word(self, word):
+        """(wordpieces, ids) of a whitespace-split word, as tokenize gives for it"""
+        tokens = []
+        if self.basic_tokenizer.do_lower_case:
+            word = self.basic_tokenizer._run_strip_accents(word.lower())
+        for token in whitespace_tokenize(" ".join(self.basic_tokenizer._run_split_on_punc(word))):
+            tokens.extend(self.wordpiece_trie.tokenize_word(token))
+        return tokens, [self.vocab[token] for token in tokens]
+
+    def _tokenize_words(self, text):
+        char_cache, word_cache = self.char_cache, self.word_cache
+        text = "".join([char_cache.get(char) if char in char_cache else self._clean_char(char) for char in text])
+        words = []
+        for word in text.split():
+            if word not in word_cache:
+                word_cache[word] = self._tokenize_word(word)
+            words.append(word_cache[word])
+        return words
+
+    def tokenize_batch(self, texts, workers=0, chunk_size=1000):
+        """
+        Tokenizes many texts, with the same output as tokenize for each of them.
+        Texts are cleaned with a per-character cache, and their words are tokenized once per unique word,
+        with wordpieces matched on a prefix trie of the vocab.
+        With workers > 1, chunks of chunk_size texts are tokenized in a pool of processes.
+        """
+        return [[token for tokens, _ in words for token in tokens]
+                for words in self._map_words(texts, workers, chunk_size)]
+
+    def convert_batch_to_ids(self, texts, workers=0, chunk_size=1000):
+        """Token ids of many texts, the same as convert_tokens_to_ids(tokenize(text)) for each of them."""
+        return [[i for _, ids in words for i in ids] for words in self._map_words(texts, workers, chunk_size)]
+
+    def _map_words(self, texts, workers, chunk_size):
+        if workers <= 1 or len(texts) <= chunk_size:
+            return [self._tokenize_words(text) for text in texts]
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        with Pool(workers, initializer=_set_worker_tokenizer, initargs=(self,)) as pool:
+            return [words for chunk in pool.imap(_tokenize_chunk, chunks) for words in chunk]
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
         ids = []
@@ -307,6 +365,69 @@ class WordpieceTokenizer(object):
         return output_tokens
 
 
+class WordpieceTrie(object):
+    """WordPiece tokenization on prefix tries of the vocab, the same as WordpieceTokenizer's."""
+
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+        self.unk_token = unk_token
+        self.max_input_chars_per_word = max_input_chars_per_word
+        # Every token can start a word, and "##" tokens continue one.
+        # Nodes are dicts of the next characters, with the token ending at the node under None.
+        self.start_trie, self.subword_trie = {}, {}
+        for token in vocab:
+            self._insert(self.start_trie, token, token)
+            if token.startswith("##"):
+                self._insert(self.subword_trie, token[2:], token)
+
+    @staticmethod
+    def _insert(trie, piece, token):
+        if not piece:
+            return
+        node = trie
+        for char in piece:
+            node = node.setdefault(char, {})
+        node[None] = token
+
+    def tokenize_word(self, word):
+        """Greedy longest-match-first wordpieces of a single token, by walking the trie from each start."""
+        if len(word) > self.max_input_chars_per_word:
+            return [self.unk_token]
+
+        sub_tokens = []
+        start, trie = 0, self.start_trie
+        while start < len(word):
+            node, end, cur_substr = trie, start, None
+            for i in range(start, len(word)):
+                node = node.get(word[i])
+                if node is None:
+                    break
+                if None in node:
+                    end, cur_substr = i + 1, node[None]
+            if cur_substr is None:
+                return [self.unk_token]
+            sub_tokens.append(cur_substr)
+            start, trie = end, self.subword_trie
+        return sub_tokens
+
+    def tokenize(self, text):
+        output_tokens = []
+        for token in whitespace_tokenize(text):
+            output_tokens.extend(self.tokenize_word(token))
+        return output_tokens
+
+
+_worker_tokenizer = None
+
+
+def _set_worker_tokenizer(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_chunk(texts):
+    return [_worker_tokenizer._tokenize_words(text) for text in texts]
+
+
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically contorl characters but we treat them
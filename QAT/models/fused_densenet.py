@@ -39,11 +39,9 @@ class FusedDenseLayer(nn.Module):
     # allowing it to take either a List[Tensor] or single Tensor
     def forward(self, input, external_range):  # noqa: F811
         if isinstance(input, Tensor):
-            prev_features = [input]
+            x = input
         else:
-            prev_features = input
-
-        x = torch.cat(prev_features, 1)
+            x = torch.cat(input, 1)
         out = self.bn1(x)
         out = self.conv1(out)
         out = self.bn2(out)
@@ -99,6 +97,7 @@ class FusedDenseBlock(nn.ModuleDict):
         super(FusedDenseBlock, self).__init__()
         self.arg_dict = arg_dict
         self.num_layers = num_layers
+        self.memory_efficient = memory_efficient
         target_bit, bit_conv_act, bit_addcat, self.smooth, self.use_ste, self.num_clusters, self.runtime_helper \
             = itemgetter('bit', 'bit_conv_act', 'bit_addcat', 'smooth', 'ste', 'cluster', 'runtime_helper')(arg_dict)
         self.a_bit = torch.nn.Parameter(torch.tensor(bit_conv_act, dtype=torch.int8), requires_grad=False)
@@ -117,11 +116,14 @@ class FusedDenseBlock(nn.ModuleDict):
             self.add_module('denselayer%d' % (i + 1), layer)
 
     def forward(self, init_features):
-        features = [init_features]
-        for name, layer in self.items():
-            new_features = layer(features, self.act_range)
-            features.append(new_features)
-        out = torch.cat(features, 1)
+        if self.memory_efficient:
+            out = run_dense_layers(list(self.values()), init_features, self.act_range)
+        else:
+            features = [init_features]
+            for name, layer in self.items():
+                new_features = layer(features, self.act_range)
+                features.append(new_features)
+            out = torch.cat(features, 1)
 
         if not self.training:
             return out
@@ -156,6 +158,8 @@ class FusedDenseNet(nn.Module):
         target_bit, self.bit_conv_act, bit_addcat, bit_first, bit_classifier, self.smooth, self.num_clusters, self.runtime_helper \
             = itemgetter('bit', 'bit_conv_act', 'bit_addcat', 'bit_first', 'bit_classifier', 'smooth', 'cluster',
                          'runtime_helper')(arg_dict)
+        self.act_checkpoint = arg_dict.get('act_checkpoint', False)
+        memory_efficient = memory_efficient or arg_dict.get('memory_efficient', False)
         self.target_bit = torch.nn.Parameter(torch.tensor(target_bit, dtype=torch.int8), requires_grad=False)
         self.a_bit = torch.nn.Parameter(torch.tensor(bit_addcat, dtype=torch.int8), requires_grad=False)
         self.in_bit = torch.nn.Parameter(torch.tensor(bit_first, dtype=torch.int8), requires_grad=False)
@@ -208,13 +212,13 @@ class FusedDenseNet(nn.Module):
         out = self.features.first_conv(x)
         out = self.features.first_norm(out, self.features.denseblock1.act_range)
         out = self.features.maxpool(out)
-        out = self.features.denseblock1(out)
+        out = run_block(self.features.denseblock1, out, self.act_checkpoint)
         out = self.features.transition1(out, self.features.denseblock2.act_range)
-        out = self.features.denseblock2(out)
+        out = run_block(self.features.denseblock2, out, self.act_checkpoint)
         out = self.features.transition2(out, self.features.denseblock3.act_range)
-        out = self.features.denseblock3(out)
+        out = run_block(self.features.denseblock3, out, self.act_checkpoint)
         out = self.features.transition3(out, self.features.denseblock4.act_range)
-        out = self.features.denseblock4(out)
+        out = run_block(self.features.denseblock4, out, self.act_checkpoint)
         out = self.features.last_norm(out)
 
         out = F.adaptive_avg_pool2d(out, (1, 1))
@@ -25,7 +25,7 @@ class FusedSqueezeExcitation(nn.Module):
         self.q_max = 2 ** self.bit - 1
         self.act_range = nn.Parameter(torch.zeros(2), requires_grad=False)
 
-        self.apply_ema = False
+        self.apply_ema = nn.Parameter(torch.tensor(0, dtype=torch.bool), requires_grad=False)
 
         squeeze_channels = _make_divisible(input_channels // squeeze_factor, 8)
         # self.fc1 = FusedConv2d(input_channels, squeeze_channels, kernel_size=1, bias=True,
@@ -83,7 +83,7 @@ class InvertedResidual(nn.Module):
         self.q_max = 2 ** self.bit - 1
         self.act_range = nn.Parameter(torch.zeros(2), requires_grad=False)
 
-        self.apply_ema = False
+        self.apply_ema = nn.Parameter(torch.tensor(0, dtype=torch.bool), requires_grad=False)
 
         self.use_res_connect = cnf.stride == 1 and cnf.input_channels == cnf.out_channels
 
@@ -167,7 +167,7 @@ class FusedMobileNet(nn.Module):
         self.q_max = 2 ** self.bit - 1
         self.in_range = nn.Parameter(torch.zeros(2), requires_grad=False)
         self.dilation = dilation
-        self.apply_ema = False
+        self.apply_ema = nn.Parameter(torch.tensor(0, dtype=torch.bool), requires_grad=False)
 
         if not inverted_residual_setting:
             raise ValueError("The inverted_residual_setting should not be empty")
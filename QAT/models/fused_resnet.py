@@ -189,6 +189,7 @@ class FusedResNet(nn.Module):
         self.arg_dict = arg_dict
         target_bit, self.bit_conv_act, bit_addcat, bit_first, bit_classifier, self.smooth, self.num_clusters, self.runtime_helper \
             = itemgetter('bit', 'bit_conv_act', 'bit_addcat', 'bit_first', 'bit_classifier', 'smooth', 'cluster', 'runtime_helper')(arg_dict)
+        self.act_checkpoint = arg_dict.get('act_checkpoint', False)
         self.target_bit = torch.nn.Parameter(torch.tensor(target_bit, dtype=torch.int8), requires_grad=False)
         self.a_bit = torch.nn.Parameter(torch.tensor(bit_addcat, dtype=torch.int8), requires_grad=False)
         self.in_bit = torch.nn.Parameter(torch.tensor(bit_first, dtype=torch.int8), requires_grad=False)
@@ -260,10 +261,10 @@ class FusedResNet(nn.Module):
         x = self.bn1(x)
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        x = run_layer(self.layer1, x, self.act_checkpoint)
+        x = run_layer(self.layer2, x, self.act_checkpoint)
+        x = run_layer(self.layer3, x, self.act_checkpoint)
+        x = run_layer(self.layer4, x, self.act_checkpoint)
 
         x = self.avgpool(x)
         x = torch.flatten(x, 1)
@@ -294,6 +295,7 @@ class FusedResNet20(nn.Module):
         self.arg_dict = arg_dict
         target_bit, self.bit_conv_act, bit_addcat, bit_first, bit_classifier, self.smooth, self.num_clusters, self.runtime_helper \
             = itemgetter('bit', 'bit_conv_act', 'bit_addcat', 'bit_first', 'bit_classifier', 'smooth', 'cluster', 'runtime_helper')(arg_dict)
+        self.act_checkpoint = arg_dict.get('act_checkpoint', False)
         self.target_bit = torch.nn.Parameter(torch.tensor(target_bit, dtype=torch.int8), requires_grad=False)
         self.a_bit = torch.nn.Parameter(torch.tensor(bit_addcat, dtype=torch.int8), requires_grad=False)
         self.in_bit = torch.nn.Parameter(torch.tensor(bit_first, dtype=torch.int8), requires_grad=False)
@@ -344,9 +346,9 @@ class FusedResNet20(nn.Module):
 
         x = self.first_conv(x)
         x = self.bn1(x)
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
+        x = run_layer(self.layer1, x, self.act_checkpoint)
+        x = run_layer(self.layer2, x, self.act_checkpoint)
+        x = run_layer(self.layer3, x, self.act_checkpoint)
         x = self.avgpool(x)
         x = torch.flatten(x, 1)
         x = self.fc(x)
@@ -2,5 +2,6 @@ from .linear import *
 from .conv2d import *
 from .misc import *
 from .maxpool2d import *
+from .avgpool2d import *
 from .activation import *
 from .norm import *
@@ -8,6 +8,13 @@ from ..quantization_utils import *
 from ..quant_noise import _quant_noise
 
 
+def get_activation_module(activation):
+    # nn.GELU and nn.Tanh take no inplace argument
+    if activation in (nn.GELU, nn.Tanh):
+        return activation()
+    return activation(inplace=False)
+
+
 class PCQActivation(nn.Module):
     """
         Activation Layer(Hardswish, Hardsigmoid, gelu ..) with clusters
@@ -24,7 +31,7 @@ class PCQActivation(nn.Module):
 
         self.apply_ema = np.zeros(self.num_clusters, dtype=bool)
 
-        self._activation = activation(inplace=False)
+        self._activation = get_activation_module(activation)
 
     def forward(self, x):
         x = self._activation(x)
@@ -43,8 +50,8 @@ class PCQActivation(nn.Module):
             if self.apply_ema[c]:
                 self.act_range[c][0], self.act_range[c][1] = ema(x[done:done + n], self.act_range[c], self.smooth)
                 if self.runtime_helper.apply_fake_quantization:
-                    s, z = calc_qparams(self.act_range[c][0], self.act_range[c][1], self.q_max)
-                    out[done:done + n] = fake_quantize(x[done:done + n], s, z, self.q_max, use_ste=self.use_ste)
+                    s, z = calc_qparams(self.act_range[c][0], self.act_range[c][1], self.bit)
+                    out[done:done + n] = fake_quantize(x[done:done + n], s, z, self.bit, use_ste=self.use_ste)
             else:
                 self.act_range[c][0] = torch.min(x[done:done + n]).item()
                 self.act_range[c][1] = torch.max(x[done:done + n]).item()
@@ -57,7 +64,7 @@ class PCQActivation(nn.Module):
         self.s3 = nn.Parameter(torch.zeros(self.num_clusters, dtype=torch.float32), requires_grad=False)
         self.z3 = nn.Parameter(torch.zeros(self.num_clusters, dtype=torch.int32), requires_grad=False)
         for c in range(self.num_clusters):
-            self.s3[c], self.z3[c] = calc_qparams(self.act_range[c][0], self.act_range[c][1], self.q_max)
+            self.s3[c], self.z3[c] = calc_qparams(self.act_range[c][0], self.act_range[c][1], self.bit)
         return self.s3, self.z3
 
 
@@ -74,9 +81,9 @@ class QActivation(nn.Module):
         self.q_max = 2 ** self.bit - 1
         self.act_range = nn.Parameter(torch.zeros(2), requires_grad=False)
 
-        self.apply_ema = False
+        self.apply_ema = nn.Parameter(torch.tensor(0, dtype=torch.bool), requires_grad=False)
 
-        self._activation = activation(inplace=False)
+        self._activation = get_activation_module(activation)
 
     def forward(self, x):
         x = self._activation(x)
@@ -87,8 +94,8 @@ class QActivation(nn.Module):
         if self.apply_ema:
             self.act_range[0], self.act_range[1] = ema(x, self.act_range, self.smooth)
             if self.runtime_helper.apply_fake_quantization:
-                s, z = calc_qparams(self.act_range[0], self.act_range[1], self.q_max)
-                out = fake_quantize(x, s, z, self.q_max, use_ste=self.use_ste)
+                s, z = calc_qparams(self.act_range[0], self.act_range[1], self.bit)
+                out = fake_quantize(x, s, z, self.bit, use_ste=self.use_ste)
         else:
             self.act_range[0] = torch.min(x).item()
             self.act_range[1] = torch.max(x).item()
@@ -97,5 +104,6 @@ class QActivation(nn.Module):
 
     def set_qparams(self, s1, z1):
         self.s1, self.z1 = nn.Parameter(s1, requires_grad=False), nn.Parameter(z1, requires_grad=False)
-        self.s3, self.z3 = calc_qparams(self.act_range[0], self.act_range[1], self.q_max)
+        self.s3, self.z3 = calc_qparams(self.act_range[0], self.act_range[1], self.bit)
         return self.s3, self.z3
+
@@ -0,0 +1,119 @@
+from operator import itemgetter
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from ..quantization_utils import *
+
+
+def get_reciprocal(n):
+    """
+        Fixed-point reciprocal of a window size n, (M, k) with M = ceil(2^k / n).
+        With k = 31 + ceil(log2(n)), floor(a * M / 2^k) = floor(a / n) for every 0 <= a < 2^31,
+        and a * M fits in int64. Window sums of codes are within int32, so the division is exact.
+    """
+    k = 31 + (n - 1).bit_length()
+    return -(-(1 << k) // n), k
+
+
+class _QuantizedAvgPool(nn.Module):
+    """
+        Average pooling of integer codes.
+        Window sums are taken in integers, and divided by the window size with a fixed-point reciprocal multiplier.
+        Mean is rounded as
+            floor : toward -inf
+            trunc : toward 0
+            round : to the nearest, halves away from the zero-point of the input's cluster
+        Only round depends on the zero-point, so only round has the zero_point parameter.
+    """
+    def __init__(self, rounding='floor', arg_dict=None):
+        super(_QuantizedAvgPool, self).__init__()
+        assert rounding in ['floor', 'trunc', 'round'], "Not supported rounding"
+        self.num_clusters, self.runtime_helper = itemgetter('cluster', 'runtime_helper')(arg_dict)
+        self.rounding = rounding
+
+        self.zero_point = None
+        if rounding == 'round':
+            z_init = torch.zeros(self.num_clusters, dtype=torch.int32) if self.num_clusters > 1 \
+                else torch.tensor(0, dtype=torch.int32)
+            self.zero_point = nn.Parameter(z_init, requires_grad=False)
+        self.windows = {}
+
+    def get_windows(self, size):
+        raise NotImplementedError
+
+    def _get_window_params(self, x):
+        """
+            Start/end of windows in rows & cols (None for global pooling), window sizes and their reciprocals,
+            kept per input size
+        """
+        key = (x.size(2), x.size(3), x.device)
+        if key not in self.windows:
+            rows, cols = self.get_windows(x.size(2)), self.get_windows(x.size(3))
+            n = [[(r1 - r0) * (c1 - c0) for c0, c1 in cols] for r0, r1 in rows]
+            reciprocals = [[get_reciprocal(size) for size in row] for row in n]
+            as_tensor = lambda v: torch.tensor(v, dtype=torch.int64, device=x.device)
+            windows = None
+            if rows != [(0, x.size(2))] or cols != [(0, x.size(3))]:
+                windows = tuple(as_tensor([w[i] for w in ws]) for ws in (rows, cols) for i in (0, 1))
+            self.windows[key] = (windows, as_tensor(n), as_tensor([[m for m, _ in row] for row in reciprocals]),
+                                 as_tensor([[k for _, k in row] for row in reciprocals]))
+        return self.windows[key]
+
+    def _window_sums(self, x, windows):
+        # Sums are in int32 (in int64 for int64 inputs, which need no cast), then in int64 for the division
+        acc_type = torch.int64 if x.dtype == torch.int64 else torch.int32
+        if windows is None:
+            return x.sum(dim=(2, 3), keepdim=True, dtype=acc_type).long()
+        # Sums of any windows from an integral image
+        r0, r1, c0, c1 = windows
+        # (wrapping around in int32 if the image's total doesn't fit, the windows' sums are still exact)
+        integral = F.pad(x.cumsum(2, dtype=acc_type).cumsum(3), (1, 0, 1, 0))
+        top, bottom = integral.index_select(2, r0), integral.index_select(2, r1)
+        sums = bottom.index_select(3, c1) - bottom.index_select(3, c0) - top.index_select(3, c1) + top.index_select(3, c0)
+        return sums.long()
+
+    def forward(self, x):
+        windows, n, M0, k = self._get_window_params(x)
+        z = 0
+        if self.zero_point is not None:
+            if self.num_clusters > 1:
+                bc = self.runtime_helper.qat_batch_cluster
+                assert bc is not None, "Per-cluster zero-points need the batch's cluster"
+                z = torch.index_select(self.zero_point, 0, bc.reshape(-1)).long()[:, None, None, None]
+            else:
+                z = self.zero_point.long()
+
+        subsum = self._window_sums(x, windows) - n * z
+        magnitude = subsum.abs()
+        if self.rounding == 'floor':
+            magnitude = torch.where(subsum < 0, magnitude + n - 1, magnitude)
+        elif self.rounding == 'round':
+            magnitude = magnitude + n // 2
+        mean = (magnitude * M0) >> k
+        mean = torch.where(subsum < 0, - mean, mean)
+        return mean.add(z).type(x.dtype)
+
+
+class QuantizedAvgPool2d(_QuantizedAvgPool):
+    def __init__(self, kernel_size, stride=None, rounding='floor', arg_dict=None):
+        super(QuantizedAvgPool2d, self).__init__(rounding, arg_dict)
+        self.layer_type = 'QuantizedAvgPool2d'
+        self.kernel_size = kernel_size
+        self.stride = stride if stride is not None else kernel_size
+
+    def get_windows(self, size):
+        return [(start, start + self.kernel_size) for start in range(0, size - self.kernel_size + 1, self.stride)]
+
+
+class QuantizedAdaptiveAvgPool2d(_QuantizedAvgPool):
+    def __init__(self, output_size, rounding='floor', arg_dict=None):
+        super(QuantizedAdaptiveAvgPool2d, self).__init__(rounding, arg_dict)
+        self.layer_type = 'QuantizedAdaptiveAvgPool2d'
+        self.output_size = output_size[0] if isinstance(output_size, tuple) else output_size
+        if isinstance(output_size, tuple):
+            assert output_size[0] == output_size[1], "Only square outputs are supported"
+
+    def get_windows(self, size):
+        # Same windows as nn.AdaptiveAvgPool2d
+        return [(i * size // self.output_size, -(-(i + 1) * size // self.output_size)) for i in range(self.output_size)]
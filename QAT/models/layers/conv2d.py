@@ -42,11 +42,20 @@ class QuantizedConv2d(nn.Conv2d):
             self.M0 = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
             self.shift = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
 
+        # Activation following the conv, applied to its output codes as a lookup table per cluster
+        self.activation = activation
+        if activation is not None:
+            self.act_table = nn.Parameter(torch.zeros((self.num_clusters, 2 ** bit), dtype=torch.int32),
+                                          requires_grad=False)
+
     def forward(self, x):
         x, out = self._conv_impl(x)
         out = self._subsum(x, out)
         if self.multiplication:
             out = self._totalsum(out)
+            if self.activation is not None:
+                bc = self.runtime_helper.qat_batch_cluster if self.num_clusters > 1 else None
+                out = lookup_activation(out, self.act_table, self.a_bit, bc)
         return out
 
     def _conv_impl(self, x):
@@ -67,7 +76,7 @@ class QuantizedConv2d(nn.Conv2d):
                     padded = F.pad(x, to_pad, mode='constant', value=self.z1[bc].item())
 
         out = F.conv2d(padded, self.weight, None, self.stride, (0, 0), self.dilation, self.groups)
-        return padded.type(torch.cuda.IntTensor), out.type(torch.cuda.LongTensor)
+        return padded.int(), out.long()
 
     def _subsum(self, x, y):
         if self.num_clusters > 1:
@@ -98,7 +107,7 @@ class QuantizedConv2d(nn.Conv2d):
             stride = self.stride[0]
             output_col, output_row = sum_q1q2.shape[2], sum_q1q2.shape[3]
             if self.sum_a1 is None or self.sum_a1.shape[0] != input_batch:     #
-                self.sum_a1 = torch.zeros((input_batch, 1, output_col, output_row), dtype=torch.int32, device='cuda')
+                self.sum_a1 = torch.zeros((input_batch, 1, output_col, output_row), dtype=torch.int32, device=x.device)
             for o_col in range(output_col):
                 for o_row in range(output_row):
                     col_st, col_end = o_col * stride, o_col * stride + filter_col
@@ -154,7 +163,7 @@ class QuantizedConv2d(nn.Conv2d):
             stride = self.stride[0]
             output_col, output_row = sum_q1q2.shape[2], sum_q1q2.shape[3]
             if self.sum_a1 is None or self.sum_a1.shape[0] != input_batch:
-                self.sum_a1 = torch.zeros((input_batch, output_col, output_row), dtype=torch.int32, device='cuda')
+                self.sum_a1 = torch.zeros((input_batch, output_col, output_row), dtype=torch.int32, device=x.device)
             for o_col in range(output_col):
                 for o_row in range(output_row):
                     col_st, col_end = o_col * stride, o_col * stride + filter_col
@@ -268,7 +277,7 @@ class PCQConv2d(nn.Module):
     @torch.no_grad()
     def _update_activation_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1)
+        data = flatten_per_sample(x)
         _max = data.max(dim=1).values.mean()
         if self._activation:
             if self.apply_ema[cluster]:
@@ -37,18 +37,21 @@ class QuantizedLinear(nn.Linear):
         self.M0 = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
         self.shift = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
         self.is_shift_neg = nn.Parameter(torch.tensor(False, dtype=torch.bool), requires_grad=False)    #
-        self.hardswish_6 = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
-        self.hardswish_3 = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
-        self.s_activation = nn.Parameter(torch.tensor(t_init, dtype=torch.float32), requires_grad=False)
-        self.z_activation = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
 
+        # Activation following the layer, applied to its output codes as a lookup table per cluster
         self.activation = activation
+        if activation is not None:
+            self.act_table = nn.Parameter(torch.zeros((self.num_clusters, 2 ** bit), dtype=torch.int32),
+                                          requires_grad=False)
 
     def forward(self, x):
         out = F.linear(x, self.weight, None)
-        out = self._subsum(x, out.type(torch.cuda.LongTensor))
+        out = self._subsum(x, out.long())
         if self.multiplication:
             out = self._totalsum(out)
+            if self.activation is not None:
+                bc = self.runtime_helper.qat_batch_cluster if self.num_clusters > 1 else None
+                out = lookup_activation(out, self.act_table, self.a_bit, bc)
         return out
 
     def _subsum(self, x, y):
@@ -25,60 +25,31 @@ class QuantizedAdd(nn.Module):
         self.s3 = nn.Parameter(torch.tensor(t_init, dtype=torch.float32), requires_grad=False)
         self.z3 = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
 
+        # Requantization parameters packed per cluster by set_pack, rebuilt from the above when empty
+        self.register_buffer('pack', torch.zeros((0, 11), dtype=torch.int64), persistent=False)
+
+    def set_pack(self):
+        """ (z_bypass, requantization of bypass, z_prev, requantization of prev, z3) per cluster, as int64 """
+        z_bypass, z_prev, z3 = [z.reshape(-1, 1).long() for z in (self.z_bypass, self.z_prev, self.z3)]
+        self.pack = torch.cat([z_bypass, get_requantization_pack(self.M0_bypass, self.shift_bypass),
+                               z_prev, get_requantization_pack(self.M0_prev, self.shift_prev), z3], dim=1)
+        return self
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super(QuantizedAdd, self)._load_from_state_dict(*args, **kwargs)
+        self.pack = self.pack.new_zeros((0, 11))
+
     def forward(self, bypass, prev):
+        if not self.pack.numel():
+            self.set_pack()
+        pack = self.pack
         if self.num_clusters > 1:
-            out = self._pcq_add(bypass, prev)
-        else:
-            out = self._general_add(bypass, prev)
-        return clamp_matrix(out, self.a_bit)
+            pack = torch.index_select(pack, 0, self.runtime_helper.qat_batch_cluster.reshape(-1))
+        pack = pack.view(pack.size(0), -1, *([1] * (bypass.dim() - 1))).unbind(1)
 
-    def _pcq_add(self, bypass, prev):
-        bc = self.runtime_helper.qat_batch_cluster
-        z_bypass = torch.index_select(self.z_bypass, 0, bc)[:, None, None, None]
-        z_prev = torch.index_select(self.z_prev, 0, bc)[:, None, None, None]
-        z3 = torch.index_select(self.z3, 0, bc)[:, None, None, None]
-        M0_bypass = torch.index_select(self.M0_bypass, 0, bc)[:, None, None, None]
-        M0_prev = torch.index_select(self.M0_prev, 0, bc)[:, None, None, None]
-        shift_bypass = torch.index_select(self.shift_bypass, 0, bc)[:, None, None, None]
-        shift_prev = torch.index_select(self.shift_prev, 0, bc)[:, None, None, None]
-        shape = bypass.shape
-        mask = self.runtime_helper.mask_4d[:shape[0]]
-
-        bypass = bypass - z_bypass
-        prev = prev - z_prev
-        zero = self.runtime_helper.izero
-
-        if not self.is_bypass_shift_neg:
-            x1 = mul_and_shift(bypass, M0_bypass, shift_bypass, mask)
-        else:
-            neg_shift = torch.where(shift_bypass < zero, - shift_bypass, zero)
-            shift = torch.where(shift_bypass >= zero, shift_bypass, zero)
-            bypass = bypass << neg_shift
-            x1 = mul_and_shift(bypass, M0_bypass, shift, mask)
-
-        if not self.is_prev_shift_neg:
-            x2 = mul_and_shift(prev, M0_prev, shift_prev, mask)
-        else:
-            neg_shift = torch.where(shift_prev < zero, - shift_prev, zero)
-            shift = torch.where(shift_prev >= zero, shift_prev, zero)
-            prev = prev << neg_shift
-            x2 = mul_and_shift(prev, M0_prev, shift, mask)
-        return (x1 + x2).add(z3)
-
-    def _general_add(self, bypass, prev):
-        bypass = bypass - self.z_bypass
-        prev = prev - self.z_prev
-
-        if self.shift_bypass < 0:
-            x1 = mul_and_shift(bypass << -self.shift_bypass.item(), self.M0_bypass, 0)
-        else:
-            x1 = mul_and_shift(bypass, self.M0_bypass, self.shift_bypass.item())
-
-        if self.shift_prev < 0:
-            x2 = mul_and_shift(prev << -self.shift_prev.item(), self.M0_prev, 0)
-        else:
-            x2 = mul_and_shift(prev, self.M0_prev, self.shift_prev.item())
-        return (x1 + x2).add(self.z3)
+        out = requantize(bypass - pack[0], *pack[1:5])
+        out = out.add_(requantize(prev - pack[5], *pack[6:10])).add_(pack[10])
+        return clamp_matrix(out, self.a_bit)
 
 
 class QuantizedMul(nn.Module):
@@ -97,37 +68,27 @@ class QuantizedMul(nn.Module):
         self.M0 = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
         self.shift = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
 
+        self.register_buffer('pack', torch.zeros((0, 7), dtype=torch.int64), persistent=False)
+
+    def set_pack(self):
+        """ (z_prev, z_bypass, requantization of the product, z3) per cluster, as int64 """
+        z_prev, z_bypass, z3 = [z.reshape(-1, 1).long() for z in (self.z_prev, self.z_bypass, self.z3)]
+        self.pack = torch.cat([z_prev, z_bypass, get_requantization_pack(self.M0, self.shift), z3], dim=1)
+        return self
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super(QuantizedMul, self)._load_from_state_dict(*args, **kwargs)
+        self.pack = self.pack.new_zeros((0, 7))
+
     def forward(self, prev, bypass):
-        if self.runtime_helper.qat_batch_cluster is not None:
-            return self.pcq_mul(bypass, prev)
-        else:
-            return self.general_mul(prev, bypass)
-
-    def general_mul(self, prev, bypass):
-        mul_q1q2 = torch.mul(prev, bypass)
-        z1z2 = self.z_bypass * self.z_prev
-        z2q1 = torch.mul(prev, self.z_bypass)
-        z1q2 = torch.mul(bypass, self.z_prev)
-        mul_q1q2 = torch.sub(mul_q1q2, z2q1)
-        mul_q1q2 = torch.sub(mul_q1q2, z1q2)
-        mul_q1q2 = mul_q1q2.add(z1z2)
-
-        if self.shift < 0:
-            multiplied = multiply_M((mul_q1q2.type(torch.cuda.LongTensor) << - self.shift.item()), self.M0)
-            total = shifting(multiplied, 0)
-        else:
-            multiplied = multiply_M(mul_q1q2.type(torch.cuda.LongTensor), self.M0)
-            total = shifting(multiplied, self.shift.item())
-
-        total = total.add(self.z3)
-
-        if self.a_bit == 4:
-            total = torch.clamp(total, 0, 15)
-        elif self.a_bit == 8:
-            total = torch.clamp(total, -128, 127)
-        elif self.a_bit == 16:
-            total = torch.clamp(total, -32768, 32767)
-        elif self.a_bit == 32:
-            total = torch.clamp(total, -2147483648, 2147483647)
-        return total
+        if not self.pack.numel():
+            self.set_pack()
+        pack = self.pack
+        if self.num_clusters > 1:
+            pack = torch.index_select(pack, 0, self.runtime_helper.qat_batch_cluster.reshape(-1))
+        pack = pack.view(pack.size(0), -1, *([1] * (prev.dim() - 1))).unbind(1)
+
+        # (q1 - z1)(q2 - z2) = q1q2 - q1z2 - q2z1 + z1z2
+        out = requantize((prev - pack[0]).mul_(bypass - pack[1]), *pack[2:6]).add_(pack[6])
+        return clamp_matrix(out, self.a_bit)
 
@@ -153,7 +153,7 @@ class PCQBnReLU(nn.Module):
     @torch.no_grad()
     def _update_activation_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1)
+        data = flatten_per_sample(x)
         _max = data.max(dim=1).values.mean()
 
         if self.activation:
@@ -185,8 +185,9 @@ class PCQBnReLU(nn.Module):
         zero = self.runtime_helper.fzero
         self.s1, self.z1 = s1, z1
 
-        _weights = torch.zeros((self.num_clusters, self.num_features), device='cuda')
-        _vars = torch.ones((self.num_clusters, self.num_features), device='cuda')
+        device = self.norms[0].weight.device
+        _weights = torch.zeros((self.num_clusters, self.num_features), device=device)
+        _vars = torch.ones((self.num_clusters, self.num_features), device=device)
         for c in range(self.num_clusters):
             _weights[c] = self.norms[c].weight
             _vars[c] = self.norms[c].running_var
@@ -65,7 +65,7 @@ class PCQAlexNet(nn.Module):
     @torch.no_grad()
     def _update_input_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1).clone().detach()
+        data = flatten_per_sample(x).clone().detach()
         _min = data.min(dim=1).values.mean()
         _max = data.max(dim=1).values.mean()
         if self.apply_ema[cluster]:
@@ -141,7 +141,7 @@ class PCQAlexNetSmall(nn.Module):
     @torch.no_grad()
     def _update_input_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.clone().detach().view(x.size(0), -1)
+        data = flatten_per_sample(x.clone().detach())
         _min = data.min(dim=1).values.mean()
         _max = data.max(dim=1).values.mean()
         if self.apply_ema[cluster]:
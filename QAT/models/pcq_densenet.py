@@ -42,11 +42,9 @@ class PCQDenseLayer(nn.Module):
     # allowing it to take either a List[Tensor] or single Tensor
     def forward(self, input, external_range):  # noqa: F811
         if isinstance(input, Tensor):
-            prev_features = [input]
+            x = input
         else:
-            prev_features = input
-
-        x = torch.cat(prev_features, 1)
+            x = torch.cat(input, 1)
         out = self.bn1(x)
         out = self.conv1(out)
         out = self.bn2(out)
@@ -103,6 +101,7 @@ class PCQDenseBlock(nn.ModuleDict):
         super(PCQDenseBlock, self).__init__()
         self.arg_dict = arg_dict
         self.num_layers = num_layers
+        self.memory_efficient = memory_efficient
         arg_bit, self.smooth, self.num_clusters, self.runtime_helper, self.use_ste, self.quant_noise, self.qn_prob \
             = itemgetter('bit', 'smooth', 'cluster', 'runtime_helper', 'ste', 'quant_noise', 'qn_prob')(arg_dict)
         self.a_bit = torch.nn.Parameter(torch.tensor(0, dtype=torch.int8), requires_grad=False)
@@ -124,11 +123,14 @@ class PCQDenseBlock(nn.ModuleDict):
             self.add_module('denselayer%d' % (i + 1), layer)
 
     def forward(self, init_features: Tensor) -> Tensor:
-        features = [init_features]
-        for name, layer in self.items():
-            new_features = layer(features, self.act_range)
-            features.append(new_features)
-        out = torch.cat(features, 1)
+        if self.memory_efficient:
+            out = run_dense_layers(list(self.values()), init_features, self.act_range)
+        else:
+            features = [init_features]
+            for name, layer in self.items():
+                new_features = layer(features, self.act_range)
+                features.append(new_features)
+            out = torch.cat(features, 1)
 
         if self.training:
             self._update_activation_ranges(out)
@@ -137,7 +139,7 @@ class PCQDenseBlock(nn.ModuleDict):
     @torch.no_grad()
     def _update_activation_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1)
+        data = flatten_per_sample(x)
         _min = data.min(dim=1).values.mean()
         _max = data.max(dim=1).values.mean()
         if self.apply_ema[cluster]:
@@ -170,6 +172,8 @@ class PCQDenseNet(nn.Module):
         target_bit, self.bit_conv_act, bit_addcat, bit_first, bit_classifier, self.smooth, self.num_clusters, self.runtime_helper \
             = itemgetter('bit', 'bit_conv_act', 'bit_addcat', 'bit_first', 'bit_classifier', 'smooth', 'cluster',
                          'runtime_helper')(arg_dict)
+        self.act_checkpoint = arg_dict.get('act_checkpoint', False)
+        memory_efficient = memory_efficient or arg_dict.get('memory_efficient', False)
         self.target_bit = torch.nn.Parameter(torch.tensor(target_bit, dtype=torch.int8), requires_grad=False)
         self.a_bit = torch.nn.Parameter(torch.tensor(bit_addcat, dtype=torch.int8), requires_grad=False)
         self.in_bit = torch.nn.Parameter(torch.tensor(bit_first, dtype=torch.int8), requires_grad=False)
@@ -217,13 +221,13 @@ class PCQDenseNet(nn.Module):
         out = self.features.first_conv(x)
         out = self.features.first_norm(out, self.features.denseblock1.act_range)
         out = self.features.maxpool(out)
-        out = self.features.denseblock1(out)
+        out = run_block(self.features.denseblock1, out, self.act_checkpoint)
         out = self.features.transition1(out, self.features.denseblock2.act_range)
-        out = self.features.denseblock2(out)
+        out = run_block(self.features.denseblock2, out, self.act_checkpoint)
         out = self.features.transition2(out, self.features.denseblock3.act_range)
-        out = self.features.denseblock3(out)
+        out = run_block(self.features.denseblock3, out, self.act_checkpoint)
         out = self.features.transition3(out, self.features.denseblock4.act_range)
-        out = self.features.denseblock4(out)
+        out = run_block(self.features.denseblock4, out, self.act_checkpoint)
         out = self.features.last_norm(out)
 
         out = F.adaptive_avg_pool2d(out, (1, 1))
@@ -234,7 +238,7 @@ class PCQDenseNet(nn.Module):
     @torch.no_grad()
     def _update_input_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1)
+        data = flatten_per_sample(x)
         _min = data.min(dim=1).values.mean()
         _max = data.max(dim=1).values.mean()
         if self.apply_ema[cluster]:
@@ -246,11 +250,11 @@ class PCQDenseNet(nn.Module):
 
     def _fake_quantize_input(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        s, z = calc_qparams(self.in_range[cluster][0], self.in_range[cluster][1], self.bit)
-        return fake_quantize(x, s, z, self.bit)
+        s, z = calc_qparams(self.in_range[cluster][0], self.in_range[cluster][1], self.in_bit)
+        return fake_quantize(x, s, z, self.in_bit)
 
     def set_quantization_params(self):
-        self.scale, self.zero_point = calc_qparams_per_cluster(self.in_range, self.bit)
+        self.scale, self.zero_point = calc_qparams_per_cluster(self.in_range, self.in_bit)
         conv_s, conv_z = self.features.first_conv.set_qparams(self.scale, self.zero_point)
         block1_s, block1_z = self.features.denseblock1.set_block_qparams()
         block2_s, block2_z = self.features.denseblock2.set_block_qparams()
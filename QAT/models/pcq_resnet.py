@@ -72,7 +72,7 @@ class PCQBasicBlock(nn.Module):
     @torch.no_grad()
     def _update_activation_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1)
+        data = flatten_per_sample(x)
         _max = data.max(dim=1).values.mean()
         if self.apply_ema[cluster]:
             self.act_range[cluster][1] = self.act_range[cluster][1] * self.smooth + _max * (1 - self.smooth)
@@ -169,7 +169,7 @@ class PCQBottleneck(nn.Module):
     @torch.no_grad()
     def _update_activation_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1)
+        data = flatten_per_sample(x)
         _max = data.max(dim=1).values.mean()
         if self.apply_ema[cluster]:
             self.act_range[cluster][1] = self.act_range[cluster][1] * self.smooth + _max * (1 - self.smooth)
@@ -214,6 +214,7 @@ class PCQResNet(nn.Module):
         self.arg_dict = arg_dict
         target_bit, self.bit_conv_act, bit_addcat, bit_first, bit_classifier, self.smooth, self.num_clusters, self.runtime_helper \
             = itemgetter('bit', 'bit_conv_act', 'bit_addcat', 'bit_first', 'bit_classifier', 'smooth', 'cluster', 'runtime_helper')(arg_dict)
+        self.act_checkpoint = arg_dict.get('act_checkpoint', False)
         self.target_bit = torch.nn.Parameter(torch.tensor(target_bit, dtype=torch.int8), requires_grad=False)
         self.a_bit = torch.nn.Parameter(torch.tensor(bit_addcat, dtype=torch.int8), requires_grad=False)
         self.in_bit = torch.nn.Parameter(torch.tensor(bit_first, dtype=torch.int8), requires_grad=False)
@@ -275,10 +276,10 @@ class PCQResNet(nn.Module):
         x = self.bn1(x)
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        x = run_layer(self.layer1, x, self.act_checkpoint)
+        x = run_layer(self.layer2, x, self.act_checkpoint)
+        x = run_layer(self.layer3, x, self.act_checkpoint)
+        x = run_layer(self.layer4, x, self.act_checkpoint)
 
         x = self.avgpool(x)
         x = torch.flatten(x, 1)
@@ -288,7 +289,7 @@ class PCQResNet(nn.Module):
     @torch.no_grad()
     def _update_input_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1)
+        data = flatten_per_sample(x)
         _min = data.min(dim=1).values.mean()
         _max = data.max(dim=1).values.mean()
         if self.apply_ema[cluster]:
@@ -331,6 +332,7 @@ class PCQResNet20(nn.Module):
         self.arg_dict = arg_dict
         target_bit, self.bit_conv_act, bit_addcat, bit_first, bit_classifier, self.smooth, self.num_clusters, self.runtime_helper \
             = itemgetter('bit', 'bit_conv_act', 'bit_addcat', 'bit_first', 'bit_classifier', 'smooth', 'cluster', 'runtime_helper')(arg_dict)
+        self.act_checkpoint = arg_dict.get('act_checkpoint', False)
         self.target_bit = torch.nn.Parameter(torch.tensor(target_bit, dtype=torch.int8), requires_grad=False)
         self.a_bit = torch.nn.Parameter(torch.tensor(bit_addcat, dtype=torch.int8), requires_grad=False)
         self.in_bit = torch.nn.Parameter(torch.tensor(bit_first, dtype=torch.int8), requires_grad=False)
@@ -373,9 +375,9 @@ class PCQResNet20(nn.Module):
 
         x = self.first_conv(x)
         x = self.bn1(x)
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
+        x = run_layer(self.layer1, x, self.act_checkpoint)
+        x = run_layer(self.layer2, x, self.act_checkpoint)
+        x = run_layer(self.layer3, x, self.act_checkpoint)
         x = self.avgpool(x)
         x = torch.flatten(x, 1)
         x = self.fc(x)
@@ -384,7 +386,7 @@ class PCQResNet20(nn.Module):
     @torch.no_grad()
     def _update_input_ranges(self, x):
         cluster = self.runtime_helper.qat_batch_cluster
-        data = x.view(x.size(0), -1)
+        data = flatten_per_sample(x)
         _min = data.min(dim=1).values.mean()
         _max = data.max(dim=1).values.mean()
         if self.apply_ema[cluster]:
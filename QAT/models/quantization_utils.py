@@ -1,8 +1,10 @@
 import os
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import numpy as np
 from copy import deepcopy
+from itertools import chain
 
 
 class STE(torch.autograd.Function):
@@ -44,16 +46,16 @@ def get_scale_and_zeropoint(_min, _max, bit):
         return s, torch.clamp(z, -32768, 32767)
     elif bit == 24:
         s = _max.sub(_min).div(16777215)
-        return s, torch.zeros(s.shape, device='cuda')
+        return s, torch.zeros(s.shape, device=s.device)
     s = (_max - _min) / 4294967295
-    return s, torch.tensor(0, device='cuda')
+    return s, torch.tensor(0, device=s.device)
 
 
 def calc_qparams(range_min, range_max, bit, symmetric=False, zero=None):
     if symmetric:
         return calc_symmetric_qparams(range_min, range_max, bit)
     if zero is None:
-        zero = torch.tensor(0.0, device='cuda')
+        zero = torch.tensor(0.0, device=range_min.device)
     _min = zero if range_min > 0.0 else range_min
     _max = zero if range_max < 0.0 else range_max
     return get_scale_and_zeropoint(_min, _max, bit)
@@ -71,18 +73,28 @@ def calc_symmetric_qparams(_min, _max, bit, per_channel=False):
             s = _max.sub(_min).div(16777215)
         else:
             s = (_max - _min) / 4294967295
-    return s, torch.zeros_like(s, device='cuda')    #
+    return s, torch.zeros_like(s)
+
+
+def flatten_per_sample(x):
+    """
+        (N, -1) view of x without a copy, in x's memory order (NCHW or channels_last).
+        Only for order-free reductions like min/max per sample or per output channel.
+    """
+    if x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last):
+        x = x.permute(0, 2, 3, 1)
+    return x.reshape(x.size(0), -1)
 
 
 def calc_qparams_per_output_channel(mat, bit, symmetric=False, zero=None):
-    _mat = mat.view(mat.size(0), -1)
+    _mat = flatten_per_sample(mat)
     _min = _mat.min(dim=1).values
     _max = _mat.max(dim=1).values
     if symmetric:
         return calc_symmetric_qparams(_min, _max, bit, True)
     else:
         if zero is None:
-            zero = torch.tensor(0.0, device='cuda')
+            zero = torch.tensor(0.0, device=mat.device)
         _min = torch.where(_min <= zero, _min, zero)
         _max = torch.where(_max >= zero, _max, zero)
     return get_scale_and_zeropoint(_min, _max, bit)
@@ -90,7 +102,7 @@ def calc_qparams_per_output_channel(mat, bit, symmetric=False, zero=None):
 
 def calc_qparams_per_cluster(ranges, bit, zero=None):
     if zero is None:
-        zero = torch.tensor(0.0, device='cuda')
+        zero = torch.tensor(0.0, device=ranges.device)
     _min = torch.where(ranges[:, 0] <= 0, ranges[:, 0], zero)
     _max = torch.where(ranges[:, 1] >= 0, ranges[:, 1], zero)
     return get_scale_and_zeropoint(_min, _max, bit)
@@ -258,14 +270,14 @@ def quantize_M(M):
         M /= 2
         shift -= 1
 
-    q_M = torch.round(M.clone().detach() * (1 << 31)).cuda()
+    q_M = torch.round(M.clone().detach() * (1 << 31))
     assert (q_M <= (1 << 31))
     if q_M == (1 << 31):
         q_M /= 2
         shift -= 1
 
-    q_M = q_M.type(torch.cuda.IntTensor)
-    shift = torch.tensor(shift, dtype=torch.int32).cuda()
+    q_M = q_M.int()
+    shift = torch.tensor(shift, dtype=torch.int32, device=q_M.device)
     max_int = 2147483647
     assert q_M <= max_int
     return q_M, shift
@@ -278,8 +290,8 @@ def multiply_M(x, q_M):
     overflow = torch.logical_and(overflow_max, overflow_min)
 
     subsummultiplier = x.mul(q_M)
-    nudge = torch.where(subsummultiplier >= 0, (1 << 30), (1 - (1 << 30))).type(torch.cuda.IntTensor)
-    subsummultiplier_high = ((subsummultiplier + nudge) / (1 << 31)).type(torch.cuda.LongTensor)
+    nudge = torch.where(subsummultiplier >= 0, (1 << 30), (1 - (1 << 30))).int()
+    subsummultiplier_high = ((subsummultiplier + nudge) / (1 << 31)).long()
     return torch.where(overflow, max_int, subsummultiplier_high)
 
 
@@ -287,9 +299,9 @@ def shifting_without_cast(cur, shift, mask=1):
     _mask = (mask << shift) - 1
     zero, one = 0, 1
 
-    remainder = (cur & _mask).type(torch.cuda.IntTensor)
+    remainder = (cur & _mask).int()
     maskiflessthan = torch.where(cur < zero, ~zero, zero)
-    threshold = ((_mask >> one) + (maskiflessthan & one)).type(torch.cuda.IntTensor)
+    threshold = ((_mask >> one) + (maskiflessthan & one)).int()
     maskifgreaterthan = torch.where(remainder > threshold, ~zero, zero)
     return (cur >> shift).add(maskifgreaterthan & one)
 
@@ -298,36 +310,143 @@ def shifting(cur, shift, mask=1):
     _mask = (mask << shift) - 1
     zero, one = 0, 1
 
-    remainder = (cur & _mask).type(torch.cuda.IntTensor)
+    remainder = (cur & _mask).int()
     maskiflessthan = torch.where(cur < zero, ~zero, zero)
-    threshold = ((_mask >> one) + (maskiflessthan & one)).type(torch.cuda.IntTensor)
+    threshold = ((_mask >> one) + (maskiflessthan & one)).int()
     maskifgreaterthan = torch.where(remainder > threshold, ~zero, zero)
-    total = ((cur >> shift).add(maskifgreaterthan & one)).type(torch.cuda.IntTensor)
+    total = ((cur >> shift).add(maskifgreaterthan & one)).int()
     return total
 
 
-def clamp_matrix(x, bit=None, symmetric=False):
+def get_code_range(bit=None, symmetric=False):
     if bit == 4:
         if symmetric:
-            qmin, qmax = -8, 7
-        else:
-            qmin, qmax = 0, 15
+            return -8, 7
+        return 0, 15
     elif bit == 8:
-        qmin, qmax = -128, 127
+        return -128, 127
     elif bit == 16:
-        qmin, qmax = -32768, 32767
+        return -32768, 32767
     elif bit == 24:
-        qmin, qmax = -8388608, 8388607
-    else:
-        qmin, qmax = -2147483648, 2147483647
+        return -8388608, 8388607
+    return -2147483648, 2147483647
+
+
+def clamp_matrix(x, bit=None, symmetric=False):
+    qmin, qmax = get_code_range(bit, symmetric)
     return torch.clamp(x, qmin, qmax)
 
 
+@torch.no_grad()
+def make_activation_table(activation, s1, z1, s3, z3, bit):
+    """
+        Output codes (s3, z3) of activation for every input code (s1, z1) of the bit-width, one row per cluster.
+        Integer layers apply the activation as a gather from the table.
+    """
+    qmin, qmax = get_code_range(bit)
+    codes = torch.arange(qmin, qmax + 1, dtype=torch.float64, device=s1.device)
+    s1, z1, s3, z3 = [t.reshape(-1, 1).type(torch.float64) for t in (s1, z1, s3, z3)]
+    out = activation((codes - z1) * s1)
+    return torch.clamp(torch.round(out / s3 + z3), qmin, qmax).type(torch.int32)
+
+
+def set_activation_table(_fp, _int):
+    """
+        _fp  : (PCQ/Q)Activation with its qparams set
+        _int : integer layer producing _fp's input, built with activation
+    """
+    _int.act_table.data.copy_(make_activation_table(_fp._activation, _fp.s1, _fp.z1, _fp.s3, _fp.z3, _int.a_bit))
+    return _int
+
+
+def lookup_activation(x, table, bit, batch_cluster=None):
+    """ Gathers each code of x from its cluster's row of the table made by make_activation_table """
+    idx = (x - get_code_range(bit)[0]).long()
+    if batch_cluster is None:
+        return table[0][idx].type(x.dtype)
+    rows = torch.index_select(table, 0, batch_cluster.reshape(-1))
+    if rows.size(0) == 1:
+        return rows[0][idx].type(x.dtype)
+    offset = (batch_cluster * table.size(1)).view(-1, *([1] * (x.dim() - 1)))
+    return table.view(-1)[idx + offset].type(x.dtype)
+
+
+@torch.no_grad()
+def get_softmax_constants(s, target_scale=2 ** -10):
+    """
+        Integer constants of integer_softmax for inputs of scale s (one per cluster), as in I-BERT's i-exp.
+        exp(x) = 2^-n * exp(p) with x = p - n * ln2, p in (-ln2, 0], and exp(p) ~ 0.3585 * (p + 1.353)^2 + 0.344.
+        Inputs are shifted by up bits (right if negative) to a scale s' in (target_scale / 2, target_scale],
+        which bounds every constant and intermediate below.
+            up      : left shift of the inputs
+            ln2     : floor(ln2 / s')
+            ln2_inv : ceil(2^32 / ln2), to get n = floor(-x / ln2) by a multiplication
+            b       : floor(1.353 / s')
+            c       : floor(0.344 / (0.3585 * s'^2))
+    """
+    s = s.type(torch.float64)
+    up = torch.ceil(torch.log2(s / target_scale))
+    s = s / 2 ** up
+    ln2 = torch.floor(np.log(2) / s)
+    ln2_inv = torch.ceil(2 ** 32 / ln2)
+    b = torch.floor(1.353 / s)
+    c = torch.floor(0.344 / (0.3585 * s ** 2))
+    return [t.type(torch.int64) for t in (up, ln2, ln2_inv, b, c)]
+
+
+def integer_softmax(x, up, ln2, ln2_inv, b, c, bit, mask=None):
+    """
+        Softmax of integer scores x along the last dim, with constants of get_softmax_constants
+        (broadcastable to x, e.g. per cluster of the batch).
+        Output probabilities are unsigned codes in [0, 2^bit - 1] with scale 2^-bit and zero-point 0.
+        mask : bool, broadcastable to x, False where keys are masked out
+    """
+    x = (x.long() << torch.clamp(up, min=0)) >> torch.clamp(-up, min=0)
+    if mask is not None:
+        x.add_((~mask).long() * -(1 << 61))
+    # exp(x - max) is 0 from x - max <= -62 * ln2 on, where masked keys end up
+    x = torch.maximum(x.sub_(x.amax(dim=-1, keepdim=True)), -62 * ln2)
+
+    # n = floor(-x / ln2), exact as -x * ln2 < 2^32
+    n = x.mul(-ln2_inv).__irshift__(32)
+    p = x.add_(n * ln2).add_(b)
+    exp = p.mul_(p).add_(c).__irshift__(n)
+
+    # Normalized with a reciprocal per row, 1 below floor(exp * 2^bit / total) at most
+    bit = int(bit)
+    reciprocal = torch.div((1 << 62) - 1, exp.sum(dim=-1, keepdim=True).clamp(min=1), rounding_mode='floor')
+    return exp.mul_(reciprocal).__irshift__(62 - bit)
+
+
 def mul_and_shift(x, M0, shift, mask=1):
     multiplied = multiply_M(x, M0)
     return shifting_without_cast(multiplied, shift, mask)
 
 
+@torch.no_grad()
+def get_requantization_pack(M0, shift):
+    """
+        Per-cluster int64 columns (M0, shift, half, is_shift) of requantize for mul_and_shift by M0 and shift.
+        Negative shifts are folded into the multiplier, as (x << n) * M0 = x * (M0 << n), so shifts are never negative,
+        and half/is_shift are the rounding offsets shifting_without_cast uses.
+    """
+    M0, shift = M0.reshape(-1).long(), shift.reshape(-1).long()
+    M0 = M0 << torch.clamp(-shift, min=0)
+    shift = torch.clamp(shift, min=0)
+    return torch.stack([M0, shift, (1 << shift) >> 1, (shift > 0).long()], dim=1)
+
+
+def requantize(x, M0, shift, half, is_shift):
+    """
+        mul_and_shift of a pack by get_requantization_pack, without host syncs, bit-exact with it
+        (including multiply_M's rounding through a float division).
+    """
+    x = x * M0
+    x = x.add_(torch.where(x >= 0, 1 << 30, 1 - (1 << 30))).div(1 << 31).long()
+    # Rounds half away from zero, as shifting_without_cast
+    return x.add(half).sub_((x < 0) * is_shift).__irshift__(shift)
+
+
 def add_pos_and_neg_shift(x, M0, shift, mask, out):
     neg = (shift < 0).nonzero(as_tuple=True)[0]
     pos = (shift >= 0).nonzero(as_tuple=True)[0]
@@ -377,32 +496,25 @@ def quantize_fc_weight(_fp, _int, symmetric):
 
 def quantize_bn(_fp, _int):
     if _int.num_clusters > 1:
-        _size = (_fp.num_clusters, _fp.num_features)
-        _weights = torch.zeros(_size, device='cuda')
-        _biases = torch.zeros(_size, device='cuda')
-        _means = torch.zeros(_size, device='cuda')
-        _vars = torch.zeros(_size, device='cuda')
-        for c in range(_fp.num_clusters):
-            _weights[c] = _fp.norms[c].weight.clone().detach()
-            _biases[c] = _fp.norms[c].bias.clone().detach()
-            _means[c] = _fp.norms[c].running_mean.clone().detach()
-            _vars[c] = _fp.norms[c].running_var.clone().detach()
+        _weights = torch.stack([norm.weight.detach() for norm in _fp.norms])
+        _biases = torch.stack([norm.bias.detach() for norm in _fp.norms])
+        _means = torch.stack([norm.running_mean.detach() for norm in _fp.norms])
+        _vars = torch.stack([norm.running_var.detach() for norm in _fp.norms])
 
         weight = _weights.div(torch.sqrt(_vars + _fp.norms[0].eps))
         bias = _biases - weight * _means
         weight = quantize_matrix(weight, _int.s2, _int.z2, _fp.w_bit)
-        _int.weight.copy_(weight.type(torch.cuda.IntTensor))
-        for c in range(_int.num_clusters):
-            b = quantize_matrix(bias[c], _int.s1[c] * _int.s2, 0, 32)
-            _int.bias[c].copy_(b.type(torch.cuda.IntTensor))
+        _int.weight.copy_(weight.type(torch.int32))
+        bias = quantize_matrix(bias, _int.s1[:, None] * _int.s2, 0, 32)
+        _int.bias.copy_(bias.type(torch.int32))
     else:
         w = _fp.bn.weight.clone().detach().div(torch.sqrt(_fp.bn.running_var.clone().detach() + _fp.bn.eps))
         b = _fp.bn.bias.clone().detach() - w * _fp.bn.running_mean.clone().detach()
         w = quantize_matrix(w, _int.s2, _int.z2, _fp.w_bit)
         b = quantize_matrix(b, _int.s1 * _int.s2, 0, 32)
 
-        _int.weight[0].copy_(w.type(torch.cuda.IntTensor))
-        _int.bias[0].copy_(b.type(torch.cuda.IntTensor))
+        _int.weight[0].copy_(w.type(torch.int32))
+        _int.bias[0].copy_(b.type(torch.int32))
     return _int
 
 
@@ -421,20 +533,196 @@ def quantize_layer(_fp, _int):
         if fp_layer.bias is not None:
             _int.is_bias.data = torch.tensor(True, dtype=torch.bool)
             if _int.num_clusters > 1:
-                for c in range(_int.num_clusters):
-                    _int.quantized_bias[c].copy_(quantize_matrix(fp_layer.bias, _int.s1[c] * _int.s2, 0, bit=32, symmetric=True))
+                _int.quantized_bias.copy_(quantize_matrix(fp_layer.bias[None, :], _int.s1[:, None] * _int.s2, 0,
+                                                          bit=32, symmetric=True))
             else:
                 _int.quantized_bias[0].copy_(quantize_matrix(fp_layer.bias, _int.s1 * _int.s2, 0, bit=32, symmetric=True))
     return _int
 
 
+_CHECKSUM_DTYPES = {8: torch.int64, 4: torch.int32, 2: torch.int16, 1: torch.int8}
+
+
+def tensor_checksum(t):
+    """
+        Two int64 sums of a tensor's bits, the second weighted by position.
+        Any write changes them, whether it bumps the tensor's version or not (BN's running statistics,
+        writes through .data by sync_cluster_states, checkpoint_block and calibration), without keeping a copy.
+    """
+    t = t.detach().reshape(-1)
+    if t.is_floating_point():
+        t = t.view(_CHECKSUM_DTYPES[t.element_size()])
+    bits = t.long()
+    weights = torch.arange(1, bits.numel() + 1, dtype=torch.int64, device=bits.device)
+    return torch.stack([bits.sum(), bits.mul(weights).sum()])
+
+
+def source_signature(_fp):
+    """
+        What a quantized layer is made from: checksums of the FP parameters/buffers (weights, BN statistics,
+        act_range) and of the qparams, and the qparams that are not tensors
+    """
+    qparams = [getattr(_fp, name, None) for name in ('s1', 's2', 's3', 'z1', 'z2', 'z3', 'M0', 'shift')]
+    tensors = chain(_fp.parameters(), _fp.buffers(), (q for q in qparams if isinstance(q, torch.Tensor)))
+    return [tensor_checksum(t) for t in tensors] + [q for q in qparams if not isinstance(q, torch.Tensor)]
+
+
+def is_same_signature(prev, cur):
+    if prev is None or len(prev) != len(cur):
+        return False
+    for p, c in zip(prev, cur):
+        if isinstance(c, torch.Tensor):
+            if not isinstance(p, torch.Tensor) or p.device != c.device or not torch.equal(p, c):
+                return False
+        elif p != c:
+            return False
+    return True
+
+
 def quantize(_fp, _int):
     assert _int.layer_type in ['QuantizedConv2d', 'QuantizedLinear', 'QuantizedBn2d'], "Not supported quantized layer"
+    # Layers tracked by IncrementalQuantizer are skipped if nothing they are made from has changed
+    tracked = hasattr(_int, 'source_signature')
+    if tracked:
+        signature = source_signature(_fp)
+        if is_same_signature(_int.source_signature, signature):
+            return _int
     _int = transfer_qparams(_fp, _int)
     _int = quantize_layer(_fp, _int)
+    if tracked:
+        _int.source_signature = signature
     return _int
 
 
+class IncrementalQuantizer(object):
+    """
+        Keeps one integer model in sync with an FP model over fine-tuning epochs.
+        Every call runs the architecture's quantizer (e.g. quantize_pcq_resnet) in place and on the FP model's
+        device. Each integer layer keeps the checksums of what it was quantized from, and quantize() skips the
+        layers whose FP layer and qparams are unchanged since the last call.
+    """
+    def __init__(self, quantizer, memory_format=torch.contiguous_format):
+        self.quantizer = quantizer
+        self.memory_format = memory_format
+        self.fp_model = None
+        self.int_model = None
+        self.tensors = []
+
+    def track(self, fp_model, int_model, device):
+        int_model.to(device, memory_format=self.memory_format)
+        for m in int_model.modules():
+            if getattr(m, 'layer_type', None) in ['QuantizedConv2d', 'QuantizedLinear', 'QuantizedBn2d']:
+                m.source_signature = None
+        self.tensors = [(m, name) for m in int_model.modules()
+                        for name, _ in chain(m.named_parameters(recurse=False), m.named_buffers(recurse=False))]
+        self.fp_model, self.int_model = fp_model, int_model
+
+    def __call__(self, fp_model, int_model):
+        device = next(fp_model.parameters()).device
+        with torch.no_grad():
+            if int_model is not self.int_model or fp_model is not self.fp_model:
+                self.track(fp_model, int_model, device)
+            int_model = self.quantizer(fp_model, int_model)
+
+            # Qparams computed on CPU (M0, shift) are moved here, instead of moving the whole model
+            for m, name in self.tensors:
+                t = getattr(m, name)
+                if isinstance(t, torch.Tensor) and t.device != device:
+                    t.data = t.data.to(device)
+        return int_model
+
+
+# Tensors a training forward updates: EMA ranges of fake-quantization and BN's running statistics
+TRAINING_STATE = ('act_range', 'in_range', 'apply_ema', 'running_mean', 'running_var', 'num_batches_tracked')
+
+
+def checkpoint_block(block, x):
+    """
+        Activation checkpointing of a residual/dense block: only x is kept for backward, and backward runs
+        the block's forward again.
+        The forward updates ranges and BN statistics before fake-quantizing with them, so they are reset to their
+        values before the forward when it is run again, and to their values after it once it is done.
+        The recomputation fake-quantizes with the same ranges, and ranges are updated once per step.
+        Checkpointing is non-reentrant, so it works with DDP's find_unused_parameters and inputs without grad.
+    """
+    tensors = [t for name, t in chain(block.named_parameters(), block.named_buffers())
+               if name.rsplit('.', 1)[-1] in TRAINING_STATE]
+    before = [t.detach().clone() for t in tensors]
+    after = []
+
+    def run(_x):
+        if not after:
+            out = block(_x)
+            after.extend(t.detach().clone() for t in tensors)
+            return out
+        for t, saved in zip(tensors, before):
+            t.data.copy_(saved)
+        try:
+            return block(_x)
+        finally:
+            # Also when the recomputation stops early, once it has what backward needs.
+            # Through .data, as BN's backward holds its running statistics and checks their version
+            for t, saved in zip(tensors, after):
+                t.data.copy_(saved)
+    return torch.utils.checkpoint.checkpoint(run, x, use_reentrant=False)
+
+
+def run_block(block, x, use_checkpoint):
+    if use_checkpoint and block.training and torch.is_grad_enabled():
+        return checkpoint_block(block, x)
+    return block(x)
+
+
+def run_layer(layer, x, use_checkpoint):
+    """ Runs an nn.Sequential of residual blocks, checkpointing each block """
+    for block in layer:
+        x = run_block(block, x, use_checkpoint)
+    return x
+
+
+class AppendFeatures(torch.autograd.Function):
+    """
+        Writes features to a dense block's buffer right after prefix (the buffer's first channels, or None),
+        and returns the buffer up to them. Backward slices the gradient back to prefix and features.
+        The buffer is written through .data, so the write doesn't bump the version of the buffer's views
+        earlier layers saved for backward. Those views only cover channels that are never written again.
+    """
+    @staticmethod
+    def forward(ctx, prefix, features, buffer):
+        ctx.start = prefix.size(1) if prefix is not None else 0
+        end = ctx.start + features.size(1)
+        buffer.data[:, ctx.start:end].copy_(features)
+        return buffer.data[:, :end]
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad[:, :ctx.start] if ctx.start else None, grad[:, ctx.start:], None
+
+
+def run_dense_layers(layers, init_features, *args):
+    """
+        Runs the layers of a dense block on one preallocated buffer of the block's output, instead of
+        concatenating all previous features for each layer.
+        Each layer reads the buffer's prefix filled so far (a view, no copy) and its features are written
+        to the following channels. The buffer is allocated once the first layer's features give the growth rate,
+        with the dtype torch.cat would give.
+    """
+    features, buffer = init_features, None
+    for layer in layers:
+        new_features = layer(features, *args)
+        if buffer is None:
+            size = list(init_features.size())
+            size[1] += len(layers) * new_features.size(1)
+            channels_last = init_features.dim() == 4 and not init_features.is_contiguous() \
+                and init_features.is_contiguous(memory_format=torch.channels_last)
+            buffer = torch.empty(size, dtype=torch.promote_types(init_features.dtype, new_features.dtype),
+                                 device=init_features.device,
+                                 memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+            features = AppendFeatures.apply(None, init_features, buffer)
+        features = AppendFeatures.apply(features, new_features, buffer)
+    return features
+
+
 def copy_from_pretrained(_to, _from, norm_layer=None):
     # Copy weights from pretrained FP model
     with torch.no_grad():
@@ -6,6 +6,7 @@ from typing import Any
 from .layers.conv2d import *
 from .layers.linear import *
 from .layers.maxpool2d import *
+from .layers.avgpool2d import *
 from .quantization_utils import *
 
 
@@ -22,7 +23,7 @@ class QuantizedAlexNet(nn.Module):
         self.zero_point = nn.Parameter(torch.tensor(t_init, dtype=torch.int32), requires_grad=False)
 
         self.maxpool = QuantizedMaxPool2d(kernel_size=3, stride=2, padding=0, arg_dict=arg_dict)
-        self.avgpool = nn.AdaptiveAvgPool2d((6, 6))
+        self.avgpool = QuantizedAdaptiveAvgPool2d((6, 6), arg_dict=arg_dict)
         self.conv1 = QuantizedConv2d(3, 64, kernel_size=11, stride=4, padding=2, bias=True, arg_dict=arg_dict)
         self.conv2 = QuantizedConv2d(64, 192, kernel_size=5, stride=1, padding=2, bias=True, arg_dict=arg_dict)
         self.conv3 = QuantizedConv2d(192, 384, kernel_size=3, stride=1, padding=1, bias=True, arg_dict=arg_dict)
@@ -77,7 +78,7 @@ class QuantizedAlexNetSmall(nn.Module):
         self.maxpool1 = QuantizedMaxPool2d(kernel_size=3, stride=2, padding=0, arg_dict=arg_dict)
         self.maxpool2 = QuantizedMaxPool2d(kernel_size=3, stride=2, padding=0, arg_dict=arg_dict)
         self.maxpool3 = QuantizedMaxPool2d(kernel_size=3, stride=2, padding=0, arg_dict=arg_dict)
-        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
+        self.avgpool = QuantizedAdaptiveAvgPool2d((1, 1), arg_dict=arg_dict)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         if self.runtime_helper.qat_batch_cluster is not None:
@@ -86,20 +87,19 @@ class QuantizedAlexNetSmall(nn.Module):
             x = quantize_matrix(x, self.scale, self.zero_point, self.in_bit)
 
         x = self.conv1(x)
-        x = self.maxpool1(x.type(torch.cuda.FloatTensor))
-        x = self.conv2(x.type(torch.cuda.FloatTensor))
-        x = self.maxpool2(x.type(torch.cuda.FloatTensor))
-        x = self.conv3(x.type(torch.cuda.FloatTensor))
-        x = self.conv4(x.type(torch.cuda.FloatTensor))
-        x = self.conv5(x.type(torch.cuda.FloatTensor))
-        x = self.maxpool3(x.type(torch.cuda.FloatTensor))
+        x = self.maxpool1(x.float())
+        x = self.conv2(x.float())
+        x = self.maxpool2(x.float())
+        x = self.conv3(x.float())
+        x = self.conv4(x.float())
+        x = self.conv5(x.float())
+        x = self.maxpool3(x.float())
         x = self.avgpool(x)
-        x = x.floor()
         x = torch.flatten(x, 1)
         x = self.fc1(x)
-        x = self.fc2(x.type(torch.cuda.FloatTensor))
-        x = self.fc3(x.type(torch.cuda.FloatTensor))
-        return x.type(torch.cuda.FloatTensor)
+        x = self.fc2(x.float())
+        x = self.fc3(x.float())
+        return x.float()
 
 
 def quantized_alexnet(arg_dict: dict, **kwargs: Any) -> QuantizedAlexNet:
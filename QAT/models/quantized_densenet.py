@@ -34,11 +34,9 @@ class QuantizedDenseLayer(nn.Module):
     # allowing it to take either a List[Tensor] or single Tensor
     def forward(self, input):  # noqa: F811
         if isinstance(input, Tensor):
-            prev_features = [input]
+            x = input
         else:
-            prev_features = input
-
-        x = torch.cat(prev_features, 1)
+            x = torch.cat(input, 1)
         out = self.bn1(x)
         out = self.conv1(out)
         out = self.bn2(out)
@@ -55,15 +53,13 @@ class QuantizedTransition(nn.Sequential):
 
         self.bn = QuantizedBn2d(num_input_features, arg_dict=arg_dict)
         self.conv = QuantizedConv2d(num_input_features, num_output_features, kernel_size=1, stride=1, bias=False, arg_dict=arg_dict)
-        self.pool = nn.AvgPool2d(kernel_size=2, stride=2)
+        self.pool = QuantizedAvgPool2d(kernel_size=2, stride=2, rounding='trunc', arg_dict=arg_dict)
 
     def forward(self, x):
         out = self.bn(x)
         out = self.conv(out)
         out = self.pool(out)
-        out = out.type(torch.cuda.IntTensor)
-        out = out.type(torch.cuda.FloatTensor)
-        return out
+        return out.float()
 
 
 class QuantizedDenseBlock(nn.ModuleDict):
@@ -81,6 +77,7 @@ class QuantizedDenseBlock(nn.ModuleDict):
         super(QuantizedDenseBlock, self).__init__()
         self.arg_dict = arg_dict
         self.num_layers = num_layers
+        self.memory_efficient = memory_efficient
         self.bit, self.num_clusters = itemgetter('bit', 'cluster')(arg_dict)
         self.q_max = 2 ** self.bit - 1
 
@@ -95,6 +92,10 @@ class QuantizedDenseBlock(nn.ModuleDict):
             self.add_module('denselayer%d' % (i + 1), layer)
 
     def forward(self, init_features: Tensor) -> Tensor:
+        # Features of every layer share the block's qparams, so they are written to one buffer as they are
+        if self.memory_efficient:
+            return run_dense_layers(list(self.values()), init_features)
+
         features = [init_features]
         for name, layer in self.items():
             new_features = layer(features)
@@ -116,6 +117,7 @@ class QuantizedDenseNet(nn.Module):
     ) -> None:
         super(QuantizedDenseNet, self).__init__()
         self.num_clusters, self.runtime_helper = itemgetter('cluster', 'runtime_helper')(arg_dict)
+        memory_efficient = memory_efficient or arg_dict.get('memory_efficient', False)
 
         self.target_bit = nn.Parameter(torch.tensor(0, dtype=torch.int8), requires_grad=False)
         self.a_bit = nn.Parameter(torch.tensor(0, dtype=torch.int8), requires_grad=False)
@@ -161,6 +163,7 @@ class QuantizedDenseNet(nn.Module):
         # Last Norm
         self.features.add_module('last_norm', QuantizedBn2d(num_features, arg_dict=arg_dict))
         # Linear layer
+        self.avgpool = QuantizedAdaptiveAvgPool2d((1, 1), rounding='trunc', arg_dict=arg_dict)
         self.classifier = QuantizedLinear(num_features, num_classes, arg_dict=arg_dict)
 
     def forward(self, x: Tensor) -> Tensor:
@@ -170,17 +173,13 @@ class QuantizedDenseNet(nn.Module):
             x = quantize_matrix(x, self.scale, self.zero_point, self.in_bit)
 
         out = self.features(x)
-        out = F.adaptive_avg_pool2d(out, (1, 1))
-        out = out.type(torch.cuda.IntTensor)
-        out = out.type(torch.cuda.FloatTensor)
+        out = self.avgpool(out)
         out = torch.flatten(out, 1)
         if self.a_bit > self.target_bit:
-            out = rescale_matrix(out.type(torch.cuda.LongTensor), self.z1, self.z_target, self.M0,
+            out = rescale_matrix(out.long(), self.z1, self.z_target, self.M0,
                                self.shift, self.target_bit, self.runtime_helper)
-            out = self.classifier(out.type(torch.cuda.FloatTensor))
-        else:
-            out = self.classifier(out)
-        return out.type(torch.cuda.FloatTensor)
+        out = self.classifier(out.float())
+        return out.float()
 
 
 def quantized_densenet(arg_dict: dict, **kwargs):
@@ -24,10 +24,11 @@ class QuantizedSqueezeExcitation(nn.Module):
         self.fc1 = QuantizedConv2d(input_channels, squeeze_channels, kernel_size=1, arg_dict=arg_dict)
         self.fc2 = QuantizedConv2d(squeeze_channels, input_channels, kernel_size=1, activation='Hardsigmoid', arg_dict=arg_dict)
         self.mul = QuantizedMul(arg_dict=arg_dict)
+        self.avgpool = QuantizedAdaptiveAvgPool2d(1, rounding='round', arg_dict=arg_dict)
 
     def _scale(self, x: Tensor) -> Tensor:
         identity = x
-        scale = F.adaptive_avg_pool2d(x, 1)
+        scale = self.avgpool(x)
         scale = self.fc1(scale)
         scale = self.fc2(scale)
         scale = self.mul(scale, identity)
@@ -135,7 +136,7 @@ class QuantizedMobileNet(nn.Module):
                                       activation='Hardswish', arg_dict=arg_dict))
 
         self.features = nn.Sequential(*layers)
-        self.avgpool = nn.AdaptiveAvgPool2d(1)
+        self.avgpool = QuantizedAdaptiveAvgPool2d(1, rounding='round', arg_dict=arg_dict)
         self.classifier = nn.Sequential(
             QuantizedLinear(lastconv_output_channels, last_channel, activation='Hardswish', arg_dict=arg_dict),
             QuantizedLinear(last_channel, num_classes, arg_dict=arg_dict)
@@ -177,9 +178,9 @@ def set_shortcut_qparams(m, s_bypass, z_bypass, s_prev, z_prev, s3, z3):
             m.M0_bypass[c], m.shift_bypass[c] = quantize_M(s_bypass[c] / s3[c])
             m.M0_prev[c], m.shift_prev[c] = quantize_M(s_prev[c] / s3[c])
     else:
-        m.M0_bypass, m.shift_bypass = quantize_M(s_bypass / s3)
-        m.M0_prev, m.shift_prev = quantize_M(s_prev / s3)
-    return m
+        m.M0_bypass.data, m.shift_bypass.data = quantize_M(s_bypass / s3)
+        m.M0_prev.data, m.shift_prev.data = quantize_M(s_prev / s3)
+    return m.set_pack()
 
 def set_mul_qparams(_int, s_bypass, z_bypass, s_prev, z_prev, s3, z3):
     _int.s_bypass = nn.Parameter(s_bypass, requires_grad=False)
@@ -193,35 +194,21 @@ def set_mul_qparams(_int, s_bypass, z_bypass, s_prev, z_prev, s3, z3):
         for c in range(_int.num_clusters):
             _int.M0[c], _int.shift[c] = quantize_M(s_bypass[c] * s_prev[c] / _int.s3[c])
     else:
-        _int.M0, _int.shift = quantize_M(s_bypass * s_prev / _int.s3)
-    return _int
-
-def set_activation(_fp, _int):
-    if _int.num_clusters > 1:
-        for i in range(_int.num_clusters):
-            _int.s_activation[i] = torch.nn.Parameter(_fp.s3[i], requires_grad=False)
-            _int.z_activation[i] = torch.nn.Parameter(_fp.z3[i], requires_grad=False)
-            _int.hardswish_6[i].copy_(torch.round(6 / _int.s_activation[i] + _int.z_activation[i]))
-            _int.hardswish_3[i].copy_(torch.round(3 / _int.s_activation[i] + _int.z_activation[i]))
-    else:
-        _int.s_activation = torch.nn.Parameter(_fp.s3, requires_grad=False)
-        _int.z_activation = torch.nn.Parameter(_fp.z3, requires_grad=False)
-        _int.hardswish_6.copy_(nn.Parameter(torch.round(6 / _int.s_activation + _int.z_activation)))
-        _int.hardswish_3.copy_(nn.Parameter(torch.round(3 / _int.s_activation + _int.z_activation)))
-
+        _int.M0.data, _int.shift.data = quantize_M(s_bypass * s_prev / _int.s3)
+    return _int.set_pack()
 
 def quantize_mobilenet(fp_model, int_model):
     int_model.scale = torch.nn.Parameter(fp_model.scale, requires_grad=False)
     int_model.zero_point = torch.nn.Parameter(fp_model.zero_point, requires_grad=False)
     int_model.features[0] = quantize(fp_model.features[0], int_model.features[0])
-    set_activation(fp_model.features[1], int_model.features[0])
+    set_activation_table(fp_model.features[1], int_model.features[0])
 
     fp_feature_idx = 2
     for int_feature_idx in range(1, len(int_model.features)-1):
         fp_block_idx = 0
         for block_idx in range(len(int_model.features[int_feature_idx].block)):
             if isinstance(fp_model.features[fp_feature_idx].block[fp_block_idx], QActivation):
-                set_activation(fp_model.features[fp_feature_idx].block[fp_block_idx], int_model.features[int_feature_idx].block[block_idx-1])
+                set_activation_table(fp_model.features[fp_feature_idx].block[fp_block_idx], int_model.features[int_feature_idx].block[block_idx-1])
                 fp_block_idx += 1
             fp_module = fp_model.features[fp_feature_idx].block[fp_block_idx]
             int_module = int_model.features[int_feature_idx].block[block_idx]
@@ -230,7 +217,8 @@ def quantize_mobilenet(fp_model, int_model):
             elif isinstance(fp_module, FusedSqueezeExcitation):
                 int_module.fc1 = quantize(fp_module.fc1, int_module.fc1)
                 int_module.fc2 = quantize(fp_module.fc2, int_module.fc2)
-                set_activation(fp_module.QAct, int_module.fc2)
+                set_activation_table(fp_module.QAct, int_module.fc2)
+                int_module.avgpool.zero_point.data = fp_module.z1
                 int_module.mul = set_mul_qparams(int_module.mul, fp_module.QAct.s3, fp_module.QAct.z3, fp_module.s1,
                                                  fp_module.z1, fp_module.s3, fp_module.z3)
             fp_block_idx += 1
@@ -245,10 +233,11 @@ def quantize_mobilenet(fp_model, int_model):
         fp_feature_idx += 1
 
     int_model.features[-1] = quantize(fp_model.features[-2], int_model.features[-1])
-    set_activation(fp_model.features[-1], int_model.features[-1])
+    set_activation_table(fp_model.features[-1], int_model.features[-1])
+    int_model.avgpool.zero_point.data = fp_model.features[-1].z3
 
     int_model.classifier[0] = quantize(fp_model.classifier[0], int_model.classifier[0])
-    set_activation(fp_model.classifier[1], int_model.classifier[0])
+    set_activation_table(fp_model.classifier[1], int_model.classifier[0])
     int_model.classifier[1] = quantize(fp_model.classifier[2], int_model.classifier[1])
     return int_model
 
@@ -60,11 +60,11 @@ class QuantizedBasicBlock(nn.Module):
         if self.a_bit > self.target_bit:
             conv_x = rescale_matrix(x, self.z1, self.z_target, self.M0, self.shift,
                                     self.target_bit, self.runtime_helper)
-        conv_x = conv_x.type(torch.cuda.FloatTensor)
+        conv_x = conv_x.float()
         out = self.conv1(conv_x)
         out = self.bn1(out)
 
-        out = self.conv2(out.type(torch.cuda.FloatTensor))
+        out = self.conv2(out.float())
         out = self.bn2(out)
 
         if self.downsample is not None:
@@ -117,13 +117,13 @@ class QuantizedBottleneck(nn.Module):
         if self.a_bit > self.target_bit:
             conv_x = rescale_matrix(x, self.z1, self.z_target, self.M0, self.shift,
                                     self.target_bit, self.runtime_helper)
-        conv_x = conv_x.type(torch.cuda.FloatTensor)
+        conv_x = conv_x.float()
 
         out = self.conv1(conv_x)
         out = self.bn1(out)
-        out = self.conv2(out.type(torch.cuda.FloatTensor))
+        out = self.conv2(out.float())
         out = self.bn2(out)
-        out = self.conv3(out.type(torch.cuda.FloatTensor))
+        out = self.conv3(out.float())
         out = self.bn3(out)
 
         if self.downsample is not None:
@@ -175,7 +175,7 @@ class QuantizedResNet(nn.Module):
         self.layer2 = self._make_layer(block, 128, layers[1], stride=2, dilate=replace_stride_with_dilation[0])
         self.layer3 = self._make_layer(block, 256, layers[2], stride=2, dilate=replace_stride_with_dilation[1])
         self.layer4 = self._make_layer(block, 512, layers[3], stride=2, dilate=replace_stride_with_dilation[2])
-        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
+        self.avgpool = QuantizedAdaptiveAvgPool2d((1, 1), arg_dict=arg_dict)
         self.fc = QuantizedLinear(512 * block.expansion, num_classes, arg_dict=arg_dict)
 
     def _make_layer(self, block, planes, blocks, stride=1, dilate=False):
@@ -204,26 +204,23 @@ class QuantizedResNet(nn.Module):
         else:
             x = quantize_matrix(x, self.scale, self.zero_point, self.in_bit)
 
-        x = self.first_conv(x.type(torch.cuda.FloatTensor))
+        x = self.first_conv(x.float())
         x = self.bn1(x)
-        x = self.maxpool(x.type(torch.cuda.FloatTensor))
+        x = self.maxpool(x.float())
 
-        x = self.layer1(x.type(torch.cuda.LongTensor))
+        x = self.layer1(x.long())
         x = self.layer2(x)
         x = self.layer3(x)
         x = self.layer4(x)
 
-        x = self.avgpool(x.type(torch.cuda.FloatTensor))
-        x = x.floor()
+        x = self.avgpool(x)
 
         x = torch.flatten(x, 1)
         if self.a_bit > self.target_bit:
-            x = rescale_matrix(x.type(torch.cuda.LongTensor), self.z1, self.z_target, self.M0,
+            x = rescale_matrix(x.long(), self.z1, self.z_target, self.M0,
                                self.shift, self.target_bit, self.runtime_helper)
-            x = self.fc(x.type(torch.cuda.FloatTensor))
-        else:
-            x = self.fc(x)
-        return x.type(torch.cuda.FloatTensor)
+        x = self.fc(x.float())
+        return x.float()
 
 
 class QuantizedResNet20(nn.Module):
@@ -256,7 +253,7 @@ class QuantizedResNet20(nn.Module):
         self.layer1 = self._make_layer(block, 16, layers[0])
         self.layer2 = self._make_layer(block, 32, layers[1], stride=2)
         self.layer3 = self._make_layer(block, 64, layers[2], stride=2)
-        self.avgpool = nn.AvgPool2d(8, stride=1)
+        self.avgpool = QuantizedAvgPool2d(8, stride=1, arg_dict=arg_dict)
         self.fc = QuantizedLinear(64 * block.expansion, num_classes, arg_dict=arg_dict)
 
     def _make_layer(self, block, planes, blocks, stride=1):
@@ -277,23 +274,20 @@ class QuantizedResNet20(nn.Module):
         else:
             x = quantize_matrix(x, self.scale, self.zero_point, self.in_bit)
 
-        x = self.first_conv(x.type(torch.cuda.FloatTensor))
+        x = self.first_conv(x.float())
         x = self.bn1(x)
         x = self.layer1(x)
         x = self.layer2(x)
         x = self.layer3(x)
 
-        x = self.avgpool(x.type(torch.cuda.FloatTensor))
-        x = x.floor()
+        x = self.avgpool(x)
 
         x = torch.flatten(x, 1)
         if self.a_bit > self.target_bit:
-            x = rescale_matrix(x.type(torch.cuda.LongTensor), self.z1, self.z_target, self.M0,
+            x = rescale_matrix(x.long(), self.z1, self.z_target, self.M0,
                                self.shift, self.target_bit, self.runtime_helper)
-            x = self.fc(x.type(torch.cuda.FloatTensor))
-        else:
-            x = self.fc(x)
-        return x.type(torch.cuda.FloatTensor)
+        x = self.fc(x.float())
+        return x.float()
 
 
 def quantized_resnet18(arg_dict, **kwargs):
@@ -331,7 +325,7 @@ def set_shortcut_qparams(m, bit, s_bypass, z_bypass, s_prev, z_prev, s3, z3):
     else:
         m.M0_bypass.data, m.shift_bypass.data = quantize_M(s_bypass / s3)
         m.M0_prev.data, m.shift_prev.data = quantize_M(s_prev / s3)
-    return m
+    return m.set_pack()
 
 
 def quantize_block(_fp, _int):
@@ -1,12 +1,7 @@
 import argparse
 import os
 
-from .models import *
-from QAT.finetune import _finetune
-from Clustering import *
-from pretrain import _pretrain
-from .evaluate import _evaluate
-from utils.lipschitz import check_lipschitz
+from .registry import get_model_tools, get_mode_runner
 
 parser = argparse.ArgumentParser(description='[PyTorch] Per Cluster Quantization')
 parser.add_argument('--arch', default='resnet', type=str, help='Architecture to train/eval')
@@ -31,8 +26,24 @@ parser.add_argument('--fold_convbn', action='store_true',
                     help="Fake Quantize CONV's weight after folding BatchNormalization")
 
 parser.add_argument('--ste', default=True, type=bool, help="Use Straight-through Estimator in Fake Quantization")
+parser.add_argument('--act_checkpoint', action='store_true',
+                    help="Recompute each residual/dense block's activations in backward to save memory (ResNet/DenseNet)")
+parser.add_argument('--memory_efficient', action='store_true',
+                    help="Write DenseNet's features to one preallocated buffer per dense block instead of concatenating them")
+parser.add_argument('--channels_last', action='store_true',
+                    help='Keep 4D weights and activations of models in channels_last (NHWC) memory format')
 parser.add_argument('--fq', default=1, type=int,
                     help='Epoch to wait for fake-quantize activations. PCQ requires at least one epoch.')
+parser.add_argument('--proxy_val', default=0, type=int,
+                    help='Validate on a cluster-stratified subset of this many test samples, 0 to always run full validation')
+parser.add_argument('--full_val_every', default=10, type=int,
+                    help='With proxy_val, epochs between forced full validations of the quantized model (0: never)')
+parser.add_argument('--calib_observer', default='mean', type=str,
+                    help="PTQ observer of activation ranges (mean of per-sample min/max, minmax, percentile)")
+parser.add_argument('--calib_percentile', default=99.99, type=float, help="Percentile of the percentile observer")
+parser.add_argument('--eval_spec', default='', type=str,
+                    help='JSON list of checkpoints to evaluate in shared passes over the test set (eval mode)')
+parser.add_argument('--max_resident', default=4, type=int, help='Models of eval_spec loaded on the GPU at a time')
 parser.add_argument('--bit', default=32, type=int, help='Target bit-width to be quantized (value 32 means pretraining)')
 parser.add_argument('--bit_conv_act', default=16, type=int,
                     help="CONV's activation bit size when not using Conv&BN folding")
@@ -48,131 +59,79 @@ parser.add_argument('--qn_increment_epoch', default=9999, type=int, help='quant
 parser.add_argument('--qn_each_channel', default=True, type=bool, help='qn apply conv each channel')
 
 parser.add_argument('--gpu', default='0', type=str, help='GPU to use')
-args_qat, _ = parser.parse_known_args()
-#os.environ["CUDA_VISIBLE_DEVICES"] = args_qat.gpu
 
-# General
-if not args_qat.bit_first:
-    args_qat.bit_first = args_qat.bit
-if not args_qat.bit_classifier:
-    args_qat.bit_classifier = args_qat.bit
-# if not args_qat.bit_addcat:
-#     args_qat.bit_addcat = args_qat.bit
+
+def parse_qat_args(argv=None):
+    args, _ = parser.parse_known_args(argv)
+    #os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+
+    # General
+    if not args.bit_first:
+        args.bit_first = args.bit
+    if not args.bit_classifier:
+        args.bit_classifier = args.bit
+    # if not args.bit_addcat:
+    #     args.bit_addcat = args.bit
+    return args
+
+
+args_qat = parse_qat_args()
 
 
 def set_func_for_target_arch(arch, is_pcq):
-    tools = QuantizationTool()
-    if arch == 'MLP':
-        setattr(tools, 'pretrained_model_initializer', mlp)
-        setattr(tools, 'fused_model_initializer', pcq_mlp if is_pcq else fused_mlp)
-        setattr(tools, 'quantized_model_initializer', quantized_mlp)
-        setattr(tools, 'fuser', set_fused_mlp)
-        setattr(tools, 'quantizer', quantize_mlp)
-        # setattr(tools, 'shift_qn_prob', modify_fused_mlp_qn_pre_hook)
-
-    if 'AlexNet' in arch:
-        setattr(tools, 'fuser', set_fused_alexnet)
-        setattr(tools, 'quantizer', quantize_alexnet)
-        if 'Small' in arch:
-            setattr(tools, 'pretrained_model_initializer', alexnet_small)
-            if is_pcq:
-                setattr(tools, 'fused_model_initializer', pcq_alexnet_small)
-            else:
-                setattr(tools, 'fused_model_initializer', fused_alexnet_small)
-            setattr(tools, 'quantized_model_initializer', quantized_alexnet_small)
-        else:
-            setattr(tools, 'pretrained_model_initializer', alexnet)
-            if is_pcq:
-                setattr(tools, 'fused_model_initializer', pcq_alexnet)
-            else:
-                setattr(tools, 'fused_model_initializer', fused_alexnet)
-            setattr(tools, 'quantized_model_initializer', quantized_alexnet)
-
-    elif 'ResNet' in arch:
-        setattr(tools, 'quantizer', quantize_pcq_resnet)
-        if is_pcq:
-            setattr(tools, 'fuser', set_pcq_resnet)
-        else:
-            setattr(tools, 'fuser', set_fused_resnet)
-
-        if '50' in arch:
-            setattr(tools, 'pretrained_model_initializer', resnet50)
-            if is_pcq:
-                setattr(tools, 'fused_model_initializer', pcq_resnet50)
-            else:
-                setattr(tools, 'fused_model_initializer', fused_resnet50)
-            setattr(tools, 'quantized_model_initializer', quantized_resnet50)
+    # Model functions are imported once the job uses them, from the registry's modules of arch
+    return get_model_tools(arch, 'pcq' if is_pcq else 'fused')
+
+
+def specify_target_arch(arch, dataset, num_clusters):
+    arch = 'MLP' if arch == 'mlp' else arch
+    if arch == 'alexnet':
+        if dataset == 'imagenet':
+            arch = 'AlexNet'
         else:
-            setattr(tools, 'pretrained_model_initializer', resnet20)
-            if is_pcq:
-                setattr(tools, 'fused_model_initializer', pcq_resnet20)
-            else:
-                setattr(tools, 'fused_model_initializer', fused_resnet20)
-            setattr(tools, 'quantized_model_initializer', quantized_resnet20)
-
-    elif arch == 'MobileNetV3':
-        setattr(tools, 'fuser', set_fused_mobilenet)
-        setattr(tools, 'quantizer', quantize_mobilenet)
-        setattr(tools, 'pretrained_model_initializer', mobilenet)
-        setattr(tools, 'fused_model_initializer', fused_mobilenet)
-        setattr(tools, 'quantized_model_initializer', quantized_mobilenet)
-
-    elif arch == 'DenseNet121':
-        setattr(tools, 'quantized_model_initializer', quantized_densenet)
-        if is_pcq:
-            setattr(tools, 'fused_model_initializer', pcq_densenet)
-            setattr(tools, 'fuser', set_pcq_densenet)
-            setattr(tools, 'quantizer', quantize_pcq_densenet)
+            arch = 'AlexNetSmall'
+    elif arch == 'resnet20':
+        arch = 'ResNet20'
+    elif arch == 'resnet50':
+        arch = 'ResNet50'
+    elif arch == 'resnet':
+        if dataset == 'imagenet':
+            arch = 'ResNet50'
         else:
-            setattr(tools, 'fused_model_initializer', fused_densenet)
-            setattr(tools, 'fuser', set_fused_densenet)
-            setattr(tools, 'quantizer', quantize_densenet)
-    return tools
+            arch = 'ResNet20'
+    elif arch == 'mobilenet':
+        arch = 'MobileNetV3'
+    elif arch == 'bert':
+        arch = 'Bert'
+    elif arch == 'densenet':
+        arch = 'DenseNet121'
 
+    is_pcq = True if num_clusters > 1 else False
+    model_initializers = set_func_for_target_arch(arch, is_pcq)
+    return arch, model_initializers
 
-def main(args_daq, data_loaders, clustering_model):
+
+def main(args_daq, data_loaders, clustering_model, args_qat=args_qat):
     args = argparse.Namespace(**vars(args_qat), **vars(args_daq))
     print(vars(args))
     assert args.arch in ['mlp', 'alexnet', 'resnet', 'resnet20', 'resnet50','bert', 'densenet', 'mobilenet'], 'Not supported architecture'
     assert args.bit in [4, 8, 16, 32], 'Not supported target bit'
-    if args.mode == 'fine':
+    if args.mode in ['fine', 'ptq']:
         assert args.bit in [4, 8], 'Please set target bit between 4 & 8'
         # if args.dataset != 'imagenet':
             # assert args.dnn_path, "Need pretrained model with the path('dnn_path' argument) for finetuning"
 
-    def specify_target_arch(arch, dataset, num_clusters):
-        arch = 'MLP' if arch == 'mlp' else arch
-        if arch == 'alexnet':
-            if dataset == 'imagenet':
-                arch = 'AlexNet'
-            else:
-                arch = 'AlexNetSmall'
-        elif arch == 'resnet20':
-            arch = 'ResNet20'
-        elif arch == 'resnet50':
-            arch = 'ResNet50'
-        elif arch == 'resnet':
-            if dataset == 'imagenet':
-                arch = 'ResNet50'
-            else:
-                arch = 'ResNet20'
-        elif arch == 'mobilenet':
-            arch = 'MobileNetV3'
-        elif arch == 'bert':
-            arch = 'Bert'
-        elif arch == 'densenet':
-            arch = 'DenseNet121'
-
-        is_pcq = True if num_clusters > 1 else False
-        model_initializers = set_func_for_target_arch(arch, is_pcq)
-        return arch, model_initializers
     args.arch, tools = specify_target_arch(args.arch, args.dataset, args.cluster)
 
     if args.mode == 'pre':
-        _pretrain(args, tools)
+        get_mode_runner('pre')(args, tools)
     elif args.mode == 'fine':
-        _finetune(args, tools, data_loaders, clustering_model)
+        return get_mode_runner('fine')(args, tools, data_loaders, clustering_model)
+    elif args.mode == 'ptq':
+        return get_mode_runner('ptq')(args, tools, data_loaders, clustering_model)
     elif args.mode == 'eval':
-        _evaluate(args, tools)
+        if args.eval_spec:
+            return get_mode_runner('eval_many')(args, data_loaders)
+        get_mode_runner('eval')(args, tools)
     elif args.mode == 'lip':
-        check_lipschitz(args, tools)
+        get_mode_runner('lip')(args, tools)
@@ -0,0 +1,113 @@
+from importlib import import_module
+
+from .models.quantization_utils import QuantizationTool
+
+
+# Functions of each architecture, as 'module:name' imported on first use.
+# Roles that differ between PCQ and non-PCQ models map each variant ('pcq' or 'fused') to its function.
+MODEL_REGISTRY = {
+    'MLP': {
+        'pretrained_model_initializer': '.models.mlp:mlp',
+        'fused_model_initializer': {'pcq': '.models.pcq_mlp:pcq_mlp', 'fused': '.models.fused_mlp:fused_mlp'},
+        'quantized_model_initializer': '.models.quantized_mlp:quantized_mlp',
+        'fuser': '.models.fused_mlp:set_fused_mlp',
+        'quantizer': '.models.quantized_mlp:quantize_mlp',
+    },
+    'AlexNet': {
+        'pretrained_model_initializer': '.models.alexnet:alexnet',
+        'fused_model_initializer': {'pcq': '.models.pcq_alexnet:pcq_alexnet',
+                                    'fused': '.models.fused_alexnet:fused_alexnet'},
+        'quantized_model_initializer': '.models.quantized_alexnet:quantized_alexnet',
+        'fuser': '.models.fused_alexnet:set_fused_alexnet',
+        'quantizer': '.models.quantized_alexnet:quantize_alexnet',
+    },
+    'AlexNetSmall': {
+        'pretrained_model_initializer': '.models.alexnet:alexnet_small',
+        'fused_model_initializer': {'pcq': '.models.pcq_alexnet:pcq_alexnet_small',
+                                    'fused': '.models.fused_alexnet:fused_alexnet_small'},
+        'quantized_model_initializer': '.models.quantized_alexnet:quantized_alexnet_small',
+        'fuser': '.models.fused_alexnet:set_fused_alexnet',
+        'quantizer': '.models.quantized_alexnet:quantize_alexnet',
+    },
+    'ResNet20': {
+        'pretrained_model_initializer': '.models.resnet:resnet20',
+        'fused_model_initializer': {'pcq': '.models.pcq_resnet:pcq_resnet20',
+                                    'fused': '.models.fused_resnet:fused_resnet20'},
+        'quantized_model_initializer': '.models.quantized_resnet:quantized_resnet20',
+        'fuser': {'pcq': '.models.pcq_resnet:set_pcq_resnet', 'fused': '.models.fused_resnet:set_fused_resnet'},
+        'quantizer': '.models.quantized_resnet:quantize_pcq_resnet',
+    },
+    'ResNet50': {
+        'pretrained_model_initializer': '.models.resnet:resnet50',
+        'fused_model_initializer': {'pcq': '.models.pcq_resnet:pcq_resnet50',
+                                    'fused': '.models.fused_resnet:fused_resnet50'},
+        'quantized_model_initializer': '.models.quantized_resnet:quantized_resnet50',
+        'fuser': {'pcq': '.models.pcq_resnet:set_pcq_resnet', 'fused': '.models.fused_resnet:set_fused_resnet'},
+        'quantizer': '.models.quantized_resnet:quantize_pcq_resnet',
+    },
+    'MobileNetV3': {
+        'pretrained_model_initializer': '.models.mobilenet:mobilenet',
+        'fused_model_initializer': '.models.fused_mobilenet:fused_mobilenet',
+        'quantized_model_initializer': '.models.quantized_mobilenet:quantized_mobilenet',
+        'fuser': '.models.fused_mobilenet:set_fused_mobilenet',
+        'quantizer': '.models.quantized_mobilenet:quantize_mobilenet',
+    },
+    'DenseNet121': {
+        'fused_model_initializer': {'pcq': '.models.pcq_densenet:pcq_densenet',
+                                    'fused': '.models.fused_densenet:fused_densenet'},
+        'quantized_model_initializer': '.models.quantized_densenet:quantized_densenet',
+        'fuser': {'pcq': '.models.pcq_densenet:set_pcq_densenet', 'fused': '.models.fused_densenet:set_fused_densenet'},
+        'quantizer': {'pcq': '.models.quantized_densenet:quantize_pcq_densenet',
+                      'fused': '.models.quantized_densenet:quantize_densenet'},
+    },
+}
+
+# Function running each mode of qat.main
+MODE_REGISTRY = {
+    'pre': 'pretrain:_pretrain',
+    'fine': '.finetune:_finetune',
+    'ptq': '.finetune:_calibrate',
+    'eval': '.evaluate:_evaluate',
+    'eval_many': '.evaluate:_evaluate_many',
+    'lip': 'utils.lipschitz:check_lipschitz',
+}
+
+
+def resolve(spec):
+    """ Imports 'module:name' (module relative to QAT if it starts with a dot) and returns the name """
+    module, name = spec.split(':')
+    return getattr(import_module(module, __package__), name)
+
+
+class LazyQuantizationTool(QuantizationTool):
+    """
+        QuantizationTool of an architecture, importing each of its functions on first use,
+        so a job only loads the model modules it runs. Functions set with setattr override the registry's.
+    """
+    def __init__(self, specs):
+        super(LazyQuantizationTool, self).__init__()
+        self._specs = specs
+        for role in specs:
+            del self.__dict__[role]
+
+    def __getattr__(self, name):
+        specs = self.__dict__.get('_specs', {})
+        if name not in specs:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        func = resolve(specs[name])
+        setattr(self, name, func)
+        return func
+
+
+def get_model_tools(arch, variant):
+    """ Tools of arch (as specify_target_arch names it) for variant 'pcq' or 'fused'; unregistered roles are None """
+    specs = {}
+    for role, spec in MODEL_REGISTRY.get(arch, {}).items():
+        spec = spec.get(variant) if isinstance(spec, dict) else spec
+        if spec is not None:
+            specs[role] = spec
+    return LazyQuantizationTool(specs)
+
+
+def get_mode_runner(mode):
+    return resolve(MODE_REGISTRY[mode])
@@ -4,11 +4,17 @@ from utils.torch_dataset import get_data_loaders
 
 parser = argparse.ArgumentParser(description='[PyTorch] Per Cluster Quantization')
 parser.add_argument('--worker', default=4, type=int, help='Number of workers for input data loader')
-parser.add_argument('--mode', default='fine', type=str, help="pre/fine/eval/lip")
+parser.add_argument('--mode', default='fine', type=str, help="pre/fine/ptq/eval/lip/loader/cache/kselect")
 parser.add_argument('--imagenet', default='', type=str, help="ImageNet dataset path")
+parser.add_argument('--imagenet_cache', default='', type=str,
+                    help="Path of center-cropped uint8 ImageNet shards, used for non-augmented passes")
 parser.add_argument('--dataset', default='cifar10', type=str, help='Dataset to use')
+parser.add_argument('--calib_batches', default=32, type=int,
+                    help='Calibration batches of PTQ mode, at least one per cluster')
 parser.add_argument('--batch', default=128, type=int, help='Mini-batch size')
 parser.add_argument('--val_batch', default=0, type=int, help='Validation batch size')
+parser.add_argument('--tensor_dataset', action='store_true',
+                    help='Keep CIFAR/SVHN in memory as uint8 and augment batch-wise')
 
 parser.add_argument('--quant_base', default='qat', type=str,
                     help='Among qat/qn/hawq, choose fine-tuning method to apply DAQ')
@@ -29,35 +35,75 @@ parser.add_argument('--repr_method', default='mean', type=str, help="How to get
 parser.add_argument('--similarity_method', default='and', type=str, help="How to measure similarity score")
 parser.add_argument('--clustering_path', default='', type=str, help="Trained K-means clustering model's path")
 
+parser.add_argument('--k_range', default='2-8', type=str,
+                    help="Numbers of clusters to fit at once in kselect mode, e.g. 2-8 or 2,4,8,16")
 parser.add_argument('--kmeans_epoch', default=300, type=int, help='Max epoch of K-means model to train')
 parser.add_argument('--kmeans_tol', default=0.0001, type=float, help="K-means model's tolerance to detect convergence")
 parser.add_argument('--kmeans_init', default=10, type=int, help="Train K-means model n-times, and use the best model")
+parser.add_argument('--drift_monitor', action='store_true',
+                    help="Track per-cluster statistics of predicted inputs, and report drift from the training-time baseline")
+parser.add_argument('--drift_threshold', default=1.5, type=float,
+                    help="Ratio of change in cluster frequency/distance/input range to flag as drift")
+parser.add_argument('--centroid_lr', default=0.0, type=float,
+                    help="With --drift_monitor, move centroids toward predicted inputs by this rate per batch (0: off)")
+parser.add_argument('--centroid_max_shift', default=0.5, type=float,
+                    help="Max distance of refreshed centroids from trained ones, relative to the training-time mean distance")
 parser.add_argument('--visualize_clustering', action='store_true',
                     help="Visualize clustering result with PCA-ed training dataset")
 parser.add_argument('--darknet', default=False, type=bool, help="Evaluate with dataset preprocessed in darknet")
 parser.add_argument('--horovod', default=False, type=bool, help="Use distributed training with horovod")
+parser.add_argument('--ddp', action='store_true',
+                    help="Use torch.distributed DDP, launched with torchrun (needs a trained clustering model)")
+parser.add_argument('--ddp_backend', default=None, type=str, help="DDP backend, nccl with GPUs and gloo otherwise")
 parser.add_argument('--training_per_batch', default=False, type=bool, help='concurrent training same model each batch')
+parser.add_argument('--profile', default='', type=str,
+                    help="Profile every module and phase of the first steps, and save their Chrome trace to this path")
+parser.add_argument('--profile_steps', default=20, type=int, help='Steps to profile after a warm-up step')
 
-args_daq, tmp = parser.parse_known_args()
+def parse_daq_args(argv=None):
+    """ Returns DAQ's args and the --arch given to QAT/HAWQ, parsed from argv (default: sys.argv) """
+    args, tmp = parser.parse_known_args(argv)
 
-arch = None
-if '--arch' in tmp:
-    arch = tmp[tmp.index('--arch') + 1]
+    arch = None
+    if '--arch' in tmp:
+        arch = tmp[tmp.index('--arch') + 1]
 
-if args_daq.imagenet:
-    args_daq.dataset = 'imagenet'
-if args_daq.dataset == 'cifar':
-    args_daq.dataset = 'cifar10'
-if not args_daq.val_batch:
-    args_daq.val_batch = 256 if args_daq.dataset != 'imagenet' else 128
+    if args.imagenet:
+        args.dataset = 'imagenet'
+    if args.dataset == 'cifar':
+        args.dataset = 'cifar10'
+    if not args.val_batch:
+        args.val_batch = 256 if args.dataset != 'imagenet' else 128
 
-# # NN-aware Clustering
-if args_daq.cluster > 1 and args_daq.sub_cluster:
-    args_daq.nnac = True
+    # # NN-aware Clustering
+    if args.cluster > 1 and args.sub_cluster:
+        args.nnac = True
+    return args, arch
+
+
+args_daq, arch = parse_daq_args()
 
 
 if __name__ == '__main__':
+    if args_daq.mode == 'loader':
+        from utils.torch_dataset import measure_data_loader_throughput
+        measure_data_loader_throughput(args_daq)
+        exit()
+    if args_daq.mode == 'cache':
+        # Several processes can split the shards with RANK/WORLD_SIZE, e.g. under torchrun
+        from utils.imagenet_cache import build_imagenet_cache, get_cache_dir
+        for split in ['val', 'train']:
+            build_imagenet_cache(os.path.join(args_daq.imagenet, split), get_cache_dir(args_daq, split),
+                                 workers=args_daq.worker, rank=int(os.environ.get('RANK', 0)),
+                                 world_size=int(os.environ.get('WORLD_SIZE', 1)))
+        exit()
+
     data_loaders = get_data_loaders(args_daq)
+    if args_daq.mode == 'kselect':
+        from Clustering.multi_k import select_num_clusters
+        select_num_clusters(args_daq, arch, data_loaders)
+        exit()
+
     clustering_model = None
     if args_daq.cluster > 1:
         from Clustering import get_clustering_model
@@ -1,3 +1,5 @@
+import os
+
 import torch
 import torch.backends.cudnn as cudnn
 from torchsummary import summary
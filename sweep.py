@@ -0,0 +1,193 @@
+import argparse
+import itertools
+import json
+import os
+import traceback
+import multiprocessing as mp
+from datetime import datetime
+
+import utils.misc as misc
+from utils.torch_dataset import get_data_loaders
+from utils.results_db import ResultStore
+from main import parser as daq_parser, parse_daq_args
+from QAT.qat import parser as qat_parser, parse_qat_args, main as qat_main
+
+
+# Arguments that change what get_data_loaders builds, and what a clustering model is trained with
+DATA_KEYS = ('dataset', 'imagenet', 'imagenet_cache', 'tensor_dataset', 'batch', 'val_batch', 'worker')
+CLUSTERING_KEYS = ('clustering_method', 'dataset', 'cluster', 'sub_cluster', 'partition', 'partition_method',
+                   'repr_method', 'similarity_method', 'topk', 'sim_threshold', 'nnac', 'exclude', 'mixrate',
+                   'kmeans_epoch', 'kmeans_tol', 'kmeans_init', 'clustering_path')
+
+parser = argparse.ArgumentParser(description='[PyTorch] Sweep of DAQ experiments in one process')
+parser.add_argument('spec', type=str,
+                    help='JSON grid spec, e.g. {"name": "r20", "base": {"arch": "resnet20", "dataset": "cifar10"}, '
+                         '"grid": {"cluster": [2, 4], "bit": [4, 8]}, "repeat": 5}')
+parser.add_argument('--db', default='sweep_results.db', type=str, help='SQLite file of results')
+parser.add_argument('--gpus', default='', type=str,
+                    help='Comma-separated GPUs to run configs on in parallel, one worker process per GPU. '
+                         'Empty runs configs back-to-back in this process')
+parser.add_argument('--rerun', action='store_true', help='Run configs again even if the store has them done')
+parser.add_argument('--summary', action='store_true', help="Print min/max/mean/std of the sweep's configs and exit")
+
+
+def expand_grid(spec):
+    """ Every combination of the grid's values on top of base, in the grid's key order """
+    base, grid = spec.get('base', {}), spec.get('grid', {})
+    keys = list(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        config = dict(base)
+        config.update(zip(keys, values))
+        configs.append(config)
+    return configs
+
+
+def to_argv(config):
+    actions = {}
+    for p in (daq_parser, qat_parser):
+        for action in p._actions:
+            for option in action.option_strings:
+                actions[option] = action
+
+    argv = []
+    for key, value in config.items():
+        option = '--' + key
+        assert option in actions, "Unknown argument in sweep spec: {}".format(key)
+        if isinstance(actions[option], argparse._StoreTrueAction):
+            if value:
+                argv.append(option)
+        else:
+            # type=bool arguments are False only for an empty string
+            argv += [option, '' if value is False else str(value)]
+    return argv
+
+
+class SharedResources(object):
+    """ Data loaders, clustering models and pretrained checkpoints kept across the configs run in a process """
+    def __init__(self):
+        self.data_loaders = {}
+        self.clustering_models = {}
+        misc.checkpoint_cache = {}
+
+    def get_data_loaders(self, args):
+        with_clustering_data = args.cluster > 1 and not args.clustering_path
+        key = tuple(getattr(args, k) for k in DATA_KEYS) + (args.mode == 'eval', with_clustering_data)
+        if key not in self.data_loaders:
+            self.data_loaders[key] = get_data_loaders(args)
+        return self.data_loaders[key]
+
+    def get_clustering_model(self, args, args_qat, arch, data_loaders):
+        if args.cluster <= 1:
+            return None
+        key = tuple(getattr(args, k) for k in CLUSTERING_KEYS)
+        if args.nnac:
+            # NN-aware clustering merges clusters with the pretrained model
+            key += (arch, args_qat.arch, args_qat.dnn_path)
+
+        if key not in self.clustering_models:
+            from Clustering import get_clustering_model
+            if not args.clustering_path:
+                args.clustering_path = misc.set_clustering_dir(args, arch)
+                self.clustering_models[key] = get_clustering_model(args, data_loaders)
+            else:
+                self.clustering_models[key] = get_clustering_model(args)
+        clustering_model = self.clustering_models[key]
+        args.clustering_path = clustering_model.args.clustering_path
+        # Same clustering, but InputContainer & co. read batch sizes etc. of the current run
+        clustering_model.args = args
+        return clustering_model
+
+
+def run_config(resources, config):
+    argv = to_argv(config)
+    args_daq, arch = parse_daq_args(argv)
+    args_qat = parse_qat_args(argv)
+    assert args_daq.quant_base == 'qat', "Sweeps run QAT fine-tuning/PTQ in process, HAWQ keeps global state"
+
+    data_loaders = resources.get_data_loaders(args_daq)
+    clustering_model = resources.get_clustering_model(args_daq, args_qat, arch, data_loaders)
+    results = qat_main(args_daq, data_loaders, clustering_model, args_qat)
+    return results, dict(vars(args_qat), **vars(args_daq))
+
+
+def run_task(resources, task):
+    config, overrides, repeat = task
+    started = datetime.now().isoformat(timespec='seconds')
+    try:
+        results, args = run_config(resources, dict(config, **overrides))
+        return config, repeat, started, args, results, None
+    except Exception:
+        return config, repeat, started, None, None, traceback.format_exc()
+
+
+worker_resources = None
+
+
+def init_worker(gpu_queue):
+    global worker_resources
+    os.environ['CUDA_VISIBLE_DEVICES'] = gpu_queue.get()
+    worker_resources = SharedResources()
+
+
+def run_in_worker(task):
+    return run_task(worker_resources, task)
+
+
+def fit_clustering_models(resources, tasks):
+    """ Trains each distinct clustering model once, before configs sharing it are spread over workers """
+    for config, overrides, _ in tasks:
+        argv = to_argv(config)
+        args_daq, arch = parse_daq_args(argv)
+        if args_daq.cluster > 1 and not args_daq.clustering_path and not args_daq.nnac:
+            data_loaders = resources.get_data_loaders(args_daq)
+            resources.get_clustering_model(args_daq, parse_qat_args(argv), arch, data_loaders)
+            overrides['clustering_path'] = args_daq.clustering_path
+
+
+def sweep(args):
+    with open(args.spec, 'r') as f:
+        spec = json.load(f)
+    name = spec.get('name', os.path.splitext(os.path.basename(args.spec))[0])
+    store = ResultStore(args.db)
+
+    if args.summary:
+        for row in store.summary(name):
+            print(json.dumps(row['config'], sort_keys=True))
+            print('runs: {}, min: {:.2f}, max: {:.2f}, mean: {:.2f}, std: {:.4f}\n'
+                  .format(row['runs'], row['min'], row['max'], row['mean'], row['std']))
+        store.close()
+        return
+
+    tasks = [(config, {}, r) for config in expand_grid(spec) for r in range(spec.get('repeat', 1))]
+    if not args.rerun:
+        tasks = [t for t in tasks if not store.is_done(name, t[0], t[2])]
+    print('Sweep {}: {} runs to go'.format(name, len(tasks)))
+
+    def record(result):
+        config, repeat, started, run_args, results, error = result
+        store.add(name, config, repeat, run_args, started, results, error)
+        if error:
+            print('Failed: {}\n{}'.format(json.dumps(config, sort_keys=True), error))
+
+    resources = SharedResources()
+    gpus = [g for g in args.gpus.split(',') if g]
+    if len(gpus) > 1:
+        fit_clustering_models(resources, tasks)
+        ctx = mp.get_context('spawn')
+        gpu_queue = ctx.Queue()
+        for g in gpus:
+            gpu_queue.put(g)
+        with ctx.Pool(len(gpus), initializer=init_worker, initargs=(gpu_queue,)) as pool:
+            for result in pool.imap_unordered(run_in_worker, tasks):
+                record(result)
+    else:
+        if gpus:
+            os.environ['CUDA_VISIBLE_DEVICES'] = gpus[0]
+        for task in tasks:
+            record(run_task(resources, task))
+    store.close()
+
+
+if __name__ == '__main__':
+    sweep(parser.parse_args())
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import torch
+
+from utils.misc import RuntimeHelper
+
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def get_arg_dict(cluster=1, bit=8, device=DEVICE, **kwargs):
+    """ Arguments of QAT's model initializers as qat.py sets them, with a RuntimeHelper on device """
+    runtime_helper = RuntimeHelper()
+    runtime_helper.set_pcq_arguments(SimpleNamespace(cluster=cluster, val_batch=8), device)
+    arg_dict = {'arch': 'resnet20', 'dataset': 'cifar10', 'cluster': cluster, 'bit': bit, 'bit_first': 8,
+                'bit_classifier': 8, 'bit_addcat': 16, 'bit_conv_act': 16, 'bit_bn_w': 16, 'smooth': 0.99,
+                'per_channel': False, 'symmetric': False, 'fold_convbn': False, 'ste': True, 'quant_noise': False,
+                'qn_prob': 0.0, 'qn_each_channel': True, 'bn_momentum': 0.1, 'act_checkpoint': False,
+                'memory_efficient': False, 'val_batch': 8, 'runtime_helper': runtime_helper}
+    arg_dict.update(kwargs)
+    return arg_dict, runtime_helper
+
+
+def set_batch_cluster(runtime_helper, cluster, device=DEVICE):
+    runtime_helper.batch_cluster = cluster
+    runtime_helper.qat_batch_cluster = torch.tensor(cluster, dtype=torch.int64, device=device)
+
+
+class RuleClustering(object):
+    """ Stand-in for a trained clustering model: cluster from the sign of per-channel means of a batch """
+    def __init__(self, num_clusters, dataset='cifar10', batch=8, val_batch=8):
+        self.num_clusters = num_clusters
+        self.args = SimpleNamespace(dataset=dataset, batch=batch, val_batch=val_batch, quant_base='qat')
+
+    def predict_cluster_of_batch(self, images):
+        means = images.mean(dim=(2, 3))
+        return ((means[:, 0] > 0).long() + 2 * (means[:, 1] > 0).long()) % self.num_clusters
+
+
+def get_random_dataset(n_data=64, n_classes=10, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.randn(n_data, 3, 32, 32, generator=generator)
+    targets = torch.randint(0, n_classes, (n_data,), generator=generator)
+    return torch.utils.data.TensorDataset(images, targets)
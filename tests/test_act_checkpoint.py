@@ -0,0 +1,40 @@
+"""
+    Activation checkpointing doesn't change training: gradients, ranges and BN statistics of a training step
+    are the same with and without --act_checkpoint.
+"""
+import pytest
+import torch
+
+from QAT.models.fused_resnet import fused_resnet20
+from QAT.models.pcq_resnet import pcq_resnet20
+from tests.common import DEVICE, get_arg_dict, get_random_dataset, set_batch_cluster
+
+
+def train_step(num_clusters, act_checkpoint, fake_quantization):
+    torch.manual_seed(0)
+    arg_dict, runtime_helper = get_arg_dict(num_clusters, act_checkpoint=act_checkpoint)
+    model = (pcq_resnet20 if num_clusters > 1 else fused_resnet20)(arg_dict).to(DEVICE)
+    model.train()
+    images, targets = get_random_dataset(8).tensors
+    set_batch_cluster(runtime_helper, num_clusters - 1)
+    for apply in sorted({False, fake_quantization}):
+        # The first step initializes the ranges
+        runtime_helper.apply_fake_quantization = apply
+        model.zero_grad()
+        torch.nn.functional.cross_entropy(model(images.to(DEVICE)), targets.to(DEVICE)).backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+    return grads, model.state_dict()
+
+
+def check_act_checkpoint(num_clusters, fake_quantization=True):
+    grads, state = train_step(num_clusters, False, fake_quantization)
+    ckpt_grads, ckpt_state = train_step(num_clusters, True, fake_quantization)
+    same_grads = grads.keys() == ckpt_grads.keys() and all(torch.allclose(grads[k], ckpt_grads[k]) for k in grads)
+    same_state = all(torch.equal(state[k], ckpt_state[k]) for k in state)
+    return same_grads, same_state
+
+
+@pytest.mark.parametrize('num_clusters', [1, 2], ids=['fused', 'pcq'])
+def test_act_checkpoint(num_clusters):
+    assert check_act_checkpoint(num_clusters) == (True, True)
+
@@ -0,0 +1,76 @@
+"""
+    Integer average pooling against the float pooling the quantized models used before:
+    floor of nn.AvgPool2d/nn.AdaptiveAvgPool2d (ResNet, AlexNet), and their cast to int (trunc, DenseNet).
+    The float expressions are exact only while window sums fit in float32's mantissa: 16-bit codes on maps larger
+    than the models' (e.g. 25x25) show where the float pooling was off, not the integer one.
+"""
+import pytest
+import torch
+import torch.nn as nn
+
+from QAT.models.layers.avgpool2d import QuantizedAvgPool2d, QuantizedAdaptiveAvgPool2d
+from QAT.models.quantization_utils import get_code_range
+from tests.common import get_arg_dict
+
+
+def get_pools(rounding):
+    """ (Integer, float) pools of the configurations the quantized models use """
+    arg_dict, _ = get_arg_dict()
+    pools = [(QuantizedAdaptiveAvgPool2d((1, 1), rounding=rounding, arg_dict=arg_dict), nn.AdaptiveAvgPool2d((1, 1))),
+             (QuantizedAdaptiveAvgPool2d((6, 6), rounding=rounding, arg_dict=arg_dict), nn.AdaptiveAvgPool2d((6, 6))),
+             (QuantizedAvgPool2d(2, stride=2, rounding=rounding, arg_dict=arg_dict), nn.AvgPool2d(2, stride=2)),
+             (QuantizedAvgPool2d(8, stride=1, rounding=rounding, arg_dict=arg_dict), nn.AvgPool2d(8, stride=1))]
+    return pools
+
+
+def old_pooling(pool, x, rounding):
+    out = pool(x.float())
+    return out.floor() if rounding == 'floor' else out.type(torch.int32).float()
+
+
+def check_avgpool(bit, max_size=14, dtype=torch.int32, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    qmin, qmax = get_code_range(bit)
+    mismatches = []
+    for rounding in ('floor', 'trunc'):
+        for int_pool, float_pool in get_pools(rounding):
+            kernel = getattr(int_pool, 'kernel_size', 1)
+            for size in range(kernel, max_size + 1):
+                x = torch.randint(qmin, qmax + 1, (4, 3, size, size), generator=generator).type(dtype)
+                # Extremes of the code range, where float rounding of the mean would show first
+                x[0].fill_(qmax)
+                x[1].fill_(qmin)
+                if not torch.equal(int_pool(x).float(), old_pooling(float_pool, x, rounding)):
+                    mismatches.append((rounding, int_pool.layer_type, kernel, size))
+    return mismatches
+
+
+@pytest.mark.parametrize('bit, dtype', [(4, torch.int32), (8, torch.int32), (16, torch.int32), (8, torch.int64)])
+def test_avgpool_floor_and_trunc(bit, dtype):
+    assert check_avgpool(bit, dtype=dtype) == []
+
+
+def test_avgpool_round_per_cluster_zero_points():
+    """ MobileNet's global pooling: mean of codes less the cluster's zero-point, halves rounded away from it """
+    generator = torch.Generator().manual_seed(0)
+    arg_dict, runtime_helper = get_arg_dict(cluster=3)
+    pool = QuantizedAdaptiveAvgPool2d(1, rounding='round', arg_dict=arg_dict)
+    pool.zero_point.data = torch.tensor([0, 100, 255], dtype=torch.int32)
+    for size in (2, 3, 7):
+        x = torch.randint(0, 256, (6, 4, size, size), generator=generator, dtype=torch.int32)
+        # Means exactly halfway between codes on both sides of the zero-points
+        x[:, 0] = 0
+        x[:, 0, 0, 0] = size * size // 2 if size % 2 == 0 else 0
+        x[:, 1] = 100
+        x[:, 1, 0, 0] = 100 - (size * size // 2 if size % 2 == 0 else 0)
+        for clusters in (torch.tensor([0, 1, 2, 2, 1, 0]), torch.tensor(1)):
+            runtime_helper.qat_batch_cluster = clusters
+            z = pool.zero_point[clusters.reshape(-1)].double().reshape(-1, 1, 1, 1)
+            mean = (x.double() - z).mean(dim=(2, 3), keepdim=True)
+            expected = mean.sign() * (mean.abs() + 0.5).floor() + z
+            assert torch.equal(pool(x).double(), expected.expand(x.size(0), -1, -1, -1))
+
+    runtime_helper.qat_batch_cluster = None
+    with pytest.raises(AssertionError):
+        pool(x)
+
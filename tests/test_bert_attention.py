@@ -0,0 +1,71 @@
+"""
+    Integer BERT self-attention with per-sample clusters gives, for each sample, the output of a one-cluster
+    attention quantized with that cluster's qparams.
+"""
+import torch
+
+from QAT.models.bert.fused_bert import FusedBertSelfAttention
+from QAT.models.bert.quantized_bert import BertConfig, QuantizedBertSelfAttention, quantize_self_attention
+from tests.common import get_arg_dict
+
+
+PER_CLUSTER = {'qkv': ('s1', 'z1', 's3', 'z3', 'M0', 'shift', 'quantized_bias'),
+               '': ('exp_up', 'exp_ln2', 'exp_ln2_inv', 'exp_b', 'exp_c', 's3', 'z3', 'M0', 'shift')}
+
+
+def quantize_per_cluster(config, ranges, seed=0):
+    """ One-cluster attentions quantized with each cluster's ranges, from the same FP weights """
+    arg_dict, _ = get_arg_dict(1, device='cpu')
+    torch.manual_seed(seed)
+    fp = FusedBertSelfAttention(config, arg_dict)
+    attentions = []
+    for in_range, qkv_range, out_range in ranges:
+        for layer in (fp.query, fp.key, fp.value):
+            layer.act_range.data = torch.tensor(qkv_range)
+        fp.act_range.data = torch.tensor(out_range)
+        s1 = torch.tensor((in_range[1] - in_range[0]) / 255)
+        fp.set_qparams(s1, torch.round(-in_range[0] / s1).int())
+        attentions.append(quantize_self_attention(fp, QuantizedBertSelfAttention(config, arg_dict)))
+    return attentions
+
+
+def stack_clusters(config, attentions):
+    arg_dict, runtime_helper = get_arg_dict(len(attentions), device='cpu')
+    pcq = QuantizedBertSelfAttention(config, arg_dict)
+    pcq.load_state_dict({k: v for k, v in attentions[0].state_dict().items() if k in pcq.state_dict()
+                         and v.shape == pcq.state_dict()[k].shape}, strict=False)
+    with torch.no_grad():
+        for prefix, names in PER_CLUSTER.items():
+            module = pcq.get_submodule(prefix)
+            for name in names:
+                params = [getattr(a.get_submodule(prefix), name) for a in attentions]
+                getattr(module, name).data = torch.cat([p.reshape(1, *p.shape[1:]) if p.dim() else p.reshape(1)
+                                                        for p in params])
+        pcq.qkv.is_shift_neg.data = torch.tensor(any(bool(a.qkv.is_shift_neg) for a in attentions))
+    return pcq, runtime_helper
+
+
+def test_self_attention_per_sample_clusters():
+    config = BertConfig(100, hidden_size=32, num_attention_heads=4, intermediate_size=64)
+    ranges = [((-2.0, 2.0), (-1.5, 1.0), (-0.5, 0.6)), ((-3.0, 1.0), (-0.8, 2.5), (-0.3, 0.9))]
+    attentions = quantize_per_cluster(config, ranges)
+    pcq, runtime_helper = stack_clusters(config, attentions)
+    assert not torch.equal(attentions[0].M0, attentions[1].M0)
+
+    generator = torch.Generator().manual_seed(0)
+    batch, seq = 4, 6
+    hidden = torch.randint(0, 256, (batch, seq, config.hidden_size), generator=generator)
+    mask = torch.ones(batch, 1, 1, seq, dtype=torch.bool)
+    mask[1, ..., 4:] = False
+    clusters = torch.tensor([0, 1, 1, 0])
+
+    with torch.no_grad():
+        runtime_helper.qat_batch_cluster = clusters
+        out = pcq(hidden, mask)
+        assert runtime_helper.qat_batch_cluster is clusters
+        expected = torch.cat([attentions[c](hidden[i:i + 1], mask[i:i + 1]) for i, c in enumerate(clusters.tolist())])
+        assert torch.equal(out, expected)
+
+        # One cluster for the whole batch, as QAT's per-cluster batches set it
+        runtime_helper.qat_batch_cluster = torch.tensor(1)
+        assert torch.equal(pcq(hidden, mask), attentions[1](hidden, mask))
@@ -0,0 +1,29 @@
+"""
+    BIRCH's features of a batch, the min/max of each part of each channel, against slicing the parts one by one.
+"""
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from Clustering.birch import BIRCH
+
+
+def get_parts_by_slicing(data, partition):
+    n_part = partition // 2 if partition % 2 == 0 else partition // 3
+    n_data = data.size(-1) // n_part
+    features = []
+    for i in range(n_part):
+        for j in range(n_part):
+            part = data[:, :, n_data * i:n_data * (i + 1), n_data * j:n_data * (j + 1)].flatten(2)
+            features.append(torch.stack([part.min(-1).values, part.max(-1).values], dim=-1))
+    return torch.stack(features, dim=2).reshape(data.size(0), -1).numpy()
+
+
+@pytest.mark.parametrize('partition, size', [(2, 32), (4, 32), (9, 32), (16, 32), (16, 30), (4, 29), (36, 224)])
+def test_partitioned_batch(partition, size):
+    generator = torch.Generator().manual_seed(0)
+    data = torch.randn(4, 3, size, size, generator=generator)
+    birch = BIRCH(SimpleNamespace(partition=partition))
+    features, expected = birch.get_partitioned_batch(data), get_parts_by_slicing(data, partition)
+    assert features.shape == expected.shape and (features == expected).all()
@@ -0,0 +1,119 @@
+"""
+    --channels_last gives the same results as NCHW on the fused/PCQ ResNet-20.
+    Float convolutions and BN accumulate in a layout-dependent order, so FP outputs are compared with a tolerance.
+    What is computed from tensors' values is compared bit-exactly: range updates of a fake-quantized training
+    forward (replayed on the same activations in channels_last), qparams, and the integer model and its logits.
+"""
+import pytest
+import torch
+
+from QAT.models.fused_resnet import fused_resnet20
+from QAT.models.pcq_resnet import pcq_resnet20
+from QAT.models.quantized_resnet import quantized_resnet20, quantize_pcq_resnet
+from tests.common import DEVICE, get_arg_dict, get_random_dataset, set_batch_cluster
+
+
+RANGE_UPDATES = ('_update_activation_ranges', '_update_activation_range', '_update_input_ranges')
+QPARAMS = ('s1', 'z1', 's2', 'z2', 's3', 'z3', 'M0', 'shift', 's_target', 'z_target')
+
+
+def is_same_state(a, b):
+    a, b = a.state_dict(), b.state_dict()
+    return a.keys() == b.keys() and all(torch.equal(a[k], b[k]) for k in a)
+
+
+def is_same_qparams(a, b):
+    for m, nhwc_m in zip(a.modules(), b.modules()):
+        for name in QPARAMS:
+            q, nhwc_q = getattr(m, name, None), getattr(nhwc_m, name, None)
+            if isinstance(q, torch.Tensor) and not torch.equal(q, nhwc_q):
+                return False
+    return True
+
+
+def forward(model, runtime_helper, images, memory_format, cluster=0):
+    images = images.to(DEVICE).contiguous(memory_format=memory_format)
+    if runtime_helper.num_clusters > 1:
+        set_batch_cluster(runtime_helper, cluster)
+    return model(images)
+
+
+def record_range_updates(model):
+    """ Wraps the range updates of the model's modules to record their inputs """
+    recorded = []
+    for name, m in model.named_modules():
+        for attr in RANGE_UPDATES:
+            if hasattr(m, attr):
+                def update(x, _update=getattr(m, attr), _key=(name, attr)):
+                    recorded.append((_key, x.detach().clone()))
+                    return _update(x)
+                setattr(m, attr, update)
+    return recorded
+
+
+def replay_range_updates(model, recorded):
+    """ Runs the recorded range updates on the model, with 4D inputs in channels_last """
+    modules = dict(model.named_modules())
+    for (name, attr), x in recorded:
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+            assert not x.is_contiguous()
+        getattr(modules[name], attr)(x)
+
+
+def check_channels_last(num_clusters, per_channel=False):
+    arg_dict, runtime_helper = get_arg_dict(num_clusters, per_channel=per_channel)
+    initializer = pcq_resnet20 if num_clusters > 1 else fused_resnet20
+    torch.manual_seed(0)
+    model = initializer(arg_dict).to(DEVICE)
+    images, _ = get_random_dataset(16).tensors
+    model.train()
+    with torch.no_grad():
+        # Initializes the ranges of every cluster
+        for c in range(num_clusters):
+            forward(model, runtime_helper, images[:8], torch.contiguous_format, c)
+    runtime_helper.apply_fake_quantization = True
+    nhwc_model = initializer(arg_dict).to(DEVICE, memory_format=torch.channels_last)
+    nhwc_model.load_state_dict(model.state_dict())
+    nhwc_model.train()
+
+    result = {}
+    with torch.no_grad():
+        out = forward(model, runtime_helper, images[8:], torch.contiguous_format)
+        nhwc_out = forward(nhwc_model, runtime_helper, images[8:], torch.channels_last)
+        # Fake quantization turns float differences into a step of the activations' scale at most
+        result['fp_output'] = torch.allclose(out, nhwc_out, atol=0.05)
+
+        # Range updates on the same activations, in either format.
+        # Fused layers update ranges with the tensor-wide min/max instead, which has no layout-dependent code
+        nhwc_model.load_state_dict(model.state_dict())
+        recorded = record_range_updates(model)
+        forward(model, runtime_helper, images[8:], torch.contiguous_format)
+        if num_clusters > 1:
+            replay_range_updates(nhwc_model, recorded)
+            state, nhwc_state = model.state_dict(), nhwc_model.state_dict()
+            result['fp_ranges'] = len(recorded) > 0 and all(torch.equal(state[k], nhwc_state[k]) for k in state
+                                                            if k.rsplit('.', 1)[-1] in ('act_range', 'in_range'))
+
+        # The same weights and BN statistics, kept in channels_last
+        nhwc_model.load_state_dict(model.state_dict())
+        model.eval(), nhwc_model.eval()
+        model.set_quantization_params()
+        nhwc_model.set_quantization_params()
+        result['qparams'] = is_same_qparams(model, nhwc_model)
+
+        int_model = quantize_pcq_resnet(model, quantized_resnet20(arg_dict).to(DEVICE))
+        nhwc_int_model = quantized_resnet20(arg_dict).to(DEVICE, memory_format=torch.channels_last)
+        nhwc_int_model = quantize_pcq_resnet(nhwc_model, nhwc_int_model)
+        result['int_model'] = is_same_state(int_model, nhwc_int_model)
+        int_model.eval(), nhwc_int_model.eval()
+        result['int_output'] = torch.equal(forward(int_model, runtime_helper, images, torch.contiguous_format),
+                                           forward(nhwc_int_model, runtime_helper, images, torch.channels_last))
+    return result
+
+
+@pytest.mark.parametrize('num_clusters, per_channel', [(1, False), (2, False), (2, True)],
+                         ids=['fused', 'pcq', 'pcq_per_channel'])
+def test_channels_last(num_clusters, per_channel):
+    assert all(check_channels_last(num_clusters, per_channel).values())
+
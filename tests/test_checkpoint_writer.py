@@ -0,0 +1,52 @@
+"""
+    AsyncCheckpointWriter writes the state as it is at save(), including writes through .data between saves,
+    which don't bump tensors' versions, like quantize_conv2d_weight and sync_cluster_states make.
+"""
+import os
+import tempfile
+
+import torch
+
+from QAT.models.pcq_resnet import pcq_resnet20
+from utils.checkpoint_writer import AsyncCheckpointWriter
+from tests.common import get_arg_dict
+
+
+def is_same_state(a, b):
+    return a.keys() == b.keys() and all(torch.equal(a[k], b[k]) for k in a)
+
+
+def test_checkpoint_writer_data_writes():
+    arg_dict, _ = get_arg_dict(2, device='cpu')
+    model = pcq_resnet20(arg_dict)
+    writer = AsyncCheckpointWriter()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'checkpoint.pth')
+        for epoch in range(3):
+            with torch.no_grad():
+                for t in model.state_dict(keep_vars=True).values():
+                    if t.dtype != torch.bool:
+                        t.data.copy_(t + 1)
+            expected = {k: v.clone() for k, v in model.state_dict().items()}
+            writer.save({'state_dict': model.state_dict(), 'epoch': epoch}, path)
+            writer.wait()
+            saved = torch.load(path)
+            assert saved['epoch'] == epoch
+            assert is_same_state(saved['state_dict'], expected)
+    writer.close()
+
+
+def test_checkpoint_writer_in_place_writes_after_save():
+    weight = torch.zeros(4, 4)
+    writer = AsyncCheckpointWriter()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'checkpoint.pth')
+        writer.save({'weight': weight}, path)
+        # Writes after save() are not in the snapshot
+        weight.data.fill_(1)
+        writer.wait()
+        assert torch.equal(torch.load(path)['weight'], torch.zeros(4, 4))
+        writer.save({'weight': weight}, path)
+        writer.wait()
+        assert torch.equal(torch.load(path)['weight'], torch.ones(4, 4))
+    writer.close()
@@ -0,0 +1,52 @@
+"""
+    get_data_loaders gives the same loaders with --tensor_dataset as without: a non-augmented training loader
+    for clustering (kselect, or PCQ without a trained clustering model), and the test loader only in eval mode.
+"""
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+import utils.torch_dataset as torch_dataset
+from utils.torch_dataset import get_data_loaders
+
+
+def get_args(**kwargs):
+    args = {'dataset': 'cifar10', 'tensor_dataset': False, 'imagenet_cache': False, 'mode': 'fine', 'cluster': 1,
+            'clustering_path': '', 'batch': 8, 'val_batch': 8, 'worker': 0}
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+@pytest.fixture
+def random_cifar(monkeypatch):
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randint(0, 256, (16, 3, 32, 32), dtype=torch.uint8, generator=generator)
+    targets = torch.randint(0, 10, (16,), generator=generator)
+    dataset = torch.utils.data.TensorDataset(images.float(), targets)
+    monkeypatch.setattr(torch_dataset, 'get_tensor_dataset', lambda args, train=True: (images, targets))
+    for name in ('get_test_dataset', 'get_augmented_train_dataset', 'get_non_augmented_train_dataset'):
+        monkeypatch.setattr(torch_dataset, name, lambda args, normalizer: dataset)
+
+
+@pytest.mark.parametrize('tensor_dataset', [False, True])
+@pytest.mark.parametrize('mode, cluster, clustering_path, clustering_loader', [
+    ('kselect', 1, '', True),
+    ('fine', 4, '', True),
+    ('fine', 4, 'clustering', False),
+    ('fine', 1, '', False),
+])
+def test_clustering_train_loader(random_cifar, tensor_dataset, mode, cluster, clustering_path, clustering_loader):
+    args = get_args(tensor_dataset=tensor_dataset, mode=mode, cluster=cluster, clustering_path=clustering_path)
+    loaders = get_data_loaders(args)
+    assert set(loaders) == {'aug_train', 'test', 'non_aug_train'}
+    assert (loaders['non_aug_train'] is not None) == clustering_loader
+    if clustering_loader:
+        images, _ = next(iter(loaders['non_aug_train']))
+        assert images.shape[1:] == (3, 32, 32)
+
+
+@pytest.mark.parametrize('tensor_dataset', [False, True])
+def test_eval_gives_test_loader(random_cifar, tensor_dataset):
+    loader = get_data_loaders(get_args(tensor_dataset=tensor_dataset, mode='eval'))
+    assert sum(target.size(0) for _, target in loader) == 16
@@ -0,0 +1,88 @@
+"""
+    Models built without random initializations (DeferredInit, build_from_state_dict, map_checkpoint) are the same
+    as models built normally: FP models loaded from a checkpoint, fused/PCQ models made by the fusers or loaded
+    from a fused checkpoint, and models written through .data, which doesn't bump tensors' versions.
+"""
+import os
+import tempfile
+
+import pytest
+import torch
+import torchvision
+
+from QAT.registry import get_model_tools
+from utils.misc import DeferredInit, build_from_state_dict, map_checkpoint
+from tests.common import get_arg_dict
+
+
+def get_initializers(arch, variant):
+    tools = get_model_tools(arch, variant)
+    arg_dict, _ = get_arg_dict(2 if variant == 'pcq' else 1, device='cpu', arch=arch.lower())
+    # load_dnn_model builds torchvision's DenseNet-121 as the FP model
+    fp_initializer = tools.pretrained_model_initializer or torchvision.models.densenet121
+    return fp_initializer, lambda: tools.fused_model_initializer(arg_dict), tools.fuser
+
+
+def diff_states(a, b):
+    a, b = a.state_dict(), b.state_dict()
+    return sorted(set(a) ^ set(b)) + [k for k in a if k in b and not torch.equal(a[k], b[k])]
+
+
+def save_checkpoint(model, path):
+    torch.save({'state_dict': model.state_dict()}, path)
+    return path
+
+
+def check_deferred_init(arch, variant):
+    fp_initializer, fused_initializer, fuser = get_initializers(arch, variant)
+    diffs = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        torch.manual_seed(0)
+        fp_path = save_checkpoint(fp_initializer(), os.path.join(tmp, 'fp.pth'))
+
+        torch.manual_seed(1)
+        fp_model = fp_initializer()
+        fp_model.load_state_dict(torch.load(fp_path)['state_dict'])
+        torch.manual_seed(2)
+        fused_model = fuser(fused_initializer(), fp_model)
+        fused_path = save_checkpoint(fused_model, os.path.join(tmp, 'fused.pth'))
+
+        # FP model made of the checkpoint's tensors, and built under DeferredInit then loaded
+        meta_fp_model = build_from_state_dict(fp_initializer, map_checkpoint(fp_path)['state_dict'])
+        diffs['fp_from_state_dict'] = diff_states(fp_model, meta_fp_model) if meta_fp_model is not None else ['None']
+        deferred = DeferredInit()
+        with deferred:
+            deferred_fp_model = fp_initializer()
+        deferred_fp_model.load_state_dict(map_checkpoint(fp_path)['state_dict'])
+        deferred.materialize()
+        diffs['fp_deferred'] = diff_states(fp_model, deferred_fp_model)
+
+        # Fused model from the fuser, and from the fused checkpoint
+        with deferred:
+            deferred_fused_model = fused_initializer()
+        deferred_fused_model = fuser(deferred_fused_model, deferred_fp_model)
+        deferred.materialize()
+        diffs['fused_from_fuser'] = diff_states(fused_model, deferred_fused_model)
+        with deferred:
+            deferred_fused_model = fused_initializer()
+        deferred_fused_model.load_state_dict(map_checkpoint(fused_path)['state_dict'])
+        deferred.materialize()
+        diffs['fused_from_checkpoint'] = diff_states(fused_model, deferred_fused_model)
+
+        # A fuser writing through .data
+        with deferred:
+            deferred_fused_model = fused_initializer()
+        state = fused_model.state_dict()
+        for name, t in deferred_fused_model.state_dict(keep_vars=True).items():
+            t.data.copy_(state[name])
+        deferred.materialize()
+        diffs['fused_through_data'] = diff_states(fused_model, deferred_fused_model)
+    return diffs
+
+
+@pytest.mark.parametrize('variant', ['fused', 'pcq'])
+@pytest.mark.parametrize('arch', ['ResNet20', 'DenseNet121'])
+def test_deferred_init(arch, variant):
+    diffs = check_deferred_init(arch, variant)
+    assert all(not diff for diff in diffs.values()), diffs
+
@@ -0,0 +1,130 @@
+"""
+    DDP PCQ fine-tuning on CPU with gloo, in local processes:
+    every rank ends the epoch with the same weights, activation ranges and BN statistics,
+    and rank 0 validates the FP and integer models on CPU like QAT's fine-tuning does.
+"""
+import logging
+import os
+import socket
+import tempfile
+from types import SimpleNamespace
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from QAT.models.pcq_resnet import pcq_resnet20
+from QAT.models.quantized_resnet import quantized_resnet20, quantize_pcq_resnet
+from QAT.models.quantization_utils import IncrementalQuantizer
+import utils.distributed
+from utils.distributed import ClusterDistributedBatchSampler, ClusterLabeledDataset, ddp_pcq_epoch, wrap_ddp_model, \
+    get_train_clusters
+from utils.misc import pcq_validate
+from tests.common import get_arg_dict, get_random_dataset, RuleClustering
+
+
+NUM_CLUSTERS = 2
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def flatten_state(model):
+    return torch.cat([t.detach().reshape(-1).double() for t in model.state_dict().values() if t.is_floating_point()])
+
+
+def run_rank(rank, world_size, port, result_path, act_checkpoint=False):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank, world_size=world_size)
+    device = torch.device('cpu')
+    torch.manual_seed(0)
+    arg_dict, runtime_helper = get_arg_dict(NUM_CLUSTERS, device='cpu', act_checkpoint=act_checkpoint)
+    model = pcq_resnet20(arg_dict)
+    ddp_model = wrap_ddp_model(model, device, find_unused_parameters=True)
+
+    clustering_model = RuleClustering(NUM_CLUSTERS)
+    train_dataset = get_random_dataset(64, seed=1)
+    clusters = clustering_model.predict_cluster_of_batch(train_dataset.tensors[0])
+    sampler = ClusterDistributedBatchSampler(clusters, NUM_CLUSTERS, 16 // world_size, num_replicas=world_size,
+                                             rank=rank, shuffle=True)
+    train_loader = torch.utils.data.DataLoader(ClusterLabeledDataset(train_dataset, clusters), batch_sampler=sampler)
+
+    criterion = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    logger = logging.getLogger('test_distributed')
+    for epoch in range(1, 3):
+        runtime_helper.apply_fake_quantization = epoch > 1
+        ddp_pcq_epoch(ddp_model, train_loader, criterion, optimizer, runtime_helper, epoch, logger, device=device)
+
+    state = flatten_state(model)
+    gathered = [torch.zeros_like(state) for _ in range(world_size)]
+    dist.all_gather(gathered, state)
+
+    result = {'same_state': all(torch.equal(gathered[0], g) for g in gathered)}
+    if rank == 0:
+        test_loader = torch.utils.data.DataLoader(get_random_dataset(32, seed=2), batch_size=8)
+        result['fp_score'] = pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper,
+                                          device=device)
+        model.set_quantization_params()
+        quantized_model = IncrementalQuantizer(quantize_pcq_resnet)(model, quantized_resnet20(arg_dict))
+        result['int_score'] = pcq_validate(quantized_model, clustering_model, test_loader, criterion, runtime_helper,
+                                           device=device)
+        torch.save(result, result_path)
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def run_ddp(world_size=2, act_checkpoint=False):
+    with tempfile.TemporaryDirectory() as tmp:
+        result_path = os.path.join(tmp, 'result.pt')
+        mp.spawn(run_rank, args=(world_size, get_free_port(), result_path, act_checkpoint), nprocs=world_size)
+        return torch.load(result_path)
+
+
+def test_ddp_pcq_epoch_on_cpu():
+    result = run_ddp(2)
+    assert result['same_state'], "Ranks diverged"
+    assert 0 <= result['fp_score'] <= 100 and 0 <= result['int_score'] <= 100
+
+
+def test_ddp_act_checkpoint_on_cpu():
+    # DDP finds unused parameters while blocks are checkpointed
+    result = run_ddp(2, act_checkpoint=True)
+    assert result['same_state'], "Ranks diverged"
+
+
+class CountingClustering(RuleClustering):
+    def __init__(self, num_clusters, sign=1):
+        super().__init__(num_clusters)
+        self.sign, self.n_predicted = sign, 0
+
+    def predict_cluster_of_batch(self, images):
+        self.n_predicted += images.size(0)
+        return super().predict_cluster_of_batch(images * self.sign)
+
+
+def test_train_clusters_cache_key(monkeypatch):
+    dataset = get_random_dataset(32)
+    monkeypatch.setattr(utils.distributed, 'get_non_augmented_train_dataset', lambda args, normalizer: dataset)
+    with tempfile.TemporaryDirectory() as tmp:
+        args = SimpleNamespace(clustering_path=tmp, dataset='cifar10', worker=0)
+        with open(os.path.join(tmp, 'checkpoint.pkl'), 'wb') as f:
+            f.write(b'clustering model 1')
+        model = CountingClustering(4)
+        clusters = get_train_clusters(args, model, len(dataset))
+        assert model.n_predicted == len(dataset)
+        # Cached for the same checkpoint and dataset
+        assert torch.equal(get_train_clusters(args, model, len(dataset)), clusters)
+        assert model.n_predicted == len(dataset)
+
+        # A retrained clustering model of the same size is predicted again
+        with open(os.path.join(tmp, 'checkpoint.pkl'), 'wb') as f:
+            f.write(b'clustering model 2')
+        model = CountingClustering(4, sign=-1)
+        new_clusters = get_train_clusters(args, model, len(dataset))
+        assert model.n_predicted == len(dataset)
+        assert torch.equal(new_clusters, model.predict_cluster_of_batch(dataset.tensors[0]))
+        assert not torch.equal(new_clusters, clusters)
+
@@ -0,0 +1,50 @@
+"""
+    Rounding of the NumPy runtime of HAWQ's ResNet against hand-computed values of the TVM graph's:
+    numpy's np.round/np.trunc for the input image (test_resnet_accuracy_imagenet.quantize_image),
+    relay's requantize rounding with get_net's TRUNCATE default, and UPWARD in qnn.add.
+    Scales are powers of two, so TVM's fixed-point multipliers are exact and the expected codes unambiguous.
+"""
+import numpy as np
+import pytest
+
+from HAWQ.tvm_benchmark.hawq_numpy_runtime import NumpyQuantizedResNet, QConfig, quantized_add
+
+
+IMAGE = np.array([0.5, 1.5, 2.5, -0.5, -2.5, 3.7, -3.7, 200.0, -200.0])
+REQUANTIZE_INPUT = np.array([5, -5, 3, -3, 7, 4, -300])
+
+
+def get_model(**kwargs):
+    qconfig_dict = {'conv0_qconfig': QConfig(input_scale=0.5), 'unit_qconfig': QConfig(input_scale=2.0)}
+    return NumpyQuantizedResNet({}, qconfig_dict, **kwargs)
+
+
+def quantize_image(model, image):
+    return model.quantize_image(image.reshape(1, 1, 1, -1).transpose(0, 3, 1, 2) * 0.5).reshape(-1)
+
+
+def test_image_rounding():
+    # Halves to even, as np.round, whatever the requantize rounding
+    expected = [0, 2, 2, 0, -2, 4, -4, 127, -128]
+    assert quantize_image(get_model(), IMAGE).tolist() == expected
+    assert quantize_image(get_model(rounding='TONEAREST'), IMAGE).tolist() == expected
+    assert quantize_image(get_model(image_rounding='TRUNCATE'), IMAGE).tolist() == [0, 1, 2, 0, -2, 3, -3, 127, -128]
+
+
+@pytest.mark.parametrize('rounding, expected', [
+    # x / 2 = 2.5, -2.5, 1.5, -1.5, 3.5, 2, -150, clipped to int8
+    (None, [2, -3, 1, -2, 3, 2, -128]),
+    ('TRUNCATE', [2, -3, 1, -2, 3, 2, -128]),
+    ('TONEAREST', [3, -3, 2, -2, 4, 2, -128]),
+    ('UPWARD', [3, -2, 2, -1, 4, 2, -128]),
+])
+def test_requantize_rounding(rounding, expected):
+    model = get_model() if rounding is None else get_model(rounding=rounding)
+    out = model._requantize(REQUANTIZE_INPUT, 1.0, model.qconfig_dict['unit_qconfig'])
+    assert out.tolist() == expected
+
+
+def test_quantized_add_rounds_upward():
+    # Both sides requantized to scale 4 and rounded upward: (1.25 -> 1) + (-1.5 -> -1), (0.5 -> 1) + (-0.5 -> 0)
+    lhs, rhs = np.array([5, 2]), np.array([-3, -1])
+    assert quantized_add(lhs, rhs, 1.0, 2.0, np.array([4.0])).tolist() == [0, 1]
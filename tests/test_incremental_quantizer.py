@@ -0,0 +1,82 @@
+"""
+    IncrementalQuantizer gives the same integer model as quantizing from scratch, over fine-tuning steps and after
+    writes that don't bump tensor versions (BN statistics averaged across ranks with .data.copy_),
+    and quantizes only the layers whose sources changed.
+"""
+import pytest
+import torch
+
+from QAT.models.fused_resnet import fused_resnet20
+from QAT.models.pcq_resnet import pcq_resnet20
+from QAT.models.quantized_resnet import quantized_resnet20, quantize_pcq_resnet
+import QAT.models.quantization_utils as quantization_utils
+from QAT.models.quantization_utils import IncrementalQuantizer
+from tests.common import DEVICE, get_arg_dict, get_random_dataset, RuleClustering, set_batch_cluster
+
+
+def train_steps(model, runtime_helper, num_clusters, n_steps, seed):
+    images, targets = get_random_dataset(8 * n_steps, seed=seed).tensors
+    clusters = RuleClustering(num_clusters).predict_cluster_of_batch(images)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    criterion = torch.nn.CrossEntropyLoss()
+    model.train()
+    for c in clusters.unique().tolist():
+        idx = (clusters == c).nonzero(as_tuple=True)[0]
+        for batch in idx.split(8):
+            set_batch_cluster(runtime_helper, c)
+            loss = criterion(model(images[batch].to(DEVICE)), targets[batch].to(DEVICE))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+
+def is_same_state(a, b):
+    a, b = a.state_dict(), b.state_dict()
+    return a.keys() == b.keys() and all(torch.equal(a[k].cpu(), b[k].cpu()) for k in a)
+
+
+def check_incremental(num_clusters):
+    """ Per call: whether the integer model is the same as quantized from scratch, and how many layers were quantized """
+    torch.manual_seed(0)
+    arg_dict, runtime_helper = get_arg_dict(num_clusters)
+    model = (pcq_resnet20 if num_clusters > 1 else fused_resnet20)(arg_dict).to(DEVICE)
+    runtime_helper.apply_fake_quantization = True
+    quantizer = IncrementalQuantizer(quantize_pcq_resnet)
+    quantized_model = quantized_resnet20(arg_dict)
+
+    quantized = []
+    quantize_layer = quantization_utils.quantize_layer
+
+    def counting_quantize_layer(_fp, _int):
+        quantized.append(_int)
+        return quantize_layer(_fp, _int)
+
+    results = []
+    quantization_utils.quantize_layer = counting_quantize_layer
+    try:
+        for step in range(4):
+            if step < 2:
+                train_steps(model, runtime_helper, num_clusters, 2, seed=step)
+            elif step == 2:
+                # Like sync_cluster_states: in place through .data, without a version bump.
+                # The running mean only goes into the folded bias, not into any qparam
+                bn = next(m for m in model.layer1[0].bn1.modules() if isinstance(m, torch.nn.BatchNorm2d))
+                bn.running_mean.data.copy_(bn.running_mean + 1)
+            model.set_quantization_params()
+            quantized.clear()
+            quantized_model = quantizer(model, quantized_model)
+            n_quantized = len(quantized)
+            reference = quantize_pcq_resnet(model, quantized_resnet20(arg_dict).to(DEVICE))
+            results.append((is_same_state(quantized_model, reference), n_quantized))
+    finally:
+        quantization_utils.quantize_layer = quantize_layer
+    return results
+
+
+@pytest.mark.parametrize('num_clusters', [1, 2], ids=['fused', 'pcq'])
+def test_incremental_quantizer(num_clusters):
+    same, n_quantized = zip(*check_incremental(num_clusters))
+    assert all(same)
+    # Every layer after training steps, the one whose BN statistics were written, then none
+    assert n_quantized[0] == n_quantized[1] > 1 and n_quantized[2:] == (1, 0)
+
@@ -0,0 +1,34 @@
+"""
+    Baseline comparison and HAWQ's import failures of the per-layer benchmark.
+"""
+from utils import layer_benchmark
+
+
+def result(median=None, error=None):
+    return {'error': error} if error else {'median': median}
+
+
+def test_compare_to_baseline_counts_new_errors():
+    environment = {'device': 'cpu'}
+    baseline = {'environment': environment, 'results': {
+        'ok': result(1.0), 'slower': result(1.0), 'broken': result(1.0), 'was_broken': result(error='E: x')}}
+    current = {'environment': environment, 'results': {
+        'ok': result(1.05), 'slower': result(1.5), 'broken': result(error='E: y'), 'was_broken': result(error='E: x'),
+        'new': result(1.0)}}
+    assert layer_benchmark.compare_to_baseline(current, baseline, 0.1) == ['slower', 'broken']
+
+
+def test_hawq_import_failure_skips_all_hawq_cases(monkeypatch):
+    calls = []
+
+    def import_hawq():
+        calls.append(1)
+        raise ImportError('No module named tvm')
+    monkeypatch.setattr(layer_benchmark, 'import_hawq', import_hawq)
+    names = ['QuantAct_Daq', 'QuantBnConv2d', 'quantize_M']
+    out = layer_benchmark.run_layer_benchmark(names, shapes=['resnet20.layer1'], clusters=[1, 4], batches=[1],
+                                              bits=[8], warmup=0, repeat=1)['results']
+    assert len(calls) == 1
+    hawq = [case for case in out if not case.startswith('quantize_M')]
+    assert len(hawq) == 3 and all(out[case] == {'error': 'ImportError: No module named tvm'} for case in hawq)
+    assert 'median' in out['quantize_M/scalar']
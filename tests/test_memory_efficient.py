@@ -0,0 +1,70 @@
+"""
+    --memory_efficient writes a dense block's features to one buffer (run_dense_layers/AppendFeatures) instead of
+    concatenating them per layer. Outputs and gradients of a training step are the same with and without it,
+    in float64 so that only the order of operations could tell them apart, and so are an integer dense block's.
+"""
+import pytest
+import torch
+
+from QAT.models.fused_densenet import FusedDenseNet
+from QAT.models.pcq_densenet import PCQDenseNet
+from QAT.models.quantized_densenet import QuantizedDenseBlock, quantize_block
+from tests.common import get_arg_dict, get_random_dataset, set_batch_cluster
+
+
+# A small DenseNet: 4 blocks of 2 layers on 32x32 images
+CONFIG = {'growth_rate': 4, 'block_config': (2, 2, 2, 2), 'num_init_features': 8, 'num_classes': 10}
+
+
+def train_step(num_clusters, memory_efficient):
+    torch.manual_seed(0)
+    arg_dict, runtime_helper = get_arg_dict(num_clusters, device='cpu', memory_efficient=memory_efficient)
+    model = (PCQDenseNet if num_clusters > 1 else FusedDenseNet)(arg_dict=arg_dict, **CONFIG).double().train()
+    images, targets = get_random_dataset(8).tensors
+    images = images.double()
+    set_batch_cluster(runtime_helper, num_clusters - 1, device='cpu')
+    for apply in (False, True):
+        # The first step initializes the ranges
+        runtime_helper.apply_fake_quantization = apply
+        model.zero_grad()
+        out = model(images)
+        torch.nn.functional.cross_entropy(out, targets).backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+    return model, runtime_helper, images, out.detach(), grads
+
+
+def integer_block_forward(model, memory_efficient, codes):
+    """ The integer model's second dense block, quantized from the trained one """
+    arg_dict, runtime_helper = get_arg_dict(1, device='cpu', memory_efficient=memory_efficient)
+    model = model.float().eval()
+    model.set_quantization_params()
+    block = model.features.denseblock2
+    int_block = QuantizedDenseBlock(arg_dict, block.num_layers, codes.size(1), bn_size=4,
+                                    growth_rate=CONFIG['growth_rate'], memory_efficient=memory_efficient)
+    int_block = quantize_block(block, int_block).eval()
+    with torch.no_grad():
+        return int_block(codes)
+
+
+@pytest.mark.parametrize('num_clusters', [1, 2], ids=['fused', 'pcq'])
+def test_memory_efficient_densenet(num_clusters):
+    model, _, images, out, grads = train_step(num_clusters, False)
+    me_model, _, _, me_out, me_grads = train_step(num_clusters, True)
+    assert torch.equal(out, me_out)
+    assert grads.keys() == me_grads.keys() and len(grads) > 0
+    for name in grads:
+        assert torch.allclose(grads[name], me_grads[name], rtol=1e-12, atol=1e-12), name
+    # BN's statistics of a layer reading the buffer's prefix, a strided view, differ in the last bits
+    state, me_state = model.state_dict(), me_model.state_dict()
+    for name in state:
+        assert torch.allclose(state[name], me_state[name], rtol=1e-12, atol=1e-12) if state[name].is_floating_point() \
+            else torch.equal(state[name], me_state[name]), name
+
+
+def test_memory_efficient_integer_dense_block():
+    model, _, _, _, _ = train_step(1, False)
+    generator = torch.Generator().manual_seed(0)
+    codes = torch.randint(0, 256, (8, model.features.denseblock2.denselayer1.bn1.bn.num_features, 4, 4),
+                          generator=generator).float()
+    out = integer_block_forward(model, False, codes)
+    assert torch.equal(out, integer_block_forward(model, True, codes))
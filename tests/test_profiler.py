@@ -0,0 +1,91 @@
+"""
+    Smoke test of the per-module profiler: a few training steps of a small model, with and without clusters,
+    end with the hooks and patches removed, a Chrome trace and a summary.
+"""
+import json
+import os
+import tempfile
+
+import pytest
+import torch
+
+from QAT.models.pcq_resnet import pcq_resnet20
+from utils.profiler import get_profiler, get_rank_path, NullProfiler, start_profiler
+from tests.common import DEVICE, get_arg_dict, get_random_dataset, set_batch_cluster
+
+
+def get_tiny_model():
+    return torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3, padding=1), torch.nn.BatchNorm2d(4), torch.nn.ReLU(),
+                               torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(4, 10))
+
+
+def has_hooks(model):
+    return any(m._forward_hooks or m._forward_pre_hooks or '_update_activation_ranges' in m.__dict__
+               for m in model.modules())
+
+
+def profile_steps(num_clusters, path, warmup=1, steps=2):
+    runtime_helper = None
+    if num_clusters > 1:
+        arg_dict, runtime_helper = get_arg_dict(num_clusters)
+        model = pcq_resnet20(arg_dict).to(DEVICE)
+    else:
+        model = get_tiny_model().to(DEVICE)
+    images, targets = get_random_dataset(8 * (warmup + steps)).tensors
+    loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(images, targets), batch_size=8)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+
+    # Like QAT's fine-tuning and evaluation
+    profiler = start_profiler(path, steps, runtime_helper=runtime_helper)
+    profiler.attach(model)
+    model.train()
+    for i, (input, target) in enumerate(get_profiler().iterate(loader)):
+        if runtime_helper is not None:
+            set_batch_cluster(runtime_helper, i % num_clusters)
+        with get_profiler().phase('forward'):
+            loss = torch.nn.functional.cross_entropy(model(input.to(DEVICE)), target.to(DEVICE))
+        with get_profiler().phase('backward'):
+            optimizer.zero_grad()
+            loss.backward()
+        with get_profiler().phase('optimizer'):
+            optimizer.step()
+        get_profiler().step()
+    # Ended by its last step, so finishing again does nothing
+    profiler.finish()
+
+    result = {'finished': profiler.finished and isinstance(get_profiler(), NullProfiler),
+              'unhooked': not has_hooks(model), 'summary': bool(profiler.summary())}
+    with open(path) as f:
+        events = json.load(f)
+    events = events['traceEvents'] if isinstance(events, dict) else events
+    names = {e.get('name') for e in events}
+    result['trace'] = len(events) > 0 and 'forward' in names and 'backward' in names
+    # Events of PCQ models are tagged with the batch's cluster
+    clusters = {e.get('args', {}).get('cluster') for e in events} - {None}
+    result['clusters'] = clusters == set(range(num_clusters)) if runtime_helper is not None else not clusters
+    return result
+
+
+def check_profiler(num_clusters):
+    with tempfile.TemporaryDirectory() as tmp:
+        return profile_steps(num_clusters, os.path.join(tmp, 'trace.json'))
+
+
+@pytest.mark.parametrize('num_clusters', [1, 2], ids=['tiny_model', 'pcq_model'])
+def test_profiler(num_clusters):
+    assert all(check_profiler(num_clusters).values())
+
+
+def test_profiler_trace_per_rank(monkeypatch, tmp_path):
+    path = str(tmp_path / 'trace.json')
+    assert get_rank_path(path) == path
+    # Under DDP, ranks don't overwrite each other's trace
+    monkeypatch.setattr(torch.distributed, 'is_initialized', lambda: True)
+    monkeypatch.setattr(torch.distributed, 'get_world_size', lambda: 2)
+    monkeypatch.setattr(torch.distributed, 'get_rank', lambda: 1)
+    assert get_rank_path(path) == str(tmp_path / 'trace.rank1.json')
+    profiler = start_profiler(path, steps=1, warmup=0)
+    profiler.attach(get_tiny_model())
+    profiler.step()
+    assert os.listdir(tmp_path) == ['trace.rank1.json']
+
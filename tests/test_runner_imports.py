@@ -0,0 +1,32 @@
+"""
+    QAT's runners import without loading every model family, and keep the names they star-import from QAT.models.
+"""
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('torchsummary')
+
+
+SCRIPT = """
+import sys
+import QAT.finetune, QAT.evaluate, pretrain
+from QAT.models import _FAMILIES
+assert QAT.finetune.IncrementalQuantizer and QAT.finetune.QuantizationTool
+assert QAT.evaluate.deepcopy and QAT.evaluate.load_dnn_model
+print(sorted(f for f in _FAMILIES if 'QAT.models.' + f in sys.modules))
+"""
+
+
+def test_runner_imports():
+    # A fresh interpreter, as other tests have imported model families already
+    out = subprocess.run([sys.executable, '-c', SCRIPT], capture_output=True, text=True)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.strip() == '[]'
+
+
+def test_star_import_keeps_quantization_utils_and_layers():
+    namespace = {}
+    exec('from QAT.models import *', namespace)
+    assert 'IncrementalQuantizer' in namespace and 'QuantizedConv2d' in namespace
@@ -0,0 +1,55 @@
+"""
+    BertTokenizer's batch tokenization against tokenizing text by text: tokenize_batch against tokenize, and
+    convert_batch_to_ids against convert_tokens_to_ids(tokenize(text)), uncased and cased, in a process pool too.
+"""
+import os
+import random
+import tempfile
+
+import pytest
+
+from QAT.models.bert.tokenization import BertTokenizer
+
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', 'the', 'The', 'quick', 'Quick', 'brown', 'fox', 'jump', '##s', '##ed',
+         '##ing', 'un', '##aff', '##able', 'resume', 'résumé', 'cafe', 'café', 'naive', '中', '文', '字', ',', '.', '!',
+         '?', "'", '-', 'a', '##a', 'b', '##b', 'ab', '##ab', 'x', '##x', '1', '##2', '3']
+
+PIECES = ['the', 'The', 'THE', 'quick', 'Quick', 'brown', 'foxes', 'jumped', 'jumping', 'unaffable', 'Unaffable',
+          'résumé', 'RÉSUMÉ', 'cafe\u0301', 'naïve', 'café', '中文', '字中', 'ab中b', 'fox,', '!?', "don't", 'x-x',
+          '12', '123', 'unknown', 'aab', 'ab' * 30, 'a' * 99, 'a' * 100, 'a' * 101, 'b' * 150,
+          '\x00', '\ufffd', '\x07', '\x1b', '\u200b', '\t', '\n', '\r\n', '\u3000', '\u00a0', ' ', '  ']
+
+
+def make_texts(n_texts, seed=0):
+    rng = random.Random(seed)
+    texts = ['', ' ', 'The quick brown fox', 'résumé café naïve', '中文字', 'a' * 101 + ' fox', 'fox\x00es\x07!']
+    for _ in range(n_texts - len(texts)):
+        texts.append(''.join(rng.choice(PIECES) + rng.choice(['', ' ', '\t']) for _ in range(rng.randint(1, 12))))
+    return texts
+
+
+def make_tokenizer(path, do_lower_case):
+    vocab_file = os.path.join(path, 'vocab.txt')
+    with open(vocab_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(VOCAB) + '\n')
+    return BertTokenizer(vocab_file, do_lower_case=do_lower_case)
+
+
+def check_batch_tokenization(do_lower_case, n_texts=200, workers=0, chunk_size=1000):
+    texts = make_texts(n_texts)
+    with tempfile.TemporaryDirectory() as tmp:
+        tokens = [make_tokenizer(tmp, do_lower_case).tokenize(text) for text in texts]
+        ids = [make_tokenizer(tmp, do_lower_case).convert_tokens_to_ids(t) for t in tokens]
+        # Fresh tokenizers, so caches are filled by the batch methods
+        batch_tokens = make_tokenizer(tmp, do_lower_case).tokenize_batch(texts, workers, chunk_size)
+        batch_ids = make_tokenizer(tmp, do_lower_case).convert_batch_to_ids(texts, workers, chunk_size)
+    mismatches = [text for text, a, b, c, d in zip(texts, tokens, batch_tokens, ids, batch_ids) if a != b or c != d]
+    return len(batch_tokens) == len(texts) and len(batch_ids) == len(texts), mismatches
+
+
+@pytest.mark.parametrize('do_lower_case, workers', [(True, 0), (False, 0), (True, 2)],
+                         ids=['uncased', 'cased', 'workers'])
+def test_tokenize_batch(do_lower_case, workers):
+    assert check_batch_tokenization(do_lower_case, workers=workers, chunk_size=16) == (True, [])
+
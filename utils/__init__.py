@@ -2,4 +2,5 @@ from .misc import *
 from .torch_dataset import *
 #from .dali import *
 from .lipschitz import check_lipschitz
+from .profiler import get_profiler, start_profiler
 from .darknet import validate_darknet_dataset, load_preprocessed_cifar10_from_darknet, save_fused_network_in_darknet_form
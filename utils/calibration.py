@@ -0,0 +1,147 @@
+import torch
+from tqdm import tqdm
+
+from .misc import InputContainer
+
+
+def get_calibration_batches(loader, clustering_model, runtime_helper, args, n_batches):
+    """
+        Yields (input, target, cluster) of single-cluster batches grouped by InputContainer, or of the loader's
+        batches (cluster 0) without clustering. Stops after n_batches, but not before every cluster had a batch.
+    """
+    if clustering_model is None:
+        for i, (input, target) in enumerate(loader):
+            if i == n_batches:
+                return
+            yield input, target, 0
+        return
+
+    num_clusters = runtime_helper.num_clusters
+    seen = torch.zeros(num_clusters, dtype=torch.bool)
+    container = InputContainer(loader, clustering_model, num_clusters, args.dataset, args.batch)
+    container.initialize_generator()
+    container.set_next_batch()
+    n_yielded = 0
+    while container.ready_cluster is not None:
+        input, target, cluster = container.get_batch()
+        container.set_next_batch()
+        seen[cluster] = True
+        yield input, target, cluster
+        n_yielded += 1
+        if n_yielded >= n_batches and seen.all():
+            return
+
+    # Loader exhausted before every cluster filled a batch
+    container.check_leftover()
+    for c in range(num_clusters):
+        if container.leftover_cluster_data[c] and not seen[c]:
+            yield container.leftover_batch[c][0], container.leftover_batch[c][1], c
+
+
+class RangeObserver(object):
+    """
+        Per-cluster activation range of one tensor, kept on its device.
+        mean       : mean of per-sample min/max, the statistic QAT's EMA tracks
+        minmax     : min/max over all calibration data
+        percentile : mean of per-sample (100 - p)/p percentiles, to clip outliers
+    """
+    def __init__(self, num_clusters, method='mean', percentile=99.99):
+        assert method in ['mean', 'minmax', 'percentile'], "Not supported observer"
+        self.num_clusters = num_clusters
+        self.method = method
+        self.percentile = percentile
+        self.low = None
+        self.high = None
+        self.count = None
+
+    def _init(self, device):
+        if self.method == 'minmax':
+            self.low = torch.full((self.num_clusters,), float('inf'), device=device)
+            self.high = torch.full((self.num_clusters,), float('-inf'), device=device)
+        else:
+            self.low = torch.zeros(self.num_clusters, device=device)
+            self.high = torch.zeros(self.num_clusters, device=device)
+        self.count = torch.zeros(self.num_clusters, device=device)
+
+    @torch.no_grad()
+    def update(self, x, cluster):
+        if self.low is None:
+            self._init(x.device)
+        data = x.detach().reshape(x.size(0), -1).float()
+        if self.method == 'minmax':
+            self.low[cluster] = torch.minimum(self.low[cluster], data.min())
+            self.high[cluster] = torch.maximum(self.high[cluster], data.max())
+        elif self.method == 'mean':
+            self.low[cluster] += data.min(dim=1).values.sum()
+            self.high[cluster] += data.max(dim=1).values.sum()
+        else:
+            n = data.size(1)
+            k_low = max(int(round(n * (100 - self.percentile) / 100)), 1)
+            k_high = min(max(int(round(n * self.percentile / 100)), 1), n)
+            self.low[cluster] += data.kthvalue(k_low, dim=1).values.sum()
+            self.high[cluster] += data.kthvalue(k_high, dim=1).values.sum()
+        self.count[cluster] += x.size(0)
+
+    def get_range(self):
+        """ (num_clusters, 2), including zero as act_range does. Unseen clusters get (0, 0) """
+        seen = self.count > 0
+        if self.method == 'minmax':
+            low, high = self.low, self.high
+        else:
+            low, high = self.low / self.count.clamp(min=1), self.high / self.count.clamp(min=1)
+        low = torch.where(seen, low.clamp(max=0), torch.zeros_like(low))
+        high = torch.where(seen, high.clamp(min=0), torch.zeros_like(high))
+        return torch.stack([low, high], dim=1)
+
+
+@torch.no_grad()
+def calibrate_activation_ranges(model, batches, runtime_helper=None, method='mean', percentile=99.99, device='cuda'):
+    """
+        Sets act_range (output of its module) and in_range (input of its module) of every fused/PCQ module
+        from calibration batches, in eval mode so BN uses its running statistics and nothing is trained.
+        Returns the number of calibration batches.
+    """
+    observers, handles = [], []
+
+    def output_hook(observer):
+        def hook(module, input, output):
+            observer.update(output, runtime_helper.batch_cluster if runtime_helper is not None else 0)
+        return hook
+
+    def input_hook(observer):
+        def hook(module, input):
+            observer.update(input[0], runtime_helper.batch_cluster if runtime_helper is not None else 0)
+        return hook
+
+    for m in model.modules():
+        for name, register, make_hook in (('act_range', m.register_forward_hook, output_hook),
+                                          ('in_range', m.register_forward_pre_hook, input_hook)):
+            param = getattr(m, name, None)
+            if isinstance(param, torch.Tensor):
+                n_rows = param.view(-1, 2).size(0)
+                observer = RangeObserver(n_rows, method, percentile)
+                observers.append((m, name, observer))
+                handles.append(register(make_hook(observer)))
+
+    model.eval()
+    n_batches = 0
+    try:
+        for input, _, cluster in tqdm(batches, desc="Calibrate", ncols=90):
+            if runtime_helper is not None:
+                runtime_helper.batch_cluster = cluster
+                runtime_helper.qat_batch_cluster = torch.tensor(cluster, dtype=torch.int64, device=device,
+                                                                requires_grad=False)
+            model(input.to(device))
+            n_batches += 1
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    for m, name, observer in observers:
+        if observer.count is None:
+            continue
+        param = getattr(m, name)
+        param.data.copy_(observer.get_range().view_as(param))
+        if hasattr(m, 'apply_ema'):
+            m.apply_ema.data.fill_(True)
+    return n_batches
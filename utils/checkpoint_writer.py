@@ -0,0 +1,105 @@
+import os
+import queue
+import shutil
+import threading
+from copy import deepcopy
+
+import torch
+
+
+class AsyncCheckpointWriter(object):
+    """
+        Writes checkpoints on a background thread.
+        save() copies the state's tensors to CPU buffers that are kept per file and key, and queues the write.
+        Files are written to a temporary name and renamed, so a crash never leaves a truncated checkpoint.
+        At most max_pending writes are queued; save() blocks beyond that.
+    """
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.buffers = {}      # filepath -> {key: CPU buffer}
+        self.in_flight = {}    # filepath -> threading.Event set when its last write is done
+        self.error = None
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            func, done = task
+            try:
+                if self.error is None:
+                    func()
+            except Exception as e:
+                self.error = e
+            finally:
+                if done is not None:
+                    done.set()
+                self.queue.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Checkpoint write failed") from error
+
+    def _snapshot(self, obj, buffers, key=''):
+        if isinstance(obj, torch.Tensor):
+            # Every tensor is copied: writes through .data and BN's kernel don't bump tensors' versions
+            buffer = buffers.get(key)
+            if buffer is None or buffer.dtype != obj.dtype or buffer.shape != obj.shape:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            return buffer
+        if isinstance(obj, dict):
+            return type(obj)((k, self._snapshot(v, buffers, '{}/{}'.format(key, k))) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, buffers, '{}/{}'.format(key, i)) for i, v in enumerate(obj))
+        if isinstance(obj, (int, float, str, bool, type(None))):
+            return obj
+        return deepcopy(obj)
+
+    def save(self, state, filepath):
+        self._check_error()
+        # Buffers of a file are reused, so its previous write has to be done before they are overwritten
+        if filepath in self.in_flight:
+            self.in_flight[filepath].wait()
+            self._check_error()
+
+        snapshot = self._snapshot(state, self.buffers.setdefault(filepath, {}))
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+
+        def write():
+            if copied is not None:
+                copied.synchronize()
+            tmp_path = filepath + '.tmp'
+            torch.save(snapshot, tmp_path)
+            os.replace(tmp_path, filepath)
+
+        done = threading.Event()
+        self.in_flight[filepath] = done
+        self.queue.put((write, done))
+
+    def copy(self, src, dst):
+        """ Runs after the writes queued before it, e.g. checkpoint.pth -> best.pth """
+        self._check_error()
+
+        def copy_file():
+            tmp_path = dst + '.tmp'
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, dst)
+        self.queue.put((copy_file, None))
+
+    def wait(self):
+        self.queue.join()
+        self._check_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+        self._check_error()
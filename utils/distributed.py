@@ -0,0 +1,231 @@
+import os
+from datetime import timedelta
+from itertools import chain
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from tqdm import tqdm
+
+from .misc import AverageMeter, accuracy
+from .torch_dataset import get_normalizer, get_non_augmented_train_dataset, get_data_loader
+from .proxy_validation import get_clusters_cache_key
+
+
+def init_distributed(backend=None):
+    """ Expects torchrun's env (RANK, WORLD_SIZE, LOCAL_RANK). Returns the device of this process """
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+    if backend is None:
+        backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    if not dist.is_initialized():
+        # Other ranks wait at a barrier while rank 0 validates, which can take long on ImageNet
+        dist.init_process_group(backend=backend, rank=rank, world_size=world_size, timeout=timedelta(hours=3))
+    return device
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def broadcast_object(obj):
+    """ Value of rank 0, e.g. a save path created with a timestamp """
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def wrap_ddp_model(model, device, find_unused_parameters=True):
+    """
+        Buffers are not broadcast from rank 0 on every forward, because activation ranges and BN statistics
+        are averaged over ranks by sync_cluster_states instead.
+        Per-cluster BNs leave the other clusters' parameters unused in each step.
+    """
+    return DistributedDataParallel(model, device_ids=[device.index] if device.index is not None else None,
+                                   broadcast_buffers=False, find_unused_parameters=find_unused_parameters)
+
+
+class ClusterLabeledDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, clusters):
+        self.dataset = dataset
+        self.clusters = clusters
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        input, target = self.dataset[index]
+        return input, target, self.clusters[index]
+
+
+class ClusterDistributedBatchSampler(torch.utils.data.Sampler):
+    """
+        Shards the samples of each cluster over ranks, and yields single-cluster batches.
+        Every rank builds the same step schedule from the same seed, so at each iteration all ranks
+        train on the same cluster with the same batch size.
+        The last step of a cluster is shrunk so that it still divides evenly over ranks, and is dropped
+        only if it would leave a rank fewer than 2 samples (BN needs more than one value per channel).
+    """
+    def __init__(self, clusters, num_clusters, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self.clusters = torch.as_tensor(clusters)
+        self.num_clusters = num_clusters
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _schedule(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        steps = []
+        step_size = self.batch_size * self.num_replicas
+        for c in range(self.num_clusters):
+            indices = (self.clusters == c).nonzero(as_tuple=True)[0]
+            if self.shuffle:
+                indices = indices[torch.randperm(indices.size(0), generator=generator)]
+            for start in range(0, indices.size(0), step_size):
+                step = indices[start:start + step_size]
+                per_rank = step.size(0) // self.num_replicas
+                if per_rank < 2:
+                    break
+                steps.append(step[:per_rank * self.num_replicas].view(self.num_replicas, per_rank)[self.rank])
+
+        if self.shuffle:
+            steps = [steps[i] for i in torch.randperm(len(steps), generator=generator)]
+        return steps
+
+    def __iter__(self):
+        for step in self._schedule():
+            yield step.tolist()
+
+    def __len__(self):
+        step_size = self.batch_size * self.num_replicas
+        n_steps = 0
+        for c in range(self.num_clusters):
+            n_data = (self.clusters == c).sum().item()
+            n_steps += n_data // step_size + (1 if n_data % step_size >= 2 * self.num_replicas else 0)
+        return n_steps
+
+
+@torch.no_grad()
+def get_train_clusters(args, clustering_model, n_data):
+    """
+        Cluster of every training sample, predicted on the non-augmented images once by rank 0
+        and cached in the clustering model's directory.
+        The cache is used only if it was made with the same clustering checkpoint and dataset.
+    """
+    if clustering_model is None:
+        return torch.zeros(n_data, dtype=torch.int64)
+
+    path = os.path.join(args.clustering_path, 'train_clusters.pt')
+    if is_main_process():
+        dataset = get_non_augmented_train_dataset(args, get_normalizer(args.dataset))
+        key = get_clusters_cache_key(args.clustering_path, dataset)
+        cached = torch.load(path) if key is not None and os.path.exists(path) else None
+        if not isinstance(cached, dict) or cached.get('key') != key:
+            loader = get_data_loader(dataset, batch_size=256, shuffle=False, workers=args.worker)
+            clusters = []
+            for input, _ in tqdm(loader, desc="Predict clusters", ncols=90):
+                clusters.append(clustering_model.predict_cluster_of_batch(input).cpu())
+            torch.save({'key': key, 'clusters': torch.cat(clusters)}, path)
+    if dist.is_initialized():
+        dist.barrier()
+
+    clusters = torch.load(path)['clusters']
+    assert clusters.size(0) == n_data, "Cached clusters ({}) don't match the dataset ({})".format(clusters.size(0), n_data)
+    return clusters
+
+
+def get_distributed_train_loader(args, clustering_model, dataset):
+    """ args.batch stays the global batch size, each rank gets args.batch // world_size """
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    clusters = get_train_clusters(args, clustering_model, len(dataset))
+    sampler = ClusterDistributedBatchSampler(clusters, max(args.cluster, 1), args.batch // world_size,
+                                             num_replicas=world_size, rank=rank, shuffle=True)
+    return torch.utils.data.DataLoader(ClusterLabeledDataset(dataset, clusters), batch_sampler=sampler,
+                                       num_workers=args.worker, pin_memory=torch.cuda.is_available())
+
+
+@torch.no_grad()
+def sync_cluster_states(model, range_reduce='mean'):
+    """
+        All-reduce the states DDP leaves local: activation ranges (act_range, in_range, x_min/x_max) and BN running
+        statistics. EMA updates are linear, so averaging the per-rank results is the same as updating with
+        the average of the per-rank batch statistics. With range_reduce='minmax', x_min/x_max keep the
+        global min/max instead (HAWQ's act_range_momentum == -1).
+    """
+    world_size = dist.get_world_size()
+    averaged, minimum, maximum = [], [], []
+    for name, tensor in chain(model.named_parameters(), model.named_buffers()):
+        if not tensor.is_floating_point():
+            continue
+        key = name.split('.')[-1]
+        if key in ('act_range', 'in_range', 'running_mean', 'running_var'):
+            averaged.append(tensor)
+        elif key in ('x_min', 'x_max'):
+            if range_reduce == 'minmax':
+                (minimum if key == 'x_min' else maximum).append(tensor)
+            else:
+                averaged.append(tensor)
+
+    for tensors, op in ((averaged, dist.ReduceOp.SUM), (minimum, dist.ReduceOp.MIN), (maximum, dist.ReduceOp.MAX)):
+        if not tensors:
+            continue
+        # One collective per kind, in float64 so averaging identical values (other clusters' rows) is exact
+        flat = torch.cat([t.detach().reshape(-1).double() for t in tensors])
+        dist.all_reduce(flat, op=op)
+        if op == dist.ReduceOp.SUM:
+            flat /= world_size
+        offset = 0
+        for t in tensors:
+            t.data.copy_(flat[offset:offset + t.numel()].view_as(t))
+            offset += t.numel()
+
+
+def ddp_pcq_epoch(model, train_loader, criterion, optimizer, runtime_helper, epoch, logger, fix_BN=False,
+                  range_reduce='mean', device='cuda'):
+    """ pcq_epoch for a DDP-wrapped model and a loader from get_distributed_train_loader """
+    losses = AverageMeter()
+    top1 = AverageMeter()
+
+    if fix_BN:
+        model.eval()
+    else:
+        model.train()
+
+    train_loader.batch_sampler.set_epoch(epoch)
+    with tqdm(train_loader, desc="Epoch {}".format(epoch), ncols=90, disable=not is_main_process()) as t:
+        for i, (input, target, cluster) in enumerate(t):
+            if runtime_helper is not None:
+                runtime_helper.batch_cluster = cluster[0].item()
+                runtime_helper.qat_batch_cluster = torch.tensor(runtime_helper.batch_cluster, dtype=torch.int64,
+                                                                device=device, requires_grad=False)
+            input, target = input.to(device, non_blocking=True), target.to(device, non_blocking=True)
+            output = model(input)
+
+            loss = criterion(output, target)
+            prec = accuracy(output, target)[0]
+            losses.update(loss.item(), input.size(0))
+            top1.update(prec.item(), input.size(0))
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            sync_cluster_states(model.module, range_reduce)
+
+            if is_main_process():
+                logger.debug("[Epoch] {}, step {}/{} [Loss] {:.5f} (avg: {:.5f}) [Score] {:.3f} (avg: {:.3f})"
+                             .format(epoch, i + 1, len(train_loader), loss.item(), losses.avg, prec.item(), top1.avg))
+            t.set_postfix(loss=losses.avg, acc=top1.avg)
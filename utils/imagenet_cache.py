@@ -0,0 +1,143 @@
+import os
+import json
+
+import numpy as np
+import torch
+import torchvision.datasets as datasets
+import torchvision.transforms as transforms
+from tqdm import tqdm
+
+
+# Deterministic ImageNet pipeline (Resize(256) -> CenterCrop(224)) decoded once into uint8 shards.
+# Layout of <cache_dir>/<split>/
+#   index.json              num_samples, shard_size, shard file names, classes
+#   targets.npy             int64 labels of all samples
+#   shard_00000.npy, ...    uint8 (shard_size, 3, 224, 224) arrays, opened with mmap
+
+
+def get_cache_dir(args, split):
+    return os.path.join(args.imagenet_cache, split)
+
+
+def build_imagenet_cache(root, cache_dir, shard_size=10000, batch_size=256, workers=8, rank=0, world_size=1):
+    """
+        Shards are fixed index ranges of ImageFolder, so several processes (rank/world_size) can
+        write disjoint shards of the same cache. Rank 0 writes the index and targets.
+    """
+    transformer = transforms.Compose([transforms.Resize(256),
+                                      transforms.CenterCrop(224),
+                                      transforms.PILToTensor()])
+    dataset = datasets.ImageFolder(root=root, transform=transformer)
+    n_data = len(dataset)
+    n_shards = (n_data + shard_size - 1) // shard_size
+    shard_names = ['shard_{:05d}.npy'.format(s) for s in range(n_shards)]
+    os.makedirs(cache_dir, exist_ok=True)
+
+    if rank == 0:
+        np.save(os.path.join(cache_dir, 'targets.npy'), np.array(dataset.targets, dtype=np.int64))
+        with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+            json.dump({'root': root, 'num_samples': n_data, 'shard_size': shard_size,
+                       'shards': shard_names, 'classes': dataset.classes}, f, indent=4)
+
+    for s in range(rank, n_shards, world_size):
+        path = os.path.join(cache_dir, shard_names[s])
+        start, end = s * shard_size, min((s + 1) * shard_size, n_data)
+        if os.path.exists(path):
+            continue
+
+        # Written under a temporary name so a killed build never leaves a truncated shard behind
+        tmp_path = path + '.tmp.npy'
+        shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(end - start, 3, 224, 224))
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(start, end)),
+                                             batch_size=batch_size, shuffle=False, num_workers=workers)
+        offset = 0
+        for images, _ in tqdm(loader, desc="Shard {}/{}".format(s + 1, n_shards), ncols=90):
+            shard[offset:offset + images.size(0)] = images.numpy()
+            offset += images.size(0)
+        shard.flush()
+        del shard
+        os.replace(tmp_path, path)
+
+
+class ImageNetCacheDataset(torch.utils.data.Dataset):
+    """
+        Reads samples straight from the memmapped shards, so there is no JPEG decode.
+        Shards are opened lazily in each DataLoader worker, since memmaps don't survive pickling.
+    """
+    def __init__(self, cache_dir, normalizer=None):
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.cache_dir = cache_dir
+        self.num_samples = index['num_samples']
+        self.shard_size = index['shard_size']
+        self.shard_names = index['shards']
+        self.classes = index['classes']
+        self.targets = np.load(os.path.join(cache_dir, 'targets.npy'))
+        self.normalizer = normalizer
+        self.shards = None
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def open_shards(self):
+        # Copy-on-write maps are writable views for torch.from_numpy, pages are only copied if written to
+        self.shards = [np.load(os.path.join(self.cache_dir, name), mmap_mode='c') for name in self.shard_names]
+
+    def get_uint8(self, index):
+        if self.shards is None:
+            self.open_shards()
+        return self.shards[index // self.shard_size][index % self.shard_size]
+
+    def __getitem__(self, index):
+        image = torch.from_numpy(self.get_uint8(index)).float().div_(255)
+        if self.normalizer is not None:
+            image = self.normalizer(image)
+        return image, int(self.targets[index])
+
+
+class ShardedCacheSampler(torch.utils.data.Sampler):
+    """
+        Splits shards over distributed ranks and walks them shard by shard, so every rank reads
+        contiguous regions of its own files. Shuffling permutes shard order and samples within a shard.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=False, seed=0):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.shard_ids = list(range(rank, len(dataset.shard_names), num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard_range(self, s):
+        return s * self.dataset.shard_size, min((s + 1) * self.dataset.shard_size, len(self.dataset))
+
+    def __len__(self):
+        return sum(end - start for start, end in map(self.shard_range, self.shard_ids))
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        shard_ids = self.shard_ids
+        if self.shuffle:
+            shard_ids = [shard_ids[i] for i in torch.randperm(len(shard_ids), generator=generator)]
+        for s in shard_ids:
+            start, end = self.shard_range(s)
+            if self.shuffle:
+                yield from (start + torch.randperm(end - start, generator=generator)).tolist()
+            else:
+                yield from range(start, end)
+
+
+def get_cached_data_loader(args, split, normalizer, batch_size, shuffle=False, rank=0, world_size=1):
+    dataset = ImageNetCacheDataset(get_cache_dir(args, split), normalizer)
+    sampler = ShardedCacheSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=args.worker)
@@ -0,0 +1,398 @@
+import argparse
+import json
+import platform
+import sys
+import time
+from itertools import product
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from QAT.models.layers import QuantizedConv2d, QuantizedLinear, QuantizedAdd, QuantizedMaxPool2d, PCQConv2d, \
+    FusedConv2d, PCQBnReLU
+from QAT.models.quantization_utils import multiply_M, fake_quantize, quantize_M, get_code_range
+from utils.misc import RuntimeHelper
+
+
+# Conv layers of the supported architectures: (in_channels, out_channels, kernel_size, stride, padding, input size)
+CONV_SHAPES = {
+    'resnet20.layer1': (16, 16, 3, 1, 1, 32),
+    'resnet20.layer3': (64, 64, 3, 1, 1, 8),
+    'resnet50.conv1': (3, 64, 7, 2, 3, 224),
+    'resnet50.layer1.conv2': (64, 64, 3, 1, 1, 56),
+    'resnet50.layer2.conv3': (128, 512, 1, 1, 0, 28),
+    'resnet50.layer4.conv2': (512, 512, 3, 1, 1, 7),
+    'densenet121.block1.conv1': (256, 128, 1, 1, 0, 56),
+    'densenet121.block3.conv2': (128, 32, 3, 1, 1, 14),
+    'alexnet_small.conv2': (96, 256, 5, 1, 2, 15),
+}
+
+# Feature maps the elementwise layers run on: (channels, size)
+FEATURE_SHAPES = {
+    'resnet20.layer1': (16, 32),
+    'resnet50.maxpool': (64, 112),
+    'resnet50.layer1': (256, 56),
+    'resnet50.layer4': (2048, 7),
+    'densenet121.block2': (512, 28),
+}
+
+# Classifiers and FC layers: (in_features, out_features)
+LINEAR_SHAPES = {
+    'resnet20.fc': (64, 10),
+    'resnet50.fc': (2048, 1000),
+    'densenet121.classifier': (1024, 1000),
+    'alexnet.fc2': (4096, 4096),
+}
+
+CLUSTERS = [1, 4]
+BATCHES = [1, 32]
+BITS = [4, 8]
+
+
+def make_runtime(cluster, batch, device):
+    """ RuntimeHelper and arg_dict as the models get them, with the batch spread over the clusters """
+    runtime_helper = RuntimeHelper()
+    runtime_helper.set_pcq_arguments(SimpleNamespace(cluster=cluster, val_batch=batch), device)
+    runtime_helper.apply_fake_quantization = True
+    arg_dict = {'bit': 8, 'bit_bn_w': 16, 'per_channel': False, 'symmetric': False, 'cluster': cluster,
+                'runtime_helper': runtime_helper, 'val_batch': batch, 'smooth': 0.999, 'ste': True,
+                'quant_noise': False, 'qn_prob': 0.0, 'qn_each_channel': False, 'fold_convbn': False,
+                'bn_momentum': 0.1}
+    return runtime_helper, arg_dict
+
+
+def set_batch_cluster(runtime_helper, device, pcq=False):
+    """ Cluster of the batch as DAQ's loops set it, the last one; None for non-PCQ integer layers """
+    cluster = runtime_helper.num_clusters
+    if cluster > 1 or pcq:
+        runtime_helper.batch_cluster = cluster - 1
+        runtime_helper.qat_batch_cluster = torch.tensor(cluster - 1, dtype=torch.int64, device=device)
+
+
+def random_codes(shape, bit, device, dtype=torch.float):
+    low, high = get_code_range(bit)
+    return torch.randint(low, high + 1, shape, device=device).to(dtype)
+
+
+def set_requantization(layer):
+    """ Quantization parameters of a typical layer, so integer layers run their usual path """
+    with torch.no_grad():
+        for name, value in [('z1', 3), ('z3', -5), ('M0', 1 << 30), ('shift', 8), ('z_bypass', 3), ('z_prev', -2),
+                            ('M0_bypass', 1 << 30), ('M0_prev', 1 << 29), ('shift_bypass', 1), ('shift_prev', 1)]:
+            if hasattr(layer, name):
+                getattr(layer, name).fill_(value)
+
+
+def build_quantized_conv2d(shape, cluster, batch, bit, device):
+    in_channels, out_channels, kernel_size, stride, padding, size = shape
+    runtime_helper, arg_dict = make_runtime(cluster, batch, device)
+    layer = QuantizedConv2d(in_channels, out_channels, kernel_size, stride, padding,
+                            arg_dict=dict(arg_dict, bit=bit)).to(device)
+    layer.weight.data = random_codes(layer.weight.shape, bit, device)
+    layer.a_bit.fill_(bit)
+    set_requantization(layer)
+    set_batch_cluster(runtime_helper, device)
+    x = random_codes((batch, in_channels, size, size), bit, device)
+    return lambda: layer(x)
+
+
+def build_quantized_linear(shape, cluster, batch, bit, device):
+    in_features, out_features = shape
+    runtime_helper, arg_dict = make_runtime(cluster, batch, device)
+    layer = QuantizedLinear(in_features, out_features, arg_dict=dict(arg_dict, bit=bit)).to(device)
+    layer.weight.data = random_codes(layer.weight.shape, bit, device)
+    set_requantization(layer)
+    set_batch_cluster(runtime_helper, device)
+    x = random_codes((batch, in_features), bit, device)
+    return lambda: layer(x)
+
+
+def build_quantized_add(shape, cluster, batch, bit, device):
+    channels, size = shape
+    runtime_helper, arg_dict = make_runtime(cluster, batch, device)
+    layer = QuantizedAdd(arg_dict=arg_dict).to(device)
+    layer.a_bit.fill_(bit)
+    set_requantization(layer)
+    set_batch_cluster(runtime_helper, device)
+    bypass = random_codes((batch, channels, size, size), bit, device, torch.long)
+    prev = random_codes((batch, channels, size, size), bit, device, torch.long)
+    return lambda: layer(bypass, prev)
+
+
+def build_quantized_maxpool2d(shape, cluster, batch, bit, device):
+    channels, size = shape
+    runtime_helper, arg_dict = make_runtime(cluster, batch, device)
+    layer = QuantizedMaxPool2d(kernel_size=3, stride=2, padding=1, arg_dict=arg_dict).to(device)
+    layer.bit.fill_(bit)
+    set_requantization(layer)
+    set_batch_cluster(runtime_helper, device)
+    x = random_codes((batch, channels, size, size), bit, device)
+    return lambda: layer(x)
+
+
+def training_step(layer, x):
+    """ Forward and backward of a QAT layer in training mode """
+    def step():
+        layer(x).sum().backward()
+    return step
+
+
+def build_pcq_conv2d(shape, cluster, batch, bit, device):
+    in_channels, out_channels, kernel_size, stride, padding, size = shape
+    runtime_helper, arg_dict = make_runtime(cluster, batch, device)
+    layer = PCQConv2d(in_channels, out_channels, kernel_size, stride, padding, activation=torch.nn.ReLU,
+                      arg_dict=dict(arg_dict, bit=bit)).to(device).train()
+    set_batch_cluster(runtime_helper, device, pcq=True)
+    x = torch.randn(batch, in_channels, size, size, device=device, requires_grad=True)
+    return training_step(layer, x)
+
+
+def build_fused_conv2d(shape, cluster, batch, bit, device):
+    in_channels, out_channels, kernel_size, stride, padding, size = shape
+    runtime_helper, arg_dict = make_runtime(cluster, batch, device)
+    layer = FusedConv2d(in_channels, out_channels, kernel_size, stride, padding, activation=torch.nn.ReLU,
+                        arg_dict=dict(arg_dict, bit=bit)).to(device).train()
+    x = torch.randn(batch, in_channels, size, size, device=device, requires_grad=True)
+    layer(x)    # Sets the activation range, so runs time the EMA and fake quantization
+    return training_step(layer, x)
+
+
+def build_pcq_bn_relu(shape, cluster, batch, bit, device):
+    channels, size = shape
+    runtime_helper, arg_dict = make_runtime(cluster, batch, device)
+    layer = PCQBnReLU(channels, activation=torch.nn.ReLU, arg_dict=dict(arg_dict, bit=bit)).to(device).train()
+    set_batch_cluster(runtime_helper, device, pcq=True)
+    x = torch.randn(batch, channels, size, size, device=device, requires_grad=True)
+    return training_step(layer, x)
+
+
+def import_hawq():
+    """ HAWQ's quant_modules, imported once for all of its cases: a failed import leaves it partially imported """
+    from HAWQ.utils.quantization_utils import quant_modules
+    return quant_modules
+
+
+def build_quant_act_daq(shape, cluster, batch, bit, device):
+    from HAWQ.utils.quantization_utils.quant_modules import QuantAct_Daq
+    channels, size = shape
+    runtime_helper, _ = make_runtime(cluster, batch, device)
+    set_batch_cluster(runtime_helper, device, pcq=True)
+    layer = QuantAct_Daq(activation_bit=bit, runtime_helper=runtime_helper).to(device).train()
+    layer.activation_bit = bit
+    x = torch.randn(batch, channels, size, size, device=device, requires_grad=True)
+    act_scaling_factor = torch.ones(1, device=device)
+    return lambda: layer(x, act_scaling_factor)[0].sum().backward()
+
+
+def build_quant_bn_conv2d(shape, cluster, batch, bit, device):
+    from HAWQ.utils.quantization_utils.quant_modules import QuantBnConv2d
+    in_channels, out_channels, kernel_size, stride, padding, size = shape
+    layer = QuantBnConv2d(weight_bit=bit, bias_bit=32, per_channel=True)
+    layer.set_param(torch.nn.Conv2d(in_channels, out_channels, kernel_size, stride, padding, bias=False),
+                    torch.nn.BatchNorm2d(out_channels))
+    layer = layer.to(device).train()
+    x = torch.randn(batch, in_channels, size, size, device=device, requires_grad=True)
+    act_scaling_factor = torch.ones(1, device=device)
+    return lambda: layer((x, act_scaling_factor))[0].sum().backward()
+
+
+def build_multiply_M(shape, cluster, batch, bit, device):
+    """ Requantization of a conv's int32 accumulators, by the multiplier of the batch's cluster """
+    channels, size = shape
+    runtime_helper, _ = make_runtime(cluster, batch, device)
+    set_batch_cluster(runtime_helper, device)
+    x = torch.randint(-(1 << 20), 1 << 20, (batch, channels, size, size), device=device)
+    M0 = torch.randint(1 << 30, (1 << 31) - 1, (cluster,), dtype=torch.int32, device=device)
+    if cluster > 1:
+        M0 = torch.index_select(M0, 0, runtime_helper.qat_batch_cluster)[:, None, None, None]
+    else:
+        M0 = M0[0]
+    return lambda: multiply_M(x, M0)
+
+
+def build_fake_quantize(shape, cluster, batch, bit, device):
+    channels, size = shape
+    x = torch.randn(batch, channels, size, size, device=device)
+    scale, zero_point = torch.tensor(0.05, device=device), torch.tensor(3.0, device=device)
+    return lambda: fake_quantize(x, scale, zero_point, bit)
+
+
+def build_quantize_M(shape, cluster, batch, bit, device):
+    """ Multiplier of one layer and cluster, as set_qparams computes it """
+    M = torch.tensor(0.0123, dtype=torch.double, device=device)
+    return lambda: quantize_M(M.clone())
+
+
+# Benchmarks: function building a case from (shape, cluster, batch, bit, device), its shapes,
+# and which of clusters, batches and bits it sweeps (the others are fixed to their first value)
+BENCHMARKS = {
+    'QuantizedConv2d': (build_quantized_conv2d, CONV_SHAPES, ('cluster', 'batch', 'bit')),
+    'QuantizedLinear': (build_quantized_linear, LINEAR_SHAPES, ('cluster', 'batch', 'bit')),
+    'QuantizedAdd': (build_quantized_add, FEATURE_SHAPES, ('cluster', 'batch', 'bit')),
+    'QuantizedMaxPool2d': (build_quantized_maxpool2d, FEATURE_SHAPES, ('cluster', 'batch', 'bit')),
+    'PCQConv2d': (build_pcq_conv2d, CONV_SHAPES, ('cluster', 'batch', 'bit')),
+    'FusedConv2d': (build_fused_conv2d, CONV_SHAPES, ('batch', 'bit')),
+    'PCQBnReLU': (build_pcq_bn_relu, FEATURE_SHAPES, ('cluster', 'batch', 'bit')),
+    'QuantAct_Daq': (build_quant_act_daq, FEATURE_SHAPES, ('cluster', 'batch', 'bit')),
+    'QuantBnConv2d': (build_quant_bn_conv2d, CONV_SHAPES, ('batch', 'bit')),
+    'multiply_M': (build_multiply_M, FEATURE_SHAPES, ('cluster', 'batch')),
+    'fake_quantize': (build_fake_quantize, FEATURE_SHAPES, ('batch', 'bit')),
+    'quantize_M': (build_quantize_M, {'scalar': None}, ()),
+}
+
+HAWQ_BENCHMARKS = ('QuantAct_Daq', 'QuantBnConv2d')
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(func, device, warmup, repeat):
+    """ Milliseconds per call of func: median, percentiles and mean of repeat runs after warmup runs """
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        synchronize(device)
+        start = time.perf_counter()
+        func()
+        synchronize(device)
+        times.append((time.perf_counter() - start) * 1000)
+    p10, median, p90, p99 = np.percentile(times, [10, 50, 90, 99])
+    return {'median': float(median), 'p10': float(p10), 'p90': float(p90), 'p99': float(p99),
+            'mean': float(np.mean(times)), 'repeat': repeat}
+
+
+def get_cases(names=None, shapes=None, clusters=CLUSTERS, batches=BATCHES, bits=BITS):
+    """ (case name, benchmark, shape name, cluster, batch, bit) of the sweep """
+    cases = []
+    for name, (_, benchmark_shapes, sweep) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        for shape_name in benchmark_shapes:
+            if shapes and shape_name != 'scalar' and shape_name not in shapes:
+                continue
+            for cluster, batch, bit in product(clusters if 'cluster' in sweep else clusters[:1],
+                                               batches if 'batch' in sweep else batches[:1],
+                                               bits if 'bit' in sweep else bits[:1]):
+                labels = [('cluster', 'c{}'.format(cluster)), ('batch', 'b{}'.format(batch)),
+                          ('bit', '{}bit'.format(bit))]
+                case = '/'.join([name, shape_name] + [label for dim, label in labels if dim in sweep])
+                cases.append((case, name, shape_name, cluster, batch, bit))
+    return cases
+
+
+def format_error(e):
+    return '{}: {}'.format(type(e).__name__, str(e).splitlines()[0] if str(e) else '')
+
+
+def run_layer_benchmark(names=None, shapes=None, clusters=CLUSTERS, batches=BATCHES, bits=BITS, device='cpu',
+                        warmup=3, repeat=20):
+    """
+        Times each case of the sweep. A case that fails to build or run (e.g. a layer needing CUDA, or HAWQ's
+        dependencies missing) is kept with its error, so a sweep always covers every case.
+        HAWQ is imported once before the sweep; if that fails, all of its cases get the import's error.
+    """
+    cases = get_cases(names, shapes, clusters, batches, bits)
+    hawq_error = None
+    if any(name in HAWQ_BENCHMARKS for _, name, *_ in cases):
+        try:
+            import_hawq()
+        except Exception as e:
+            hawq_error = format_error(e)
+
+    results = {}
+    print('{:<64}  {:>10}  {:>10}  {:>10}'.format('Case', 'Median ms', 'P90 ms', 'P99 ms'))
+    for case, name, shape_name, cluster, batch, bit in cases:
+        build, benchmark_shapes, _ = BENCHMARKS[name]
+        if hawq_error is not None and name in HAWQ_BENCHMARKS:
+            results[case] = {'error': hawq_error}
+            print('{:<64}  {}'.format(case, hawq_error))
+            continue
+        torch.manual_seed(0)
+        try:
+            func = build(benchmark_shapes[shape_name], cluster, batch, bit, device)
+            results[case] = measure(func, device, warmup, repeat)
+        except Exception as e:
+            results[case] = {'error': format_error(e)}
+            print('{:<64}  {}'.format(case, results[case]['error']))
+            continue
+        print('{:<64}  {:>10.3f}  {:>10.3f}  {:>10.3f}'.format(case, results[case]['median'], results[case]['p90'],
+                                                                results[case]['p99']))
+    return {'environment': get_environment(device), 'results': results}
+
+
+def get_environment(device):
+    environment = {'python': platform.python_version(), 'torch': torch.__version__, 'device': str(device),
+                   'threads': torch.get_num_threads(), 'machine': platform.machine()}
+    if torch.device(device).type == 'cuda':
+        environment['gpu'] = torch.cuda.get_device_name(device)
+    return environment
+
+
+def compare_to_baseline(current, baseline, threshold=0.1):
+    """
+        Median of each case against the baseline's. A case regresses if it is slower by more than threshold
+        (a fraction), and improves if faster by more than it. A case that ran in the baseline but fails now
+        regresses too. Returns the names of the regressed cases.
+    """
+    if current['environment'] != baseline['environment']:
+        print('Environments differ, baseline: {}, current: {}'.format(baseline['environment'],
+                                                                      current['environment']))
+    regressions = []
+    print('{:<64}  {:>10}  {:>10}  {:>7}'.format('Case', 'Base ms', 'Now ms', 'Ratio'))
+    for case, result in current['results'].items():
+        base = baseline['results'].get(case)
+        if base is None or 'error' in base:
+            continue
+        if 'error' in result:
+            regressions.append(case)
+            print('{:<64}  {:>10.3f}  {:>10}  {:>7}  REGRESSION: {}'.format(case, base['median'], '-', '-',
+                                                                         result['error']))
+            continue
+        ratio = result['median'] / base['median']
+        status = ''
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append(case)
+        elif ratio < 1 - threshold:
+            status = 'improved'
+        print('{:<64}  {:>10.3f}  {:>10.3f}  {:>7.2f}  {}'.format(case, base['median'], result['median'], ratio,
+                                                                   status))
+    print('{} regression(s) over {:.0%}'.format(len(regressions), threshold))
+    return regressions
+
+
+def split(value, cast=str):
+    return [cast(v) for v in value.split(',')] if value else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-layer micro-benchmarks of the quantized layers and helpers, '
+                                                 'run from the repository root as python -m utils.layer_benchmark')
+    parser.add_argument('--layers', default='', type=str, help='Comma-separated benchmarks to run (default: all)')
+    parser.add_argument('--shapes', default='', type=str, help='Comma-separated shapes to run (default: all)')
+    parser.add_argument('--clusters', default='1,4', type=str, help='Comma-separated cluster counts')
+    parser.add_argument('--batches', default='1,32', type=str, help='Comma-separated batch sizes')
+    parser.add_argument('--bits', default='4,8', type=str, help='Comma-separated bit widths')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--warmup', default=3, type=int, help='Untimed runs of each case')
+    parser.add_argument('--repeat', default=20, type=int, help='Timed runs of each case')
+    parser.add_argument('--json', default='', type=str, help='Path to save the results')
+    parser.add_argument('--baseline', default='', type=str, help='Results to compare with, by --json of a previous run')
+    parser.add_argument('--threshold', default=0.1, type=float, help='Slowdown of the median counted as a regression')
+    args = parser.parse_args()
+
+    result = run_layer_benchmark(split(args.layers), split(args.shapes), split(args.clusters, int),
+                                 split(args.batches, int), split(args.bits, int), args.device, args.warmup,
+                                 args.repeat)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare_to_baseline(result, baseline, args.threshold):
+            sys.exit(1)
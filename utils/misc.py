@@ -12,7 +12,9 @@ import json
 import logging
 import random
 
-from HAWQ.utils.quantization_utils.quant_modules import freeze_model , unfreeze_model
+from .profiler import get_profiler
+from .torch_dataset import set_loader_epoch
+
 
 class RuntimeHelper(object):
     """
@@ -36,15 +38,15 @@ class RuntimeHelper(object):
 
         self.qat_batch_cluster = None
 
-    def set_pcq_arguments(self, args):
+    def set_pcq_arguments(self, args, device='cuda'):
         self.num_clusters = args.cluster
         self.val_batch = args.val_batch
 
-        mask = torch.ones(1, dtype=torch.int64, device='cuda')
+        mask = torch.ones(1, dtype=torch.int64, device=device)
         self.mask_4d = mask.view(-1, 1, 1, 1)
         self.mask_2d = mask.view(-1, 1)
-        self.izero = torch.tensor([0], dtype=torch.int32, device='cuda')
-        self.fzero = torch.tensor([0], dtype=torch.float32, device='cuda')
+        self.izero = torch.tensor([0], dtype=torch.int32, device=device)
+        self.fzero = torch.tensor([0], dtype=torch.float32, device=device)
 
 
 class InputContainer(object):
@@ -68,14 +70,18 @@ class InputContainer(object):
         self.generator = iter(self.data_loader)
 
     def iter_loader(self):
+        profiler = get_profiler()
         while True:
             try:
-                images, targets = next(self.generator)
+                with profiler.phase('data'):
+                    images, targets = next(self.generator)
             except StopIteration:
                 self.epoch_done = True
                 break
-            cluster_info = self.clustering_model.predict_cluster_of_batch(images)
-            self.set_data_per_cluster(images, targets, cluster_info)
+            with profiler.phase('cluster'):
+                cluster_info = self.clustering_model.predict_cluster_of_batch(images)
+            with profiler.phase('regroup'):
+                self.set_data_per_cluster(images, targets, cluster_info)
             if self.ready_cluster is not None:
                 break
 
@@ -93,10 +99,11 @@ class InputContainer(object):
     @torch.no_grad()
     def get_batch(self):
         c = self.ready_cluster
-        input = self.container[c][0][:self.batch_size]
-        target = self.container[c][1][:self.batch_size]
-        self.container[c][0] = self.container[c][0][self.batch_size:]
-        self.container[c][1] = self.container[c][1][self.batch_size:]
+        with get_profiler().phase('regroup'):
+            input = self.container[c][0][:self.batch_size]
+            target = self.container[c][1][:self.batch_size]
+            self.container[c][0] = self.container[c][0][self.batch_size:]
+            self.container[c][1] = self.container[c][1][self.batch_size:]
         return input, target, c
 
     @torch.no_grad()
@@ -217,15 +224,19 @@ def save_checkpoint(state, is_best, path):
 def train_epoch(model, train_loader, criterion, optimizer, epoch, logger, hvd=None):
     losses = AverageMeter()
     top1 = AverageMeter()
+    profiler = get_profiler()
 
     model.train()
+    set_loader_epoch(train_loader, epoch)
     with tqdm(train_loader, unit="batch", ncols=90) as t:
-        for i, (input, target) in enumerate(t):
+        for i, (input, target) in enumerate(profiler.iterate(t)):
             t.set_description("Epoch {}".format(epoch))
 
-            input, target = input.cuda(), target.cuda()
-            output = model(input)
-            loss = criterion(output, target)
+            with profiler.phase('data'):
+                input, target = input.cuda(), target.cuda()
+            with profiler.phase('forward'):
+                output = model(input)
+                loss = criterion(output, target)
             prec = accuracy(output, target)[0]
             losses.update(loss.item(), input.size(0))
             top1.update(prec.item(), input.size(0))
@@ -238,30 +249,37 @@ def train_epoch(model, train_loader, criterion, optimizer, epoch, logger, hvd=No
                 logger.debug("[Epoch] {}, step {}/{} [Loss] {:.5f} (avg: {:.5f}) [Score] {:.3f} (avg: {:.3f})"
                              .format(epoch, i + 1, len(t), loss.item(), losses.avg, prec.item(), top1.avg))
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with profiler.phase('backward'):
+                optimizer.zero_grad()
+                loss.backward()
+            with profiler.phase('optimizer'):
+                optimizer.step()
 
             t.set_postfix(loss=losses.avg, acc=top1.avg)
+            profiler.step()
 
 
-def validate(model, test_loader, criterion, logger=None, hvd=None):
+def validate(model, test_loader, criterion, logger=None, hvd=None, device='cuda'):
     losses = AverageMeter()
     top1 = AverageMeter()
+    profiler = get_profiler()
 
     model.eval()
     with torch.no_grad():
         with tqdm(test_loader, unit="batch", ncols=90) as t:
-            for i, (input, target) in enumerate(t):
+            for i, (input, target) in enumerate(profiler.iterate(t)):
                 t.set_description("Validate")
-                input, target = input.cuda(), target.cuda()
-                output = model(input)
-                loss = criterion(output, target)
+                with profiler.phase('data'):
+                    input, target = input.to(device), target.to(device)
+                with profiler.phase('forward'):
+                    output = model(input)
+                    loss = criterion(output, target)
                 prec = accuracy(output, target)[0]
                 losses.update(loss.item(), input.size(0))
                 top1.update(prec.item(), input.size(0))
 
                 t.set_postfix(loss=losses.avg, acc=top1.avg)
+                profiler.step()
 
     if logger:
         if hvd:
@@ -275,6 +293,7 @@ def validate(model, test_loader, criterion, logger=None, hvd=None):
 def pcq_epoch(model, clustering_model, train_loader, criterion, optimizer, runtime_helper, epoch, logger, fix_BN=False):
     losses = AverageMeter()
     top1 = AverageMeter()
+    profiler = get_profiler()
 
     # switch to train mode
     if fix_BN:
@@ -282,6 +301,7 @@ def pcq_epoch(model, clustering_model, train_loader, criterion, optimizer, runti
     else:
         model.train()
 
+    set_loader_epoch(train_loader, epoch)
     container = InputContainer(train_loader, clustering_model, runtime_helper.num_clusters,
                                clustering_model.args.dataset, clustering_model.args.batch)
     container.initialize_generator()
@@ -290,24 +310,28 @@ def pcq_epoch(model, clustering_model, train_loader, criterion, optimizer, runti
         for i, _ in enumerate(t):
             input, target, runtime_helper.batch_cluster = container.get_batch()
             runtime_helper.qat_batch_cluster = torch.tensor(runtime_helper.batch_cluster, dtype=torch.int64, device='cuda', requires_grad=False)
-            input, target = input.cuda(), target.cuda()
-            output = model(input)
-
-            loss = criterion(output, target)
+            with profiler.phase('data'):
+                input, target = input.cuda(), target.cuda()
+            with profiler.phase('forward'):
+                output = model(input)
+                loss = criterion(output, target)
 
             prec = accuracy(output, target)[0]
             losses.update(loss.item(), input.size(0))
             top1.update(prec.item(), input.size(0))
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with profiler.phase('backward'):
+                optimizer.zero_grad()
+                loss.backward()
+            with profiler.phase('optimizer'):
+                optimizer.step()
 
             container.set_next_batch()
 
             logger.debug("[Epoch] {}, step {}/{} [Loss] {:.5f} (avg: {:.5f}) [Score] {:.3f} (avg: {:.3f})"
                          .format(epoch, i + 1, len(train_loader), loss.item(), losses.avg, prec.item(), top1.avg))
             t.set_postfix(loss=losses.avg, acc=top1.avg)
+            profiler.step()
 
             if container.ready_cluster is None:
                 break
@@ -321,21 +345,25 @@ def pcq_epoch(model, clustering_model, train_loader, criterion, optimizer, runti
                 runtime_helper.qat_batch_cluster = torch.tensor(runtime_helper.batch_cluster, dtype=torch.int64,
                                                                 device='cuda', requires_grad=False)
 
-                output = model(input)
-
-                loss = criterion(output, target)
+                with profiler.phase('forward'):
+                    output = model(input)
+                    loss = criterion(output, target)
                 prec = accuracy(output, target)[0]
                 losses.update(loss.item(), input.size(0))
                 top1.update(prec.item(), input.size(0))
 
                 t.set_postfix(loss=losses.avg, acc=top1.avg)
+                profiler.step()
 
 
-def pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper, logger=None, hvd=None):
+def pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper, logger=None, hvd=None,
+                 device='cuda'):
     losses = AverageMeter()
     top1 = AverageMeter()
+    profiler = get_profiler()
 
     if clustering_model.args.quant_base == 'hawq':
+        from HAWQ.utils.quantization_utils.quant_modules import freeze_model
         freeze_model(model)
     model.eval()
 
@@ -349,10 +377,11 @@ def pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper
             for i, _ in enumerate(t):
                 t.set_description("Validate")
                 input, target, runtime_helper.batch_cluster = container.get_batch()
-                input, target = input.cuda(), target.cuda()
+                input, target = input.to(device), target.to(device)
                 runtime_helper.qat_batch_cluster = torch.tensor(runtime_helper.batch_cluster, dtype=torch.int64,
-                                                                device='cuda', requires_grad=False)
-                output = model(input)
+                                                                device=device, requires_grad=False)
+                with profiler.phase('forward'):
+                    output = model(input)
 
                 container.set_next_batch()
 
@@ -362,6 +391,7 @@ def pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper
                 top1.update(prec.item(), input.size(0))
 
                 t.set_postfix(loss=losses.avg, acc=top1.avg)
+                profiler.step()
 
                 if container.ready_cluster is None:
                     break
@@ -370,10 +400,11 @@ def pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper
             for c in range(container.num_clusters):
                 if container.leftover_cluster_data[c]:
                     input, target, runtime_helper.batch_cluster = container.leftover_batch[c][0], container.leftover_batch[c][1], c
-                    input, target = input.cuda(), target.cuda()
-                    runtime_helper.qat_batch_cluster = torch.tensor(runtime_helper.batch_cluster, dtype=torch.int64, device='cuda', requires_grad=False)
+                    input, target = input.to(device), target.to(device)
+                    runtime_helper.qat_batch_cluster = torch.tensor(runtime_helper.batch_cluster, dtype=torch.int64, device=device, requires_grad=False)
 
-                    output = model(input)
+                    with profiler.phase('forward'):
+                        output = model(input)
 
                     loss = criterion(output, target)
                     prec = accuracy(output, target)[0]
@@ -381,6 +412,7 @@ def pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper
                     top1.update(prec.item(), input.size(0))
 
                     t.set_postfix(loss=losses.avg, acc=top1.avg)
+                    profiler.step()
 
     if logger:
         if hvd:
@@ -390,6 +422,7 @@ def pcq_validate(model, clustering_model, test_loader, criterion, runtime_helper
             logger.debug("[Validation] Loss: {:.5f}, Score: {:.3f}".format(losses.avg, top1.avg))
 
     if clustering_model.args.quant_base == 'hawq':
+        from HAWQ.utils.quantization_utils.quant_modules import unfreeze_model
         unfreeze_model(model)
     return top1.avg
 
@@ -420,51 +453,138 @@ def transfer_params(arch, dataset, qat_model):
 
 
 def load_dnn_model(arg_dict, tools, path=None):
-    model = None
-    if arg_dict['quant_base'] == 'qat':
-        if arg_dict['quantized']:
-            if arg_dict['dataset'] == 'cifar100':
-                model = tools.quantized_model_initializer(arg_dict, num_classes=100)
-            else:
-                model = tools.quantized_model_initializer(arg_dict)
-        elif arg_dict['fused']:
-            if arg_dict['dataset'] == 'cifar100':
-                model = tools.fused_model_initializer(arg_dict, num_classes=100)
-            else:
-                model = tools.fused_model_initializer(arg_dict)
-        else:
-            if arg_dict['dataset'] == 'imagenet':
-                if arg_dict['arch'] == 'MobileNetV3':
-                    model = vision_models.mobilenet_v3_small(pretrained=True)
-                elif arg_dict['arch'] == 'ResNet18':
-                    model = vision_models.resnet18(pretrained=True)
-                elif arg_dict['arch'] == 'AlexNet':
-                    model = vision_models.alexnet(pretrained=True)
-                elif arg_dict['arch'] == 'ResNet50':
-                    model = vision_models.resnet50(pretrained=True)
-                elif arg_dict['arch'] == 'DenseNet121':
-                    model = vision_models.densenet121(pretrained=True)
-                if not arg_dict['torchcv']:
-                    return model
-            elif arg_dict['dataset'] == 'cifar100':
-                model = tools.pretrained_model_initializer(num_classes=100)
-            else:
-                model = tools.pretrained_model_initializer()
-    # For HAWQ NNAC
+    """
+        Model of the job (quantized, fused or FP) with the parameters of the checkpoint at path (default: dnn_path).
+        Models are built without their random initializations, which run afterwards only for tensors left unloaded.
+        An FP model of our checkpoint is built on the meta device and made of the checkpoint's tensors instead.
+    """
+    path = path if path is not None else arg_dict['dnn_path']
+    kwargs = {'num_classes': 100} if arg_dict['dataset'] == 'cifar100' else {}
+    is_qat = arg_dict['quant_base'] == 'qat'
+    model, checkpoint = None, None
+    deferred = DeferredInit()
+    if is_qat and arg_dict['quantized']:
+        with deferred:
+            model = tools.quantized_model_initializer(arg_dict, **kwargs)
+    elif is_qat and arg_dict['fused']:
+        with deferred:
+            model = tools.fused_model_initializer(arg_dict, **kwargs)
+    elif is_qat and arg_dict['dataset'] == 'imagenet':
+        with deferred:
+            if arg_dict['arch'] == 'MobileNetV3':
+                model = vision_models.mobilenet_v3_small(pretrained=True)
+            elif arg_dict['arch'] == 'ResNet18':
+                model = vision_models.resnet18(pretrained=True)
+            elif arg_dict['arch'] == 'AlexNet':
+                model = vision_models.alexnet(pretrained=True)
+            elif arg_dict['arch'] == 'ResNet50':
+                model = vision_models.resnet50(pretrained=True)
+            elif arg_dict['arch'] == 'DenseNet121':
+                model = vision_models.densenet121(pretrained=True)
+        deferred.materialize()
+        if not arg_dict['torchcv']:
+            return model
+    # FP model, also for HAWQ NNAC
     else:
-        if arg_dict['dataset'] == 'cifar100':
-            model = tools.pretrained_model_initializer(num_classes=100)
-        else:
-            model = tools.pretrained_model_initializer()
+        # Tensors of a cached checkpoint are shared by jobs of a sweep, so they are copied into a new model
+        if not arg_dict['torchcv'] and checkpoint_cache is None:
+            checkpoint = load_checkpoint(path)
+            model = build_from_state_dict(tools.pretrained_model_initializer, checkpoint['state_dict'], **kwargs)
+            if model is not None:
+                return model
+        with deferred:
+            model = tools.pretrained_model_initializer(**kwargs)
 
     if arg_dict['torchcv']:
-        return transfer_params(arg_dict['arch'].lower(), arg_dict['dataset'].lower(), model)
-
-    if path is not None:
-        checkpoint = torch.load(path)
+        model = transfer_params(arg_dict['arch'].lower(), arg_dict['dataset'].lower(), model)
     else:
-        checkpoint = torch.load(arg_dict['dnn_path'])
-    model.load_state_dict(checkpoint['state_dict'], strict=False)
+        checkpoint = checkpoint if checkpoint is not None else load_checkpoint(path)
+        model.load_state_dict(checkpoint['state_dict'], strict=False)
+    deferred.materialize()
+    return model
+
+
+checkpoint_cache = None
+
+
+def map_checkpoint(path):
+    """ torch.load to CPU, memory-mapping the file so tensors are read on first use rather than copied up front """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):   # torch < 2.1, or a checkpoint saved without the zipfile format
+        return torch.load(path, map_location='cpu')
+
+
+def load_checkpoint(path):
+    """ map_checkpoint, kept if checkpoint_cache is a dict (sweeps load the same pretrained model repeatedly) """
+    if checkpoint_cache is None:
+        return map_checkpoint(path)
+    if path not in checkpoint_cache:
+        checkpoint_cache[path] = map_checkpoint(path)
+    return checkpoint_cache[path]
+
+
+# Functions of torch.nn.init drawing random values, which most of the time of building a model is spent on
+RANDOM_INITS = ['uniform_', 'normal_', 'trunc_normal_', 'kaiming_uniform_', 'kaiming_normal_',
+                'xavier_uniform_', 'xavier_normal_', 'orthogonal_', 'sparse_']
+
+
+class DeferredInit(object):
+    """
+        Context in which models are built without running the random initializations of torch.nn.init.
+        Each of them is recorded instead, and materialize() runs those of the tensors nothing has written to since
+        (in place, e.g. load_state_dict, a fuser's copy_ or a write through .data, or by assigning .data),
+        so models end up as if built normally, minus the initializations overwritten anyway.
+        Recorded tensors are filled with NaN to tell, as writes through .data don't bump their version.
+    """
+    def __init__(self):
+        self.records = []
+        self.inits = {name: getattr(torch.nn.init, name) for name in RANDOM_INITS}
+
+    def __enter__(self):
+        for name in RANDOM_INITS:
+            setattr(torch.nn.init, name, self._recorder(name))
+        return self
+
+    def __exit__(self, *exc):
+        for name, init in self.inits.items():
+            setattr(torch.nn.init, name, init)
+
+    def _recorder(self, name):
+        def record(tensor, *args, **kwargs):
+            with torch.no_grad():
+                tensor.fill_(float('nan'))
+            self.records.append((tensor, tensor.data_ptr(), name, args, kwargs))
+            return tensor
+        return record
+
+    def materialize(self):
+        # Checked before running any, as a tensor can have several initializations
+        unwritten = [tensor.data_ptr() == data_ptr and bool(torch.isnan(tensor).all())
+                     for tensor, data_ptr, _, _, _ in self.records]
+        for (tensor, _, name, args, kwargs), is_unwritten in zip(self.records, unwritten):
+            if is_unwritten:
+                self.inits[name](tensor, *args, **kwargs)
+        self.records = []
+
+
+def build_from_state_dict(initializer, state_dict, *args, **kwargs):
+    """
+        Model built on the meta device and assigned the tensors of state_dict, so nothing is allocated,
+        initialized or copied. None if the model has tensors state_dict lacks, or torch < 2.1.
+        Initializations are skipped too, as torch.device('meta') still dispatches each of them.
+    """
+    try:
+        with DeferredInit(), torch.device('meta'):
+            model = initializer(*args, **kwargs)
+        model.load_state_dict(state_dict, strict=False, assign=True)
+    except (AttributeError, TypeError):     # torch.device isn't a context manager, or no assign
+        return None
+    for module in model.modules():
+        tensors = list(module.parameters(recurse=False)) + list(module.buffers(recurse=False))
+        tensors += [v for v in vars(module).values() if isinstance(v, torch.Tensor)]
+        if any(t.is_meta for t in tensors):
+            return None
     return model
 
 
@@ -537,7 +657,8 @@ def set_save_dir(args, allow_existence=True):
 
 
 def set_logger(path):
-    logging.basicConfig(filename=os.path.join(path, "train.log"), level=logging.DEBUG)
+    # force: runs in the same process (e.g. sweeps) log to their own directory
+    logging.basicConfig(filename=os.path.join(path, "train.log"), level=logging.DEBUG, force=True)
     logger = logging.getLogger()
     return logger
 
@@ -686,18 +807,21 @@ def initialize_pcq_model(model, loader, criterion):
 
 
 def get_finetuning_model(arg_dict, tools, pretrained_model=None):
-    if arg_dict['dataset'] == 'cifar100':
-        fused_model = tools.fused_model_initializer(arg_dict, num_classes=100)
-    else:
-        fused_model = tools.fused_model_initializer(arg_dict)
+    deferred = DeferredInit()
+    with deferred:
+        if arg_dict['dataset'] == 'cifar100':
+            fused_model = tools.fused_model_initializer(arg_dict, num_classes=100)
+        else:
+            fused_model = tools.fused_model_initializer(arg_dict)
 
     if arg_dict['fused']:
-        checkpoint = torch.load(arg_dict['dnn_path'])
+        checkpoint = map_checkpoint(arg_dict['dnn_path'])
         fused_model.load_state_dict(checkpoint['state_dict'], strict=False)
     else:
         if pretrained_model is None:
             pretrained_model = load_dnn_model(arg_dict, tools)
         fused_model = tools.fuser(fused_model, pretrained_model)
+    deferred.materialize()
     return fused_model
 
 
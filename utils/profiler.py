@@ -0,0 +1,422 @@
+import json
+import os
+import sys
+import time
+import warnings
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+import torch.distributed as dist
+
+
+# Phases of a step, in the order a training step runs them
+PHASES = ['data', 'cluster', 'regroup', 'forward', 'backward', 'observer', 'optimizer']
+# Phases of one batch, tagged with its cluster. Loading, cluster prediction and regrouping serve several batches.
+CLUSTER_PHASES = ['forward', 'backward', 'observer', 'optimizer']
+# Warning of torch.cuda.set_sync_debug_mode('warn')
+SYNC_WARNING = 'called a synchronizing CUDA operation'
+
+
+class Region(object):
+    """
+        A timed span, as seconds from its start
+        kind        : 'forward' (module), 'backward' (module), 'phase' or 'step'
+        layer       : Type of the module (None for phases and steps)
+        host        : Time until the host was done issuing its work (None for backward)
+        wall        : Time until its work was done, which is host when the profiler doesn't synchronize
+        children    : Wall time of regions nested in it
+        syncs       : Host-device syncs in it, and in regions nested in it
+        self_syncs  : Host-device syncs in it, but not in regions nested in it
+    """
+    __slots__ = ('name', 'kind', 'layer', 'cluster', 'start', 'host', 'wall', 'children', 'syncs', 'self_syncs')
+
+    def __init__(self, name, kind, layer, cluster, start):
+        self.name = name
+        self.kind = kind
+        self.layer = layer
+        self.cluster = cluster
+        self.start = start
+        self.host = None
+        self.wall = None
+        self.children = 0.0
+        self.syncs = 0
+        self.self_syncs = 0
+
+
+class NullProfiler(object):
+    """ Profiler while profiling is off: phases are empty contexts and loaders are iterated as is """
+    recording = False
+
+    def phase(self, name):
+        return nullcontext()
+
+    def iterate(self, iterable, name='data'):
+        return iterable
+
+    def attach(self, model, name=''):
+        return self
+
+    def step(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Profiler(object):
+    """
+        Times every module's forward/backward and each phase of a few steps, tagged with the cluster of the batch.
+        Exports a Chrome/Perfetto trace (chrome://tracing, ui.perfetto.dev) and prints a table per layer type.
+        path            : Path of the trace, written when profiling ends ('' to print the tables only).
+                          Under DDP each rank writes its own, with the rank before the extension (trace.rank1.json)
+        steps           : Steps to record after warmup, then hooks are removed and the results exported
+        warmup          : Steps to skip before recording (cuDNN autotuning, allocator warm-up)
+        runtime_helper  : RuntimeHelper whose batch_cluster tags the events (None for non-PCQ models)
+        sync            : Synchronize the device at the boundaries of regions (default: with CUDA).
+                          Wall time then covers the kernels of a region,
+                          and host time is the Python/dispatch time spent issuing them.
+    """
+    def __init__(self, path='', steps=20, warmup=1, runtime_helper=None, sync=None):
+        self.path = path
+        self.steps = steps
+        self.warmup = warmup
+        self.runtime_helper = runtime_helper
+        self.cuda = torch.cuda.is_available()
+        self.sync = self.cuda if sync is None else sync
+
+        self.handles = []
+        self.patched = []
+        self.stack = []
+        self.regions = []
+        self.open_backward = {}
+        self.n_spans = 0
+
+        self.origin = time.perf_counter()
+        self.step_start = None
+        self.step_count = 0
+        self.overhead = 0.0
+        self.untracked_syncs = 0
+        self.in_sync = False
+        self.sync_mode = None
+        self.catcher = None
+        self.recording = False
+        self.finished = False
+        if warmup == 0:
+            self._start()
+
+    def attach(self, model, name=''):
+        """ Hooks every module of model, and wraps its observers' updates in the observer phase """
+        for module_name, module in model.named_modules(prefix=name):
+            label = module_name or type(module).__name__
+            self.handles.append(module.register_forward_pre_hook(self._pre_forward_hook(label, module)))
+            self.handles.append(module.register_forward_hook(self._forward_hook(label, module)))
+            update = getattr(module, '_update_activation_ranges', None)
+            if update is not None and '_update_activation_ranges' not in module.__dict__:
+                module._update_activation_ranges = self._observed(update)
+                self.patched.append((module, '_update_activation_ranges', None))
+
+        # Fused models update their ranges with quantization_utils.ema, imported into each model module
+        utils = sys.modules.get('QAT.models.quantization_utils')
+        if utils is not None:
+            original = utils.ema
+            ema = self._observed(original)
+            for module_name, module in list(sys.modules.items()):
+                if module_name.startswith('QAT.models') and getattr(module, 'ema', None) is original:
+                    setattr(module, 'ema', ema)
+                    self.patched.append((module, 'ema', original))
+        return self
+
+    @contextmanager
+    def _region(self, name):
+        region = self._open(name, 'phase')
+        try:
+            yield region
+        finally:
+            self._close(region)
+
+    def phase(self, name):
+        if not self.recording:
+            return nullcontext()
+        return self._region(name)
+
+    def iterate(self, iterable, name='data'):
+        """ Iterates iterable, timing each of its next() in the phase """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self):
+        """ Call at the end of every step; ends profiling once warmup + steps are done """
+        if self.finished:
+            return
+        self.step_count += 1
+        now = time.perf_counter()
+        if self.recording:
+            region = Region('step {}'.format(self.step_count - self.warmup), 'step', None, None, self.step_start)
+            region.host = region.wall = now - self.step_start
+            self.regions.append(region)
+            self.step_start = now
+        # Backward of modules whose inputs need no gradient (e.g. the first layer) never ends
+        self.open_backward.clear()
+        if self.step_count == self.warmup:
+            self._start()
+        elif self.step_count >= self.warmup + self.steps:
+            self.finish()
+
+    def finish(self):
+        """ Removes hooks and patches, then exports what was recorded """
+        global _active
+        if self.finished:
+            return
+        self.finished = True
+        self.recording = False
+        for handle in self.handles:
+            handle.remove()
+        for owner, attr, original in reversed(self.patched):
+            if original is None:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, original)
+        self.handles, self.patched = [], []
+        if self.catcher is not None:
+            torch.cuda.set_sync_debug_mode(self.sync_mode)
+            self.catcher.__exit__(None, None, None)
+            self.catcher = None
+        if _active is self:
+            _active = _NULL_PROFILER
+
+        if self.path:
+            path = get_rank_path(self.path)
+            self.export_trace(path)
+            print('Profiler trace: ' + path)
+        print(self.summary())
+
+    def _start(self):
+        self.recording = True
+        self.step_start = time.perf_counter()
+        if self.cuda:
+            # Count syncs through warnings, also when the job ignores warnings (HAWQ)
+            self.catcher = warnings.catch_warnings()
+            self.catcher.__enter__()
+            warnings.filterwarnings('always', message='.*' + SYNC_WARNING)
+            self.showwarning = warnings.showwarning
+            warnings.showwarning = self._count_sync
+            self.sync_mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode('warn')
+
+    def _count_sync(self, message, category, filename, lineno, file=None, line=None):
+        if SYNC_WARNING not in str(message):
+            self.showwarning(message, category, filename, lineno, file, line)
+            return
+        if self.in_sync:
+            return
+        if not self.stack:
+            self.untracked_syncs += 1
+            return
+        for region in self.stack:
+            region.syncs += 1
+        self.stack[-1].self_syncs += 1
+
+    def _synchronize(self):
+        self.in_sync = True
+        torch.cuda.synchronize()
+        self.in_sync = False
+
+    def _cluster(self, kind, name):
+        if self.runtime_helper is None or (kind == 'phase' and name not in CLUSTER_PHASES):
+            return None
+        return self.runtime_helper.batch_cluster
+
+    def _open(self, name, kind, layer=None):
+        called = time.perf_counter()
+        if self.sync:
+            self._synchronize()
+        region = Region(name, kind, layer, self._cluster(kind, name), time.perf_counter())
+        self.stack.append(region)
+        self.overhead += region.start - called
+        return region
+
+    def _close(self, region):
+        host = time.perf_counter()
+        if self.sync:
+            self._synchronize()
+        end = time.perf_counter()
+        region.host, region.wall = host - region.start, end - region.start
+        while self.stack:
+            if self.stack.pop() is region:
+                break
+        if self.stack:
+            self.stack[-1].children += region.wall
+        self.regions.append(region)
+        self.overhead += time.perf_counter() - end
+
+    def _pre_forward_hook(self, label, module):
+        layer = type(module).__name__
+
+        def hook(_, inputs):
+            if self.recording:
+                self._open(label, 'forward', layer)
+        return hook
+
+    def _forward_hook(self, label, module):
+        layer = type(module).__name__
+
+        def hook(_, inputs, output):
+            if not self.recording or not self.stack or self.stack[-1].name != label:
+                return
+            self._close(self.stack[-1])
+            if torch.is_grad_enabled():
+                self._hook_backward(label, layer, inputs, output)
+        return hook
+
+    def _hook_backward(self, label, layer, inputs, output):
+        """ The backward of a module starts at the gradient of its output, and ends at the one of its input """
+        called = time.perf_counter()
+        grad_output = _first_grad_tensor(output)
+        if grad_output is not None:
+            self.n_spans += 1
+            span = self.n_spans
+            cluster = self._cluster('backward', label)
+            grad_output.register_hook(lambda grad: self._open_backward(span, label, layer, cluster))
+            grad_input = _first_grad_tensor(inputs)
+            if grad_input is not None:
+                grad_input.register_hook(lambda grad: self._close_backward(span))
+        self.overhead += time.perf_counter() - called
+
+    def _open_backward(self, span, label, layer, cluster):
+        if self.recording:
+            if self.sync:
+                self._synchronize()
+            self.open_backward[span] = Region(label, 'backward', layer, cluster, time.perf_counter())
+
+    def _close_backward(self, span):
+        region = self.open_backward.pop(span, None)
+        if region is not None and self.recording:
+            if self.sync:
+                self._synchronize()
+            region.wall = time.perf_counter() - region.start
+            self.regions.append(region)
+
+    def _observed(self, update):
+        def observe(*args, **kwargs):
+            if not self.recording:
+                return update(*args, **kwargs)
+            with self._region('observer'):
+                return update(*args, **kwargs)
+        return observe
+
+    def export_trace(self, path):
+        """ Chrome trace of the regions: forward and phases nested on one track, backward as async spans """
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in enumerate(['steps, phases and forward', 'backward'])]
+        for i, region in enumerate(self.regions):
+            ts = (region.start - self.origin) * 1e6
+            args = {'cluster': region.cluster}
+            if region.layer is not None:
+                args['layer'] = region.layer
+            if region.kind == 'backward':
+                event = {'name': region.name, 'cat': region.kind, 'pid': pid, 'tid': 1, 'id': i, 'args': args}
+                events.append(dict(event, ph='b', ts=ts))
+                events.append(dict(event, ph='e', ts=ts + region.wall * 1e6))
+                continue
+            args.update({'host_ms': region.host * 1e3, 'self_ms': (region.wall - region.children) * 1e3,
+                         'syncs': region.syncs})
+            events.append({'name': region.name, 'cat': region.kind, 'ph': 'X', 'ts': ts, 'dur': region.wall * 1e6,
+                           'pid': pid, 'tid': 0, 'args': args})
+        other = {'steps': self.step_count - self.warmup, 'sync': self.sync, 'overhead_ms': self.overhead * 1e3,
+                 'untracked_syncs': self.untracked_syncs}
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': other}, f)
+
+    def get_layer_stats(self):
+        """ Forward (total, self, host) and backward times in ms, calls and syncs per layer type """
+        stats = defaultdict(lambda: {'calls': 0, 'total': 0.0, 'self': 0.0, 'host': 0.0, 'backward': 0.0, 'syncs': 0})
+        for region in self.regions:
+            if region.kind == 'forward':
+                row = stats[region.layer]
+                row['calls'] += 1
+                row['total'] += region.wall * 1e3
+                row['self'] += (region.wall - region.children) * 1e3
+                row['host'] += region.host * 1e3
+                row['syncs'] += region.self_syncs
+            elif region.kind == 'backward':
+                stats[region.layer]['backward'] += region.wall * 1e3
+        return dict(stats)
+
+    def get_phase_stats(self):
+        """ Calls, time in ms and syncs per (phase, cluster) """
+        stats = defaultdict(lambda: {'calls': 0, 'total': 0.0, 'syncs': 0})
+        for region in self.regions:
+            if region.kind == 'phase':
+                row = stats[(region.name, region.cluster)]
+                row['calls'] += 1
+                row['total'] += region.wall * 1e3
+                row['syncs'] += region.syncs
+        return dict(stats)
+
+    def summary(self):
+        lines = ['Profiled {} steps{}, overhead of the profiler: {:.1f}ms, syncs out of phases: {}'
+                 .format(self.step_count - self.warmup, ' (synchronized)' if self.sync else '', self.overhead * 1e3,
+                         self.untracked_syncs if self.cuda else '-')]
+        form = '{:<24}  {:>7}  {:>10}  {:>10}  {:>10}  {:>10}  {:>6}'
+        lines.append(form.format('Layer type', 'Calls', 'Fwd (ms)', 'Self (ms)', 'Host (ms)', 'Bwd (ms)', 'Syncs'))
+        layers = sorted(self.get_layer_stats().items(), key=lambda item: -item[1]['self'])
+        for layer, row in layers:
+            lines.append('{:<24}  {:>7}  {:>10.2f}  {:>10.2f}  {:>10.2f}  {:>10.2f}  {:>6}'
+                         .format(layer, row['calls'], row['total'], row['self'], row['host'], row['backward'],
+                                 row['syncs']))
+
+        lines.append('')
+        lines.append('{:<24}  {:>7}  {:>7}  {:>10}  {:>6}'.format('Phase', 'Cluster', 'Calls', 'Time (ms)', 'Syncs'))
+        order = {name: i for i, name in enumerate(PHASES)}
+        phases = self.get_phase_stats()
+        keys = sorted(phases, key=lambda key: (order.get(key[0], len(PHASES)), key[0],
+                                               -1 if key[1] is None else key[1]))
+        for name, cluster in keys:
+            row = phases[(name, cluster)]
+            lines.append('{:<24}  {:>7}  {:>7}  {:>10.2f}  {:>6}'
+                         .format(name, '-' if cluster is None else cluster, row['calls'], row['total'], row['syncs']))
+        return '\n'.join(lines)
+
+
+def get_rank_path(path):
+    """ path of this rank's trace: as is in a single process, with the rank before its extension under DDP """
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}.rank{}{}'.format(root, dist.get_rank(), ext)
+
+
+def _first_grad_tensor(values):
+    if isinstance(values, torch.Tensor):
+        return values if values.requires_grad else None
+    if isinstance(values, (tuple, list)):
+        for value in values:
+            tensor = _first_grad_tensor(value)
+            if tensor is not None:
+                return tensor
+    return None
+
+
+_NULL_PROFILER = NullProfiler()
+_active = _NULL_PROFILER
+
+
+def get_profiler():
+    """ The running profiler, or a NullProfiler """
+    return _active
+
+
+def start_profiler(path='', steps=20, warmup=1, runtime_helper=None, sync=None):
+    """ Replaces the running profiler. Attach models to the returned one. """
+    global _active
+    _active.finish()
+    _active = Profiler(path, steps, warmup, runtime_helper, sync)
+    return _active
@@ -0,0 +1,146 @@
+import os
+import math
+from hashlib import sha256
+
+import torch
+from tqdm import tqdm
+
+from .misc import accuracy
+from .torch_dataset import get_data_loader
+
+
+def get_clusters_cache_key(clustering_path, dataset):
+    """
+        What cached clusters are predicted from: the clustering model's checkpoint, and the dataset's samples
+        (type, location, split, size, targets or files, and transform). None if there is no checkpoint to hash.
+    """
+    checkpoint_path = os.path.join(clustering_path, 'checkpoint.pkl')
+    if not os.path.exists(checkpoint_path):
+        return None
+    key = sha256()
+    with open(checkpoint_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            key.update(chunk)
+
+    identity = [type(dataset).__name__, len(dataset), getattr(dataset, 'root', None), getattr(dataset, 'train', None),
+                repr(getattr(dataset, 'transform', None))]
+    key.update(repr(identity).encode())
+    if getattr(dataset, 'samples', None) is not None:
+        key.update(repr(dataset.samples).encode())
+    elif getattr(dataset, 'targets', None) is not None:
+        key.update(torch.as_tensor(dataset.targets).cpu().numpy().tobytes())
+    return key.hexdigest()
+
+
+@torch.no_grad()
+def get_test_clusters(args, clustering_model, dataset):
+    """
+        Targets and clusters of every test sample, predicted once and cached in the clustering model's directory.
+        The cache is used only if it was made with the same clustering checkpoint and dataset.
+        Without a clustering model every sample is in cluster 0.
+    """
+    path, key = '', None
+    if clustering_model is not None:
+        key = get_clusters_cache_key(args.clustering_path, dataset)
+        path = os.path.join(args.clustering_path, 'test_clusters.pt') if key else ''
+    if path and os.path.exists(path):
+        cached = torch.load(path)
+        if cached.get('key') == key:
+            return cached['targets'], cached['clusters']
+
+    targets, clusters = [], []
+    loader = get_data_loader(dataset, batch_size=256, shuffle=False, workers=args.worker)
+    for input, target in tqdm(loader, desc="Predict clusters", ncols=90):
+        targets.append(target)
+        if clustering_model is not None:
+            clusters.append(clustering_model.predict_cluster_of_batch(input).cpu())
+        else:
+            clusters.append(torch.zeros(target.size(0), dtype=torch.int64))
+    targets, clusters = torch.cat(targets), torch.cat(clusters)
+    if path:
+        torch.save({'key': key, 'targets': targets, 'clusters': clusters}, path)
+    return targets, clusters
+
+
+class ProxyValidator(object):
+    """
+        Validates on a fixed subset of the test set, stratified by cluster.
+        Clusters get an equal share of n_samples (or all of their data if smaller), and each cluster's share
+        is split over classes in proportion to their counts in the cluster.
+        Accuracy is estimated as the per-cluster accuracies weighted by the clusters' sizes in the full test set,
+        so it is an estimate of full validation's score, with a normal-approximation confidence interval.
+    """
+    def __init__(self, args, clustering_model, dataset, n_samples, batch_size=None, seed=0, z=1.96):
+        targets, clusters = get_test_clusters(args, clustering_model, dataset)
+        self.dataset = dataset
+        self.batch_size = batch_size if batch_size else args.val_batch
+        self.z = z
+        self.num_clusters = int(clusters.max().item()) + 1
+
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        self.indices, self.population = [], []
+        n_per_cluster = math.ceil(n_samples / self.num_clusters)
+        for c in range(self.num_clusters):
+            in_cluster = (clusters == c).nonzero(as_tuple=True)[0]
+            self.population.append(in_cluster.size(0))
+            self.indices.append(self._proportional_sample(in_cluster, targets[in_cluster],
+                                                          min(n_per_cluster, in_cluster.size(0)), generator))
+
+    @staticmethod
+    def _proportional_sample(indices, targets, n, generator):
+        """ Largest-remainder allocation of n over classes, random samples within each class """
+        if n == 0:
+            return indices[:0]
+        classes, counts = torch.unique(targets, return_counts=True)
+        quota = counts.double() * n / indices.size(0)
+        alloc = quota.floor().long()
+        remainder = n - alloc.sum().item()
+        if remainder > 0:
+            alloc[torch.argsort(quota - alloc.double(), descending=True)[:remainder]] += 1
+
+        sampled = []
+        for cls, k in zip(classes.tolist(), alloc.tolist()):
+            in_class = indices[targets == cls]
+            sampled.append(in_class[torch.randperm(in_class.size(0), generator=generator)[:k]])
+        return torch.cat(sampled).sort()[0]
+
+    def __len__(self):
+        return sum(idx.size(0) for idx in self.indices)
+
+    @torch.no_grad()
+    def validate(self, model, runtime_helper=None, logger=None, device='cuda'):
+        """ Returns (estimated accuracy, CI half width, per-cluster accuracies), in percent """
+        model.eval()
+        n_total = sum(self.population)
+        estimate, variance, per_cluster = 0.0, 0.0, []
+        with tqdm(total=len(self), desc="Proxy-validate", ncols=90) as t:
+            for c in range(self.num_clusters):
+                if self.indices[c].numel() == 0:
+                    per_cluster.append(None)
+                    continue
+                if runtime_helper is not None:
+                    runtime_helper.batch_cluster = c
+                    runtime_helper.qat_batch_cluster = torch.tensor(c, dtype=torch.int64, device=device,
+                                                                    requires_grad=False)
+                subset = torch.utils.data.Subset(self.dataset, self.indices[c].tolist())
+                correct, n = 0.0, 0
+                for input, target in get_data_loader(subset, batch_size=self.batch_size, shuffle=False):
+                    input, target = input.to(device), target.to(device)
+                    output = model(input)
+                    correct += accuracy(output, target)[0].item() * input.size(0) / 100
+                    n += input.size(0)
+                    t.update(input.size(0))
+
+                p = correct / n
+                weight = self.population[c] / n_total
+                # Finite population correction: a cluster sampled entirely has no sampling error
+                fpc = (self.population[c] - n) / max(self.population[c] - 1, 1)
+                estimate += weight * p
+                variance += weight ** 2 * p * (1 - p) / n * fpc
+                per_cluster.append(p * 100)
+
+        score, half_width = estimate * 100, self.z * math.sqrt(variance) * 100
+        if logger:
+            logger.debug("[Proxy Validation] Score: {:.3f} +- {:.3f} ({} samples)".format(score, half_width, len(self)))
+        return score, half_width, per_cluster
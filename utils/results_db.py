@@ -0,0 +1,59 @@
+import json
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+
+
+class ResultStore(object):
+    """
+        SQLite table of experiment runs, one row per run.
+        config holds the swept parameters as JSON, so runs can be filtered with json_extract, e.g.
+            SELECT score FROM runs WHERE json_extract(config, '$.cluster') = 4
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS runs (
+                                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                 sweep TEXT, config TEXT, repeat INTEGER, args TEXT,
+                                 status TEXT, score REAL, best_epoch INTEGER, time REAL, path TEXT, error TEXT,
+                                 started TEXT, finished TEXT)''')
+        self.conn.commit()
+
+    def add(self, sweep, config, repeat, args, started, results=None, error=None):
+        results = results or {}
+        self.conn.execute('INSERT INTO runs (sweep, config, repeat, args, status, score, best_epoch, time, path, error, '
+                          'started, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (sweep, json.dumps(config, sort_keys=True), repeat, json.dumps(args, default=str),
+                           'failed' if error else 'done', results.get('score'), results.get('best_epoch'),
+                           results.get('time'), results.get('path'), error, started,
+                           datetime.now().isoformat(timespec='seconds')))
+        self.conn.commit()
+
+    def is_done(self, sweep, config, repeat):
+        row = self.conn.execute("SELECT 1 FROM runs WHERE sweep = ? AND config = ? AND repeat = ? AND status = 'done'",
+                                (sweep, json.dumps(config, sort_keys=True), repeat)).fetchone()
+        return row is not None
+
+    def summary(self, sweep=None):
+        """ min/max/mean/std of scores per config, like averager.py prints for exp_results.txt """
+        query = "SELECT sweep, config, score FROM runs WHERE status = 'done'"
+        params = ()
+        if sweep is not None:
+            query += ' AND sweep = ?'
+            params = (sweep,)
+        grouped = {}
+        for name, config, score in self.conn.execute(query + ' ORDER BY id', params):
+            grouped.setdefault((name, config), []).append(score)
+
+        rows = []
+        for (name, config), scores in grouped.items():
+            scores = np.array([s for s in scores if s is not None], dtype=np.float64)
+            if not len(scores):
+                continue
+            rows.append({'sweep': name, 'config': json.loads(config), 'runs': len(scores), 'min': scores.min(),
+                         'max': scores.max(), 'mean': scores.mean(), 'std': scores.std()})
+        return rows
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+# Common commands of main.py, as their arguments
+COMMANDS = {
+    'import torch': None,
+    'eval resnet20': ['--mode', 'eval', '--arch', 'resnet20', '--dataset', 'cifar10', '--bit', '8', '--fused'],
+    'eval resnet20 pcq int': ['--mode', 'eval', '--arch', 'resnet20', '--dataset', 'cifar10', '--bit', '8',
+                              '--cluster', '4', '--quantized'],
+    'ptq resnet50 pcq': ['--mode', 'ptq', '--arch', 'resnet50', '--imagenet', '/data', '--bit', '8', '--cluster', '4'],
+    'fine resnet20 pcq': ['--mode', 'fine', '--arch', 'resnet20', '--dataset', 'cifar10', '--bit', '4',
+                          '--cluster', '4'],
+    'fine densenet': ['--mode', 'fine', '--arch', 'densenet', '--imagenet', '/data', '--bit', '8'],
+    'pre alexnet': ['--mode', 'pre', '--arch', 'alexnet', '--dataset', 'cifar10'],
+}
+
+# Tools each mode uses before it loads data
+MODE_ROLES = {
+    'pre': ['pretrained_model_initializer'],
+    'fine': ['pretrained_model_initializer', 'fused_model_initializer', 'quantized_model_initializer', 'fuser',
+             'quantizer'],
+    'ptq': ['pretrained_model_initializer', 'fused_model_initializer', 'quantized_model_initializer', 'fuser',
+            'quantizer'],
+    'eval': ['fused_model_initializer', 'quantized_model_initializer'],
+}
+
+# Run in a fresh interpreter: what main.py imports for the command, up to data loading and model building
+STARTUP = """
+import sys, time, json
+start = time.perf_counter()
+import main
+from QAT.qat import args_qat, specify_target_arch
+from QAT.registry import get_mode_runner
+args = main.args_daq
+arch, tools = specify_target_arch(main.arch or args_qat.arch, args.dataset, args.cluster)
+for role in json.loads(sys.argv[1]):
+    getattr(tools, role)
+get_mode_runner(args.mode)
+print(json.dumps({'seconds': time.perf_counter() - start, 'modules': len(sys.modules)}))
+"""
+
+BASELINE = """
+import sys, time, json
+start = time.perf_counter()
+import torch
+print(json.dumps({'seconds': time.perf_counter() - start, 'modules': len(sys.modules)}))
+"""
+
+
+def measure_startup(argv, repeat):
+    """ Wall time of the interpreter running the command until its job starts, and time/modules of its imports """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if argv is None:
+        cmd = [sys.executable, '-c', BASELINE]
+    else:
+        mode = argv[argv.index('--mode') + 1]
+        cmd = [sys.executable, '-c', STARTUP, json.dumps(MODE_ROLES.get(mode, []))] + argv
+    walls, imports, modules = [], [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run(cmd, cwd=root, capture_output=True, text=True, check=True).stdout
+        walls.append(time.perf_counter() - start)
+        result = json.loads(out.strip().splitlines()[-1])
+        imports.append(result['seconds'])
+        modules = result['modules']
+    return {'wall': float(np.median(walls)), 'imports': float(np.median(imports)), 'modules': modules}
+
+
+def run_startup_benchmark(names=None, repeat=5):
+    result = {}
+    print('{:<24}  {:>8}  {:>10}  {:>8}'.format('Command', 'Wall (s)', 'Import (s)', 'Modules'))
+    for name, argv in COMMANDS.items():
+        if names and name not in names:
+            continue
+        result[name] = measure_startup(argv, repeat)
+        print('{:<24}  {:>8.2f}  {:>10.2f}  {:>8}'.format(name, result[name]['wall'], result[name]['imports'],
+                                                          result[name]['modules']))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup time of common commands, median of fresh interpreters')
+    parser.add_argument('--repeat', default=5, type=int, help='Runs of each command')
+    parser.add_argument('--commands', default='', type=str, help='Comma-separated commands to run (default: all)')
+    parser.add_argument('--json', default='', type=str, help='Path to save the results')
+    args = parser.parse_args()
+    result = run_startup_benchmark(args.commands.split(',') if args.commands else None, args.repeat)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=4)
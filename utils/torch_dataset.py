@@ -1,5 +1,7 @@
 import os
+import time
 
+import numpy as np
 import torch
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
@@ -90,24 +92,179 @@ def get_test_dataset(args, normalizer):
     return test_dataset
 
 
+def get_tensor_dataset(args, train=True):
+    """ Whole 32x32 split as (uint8 NCHW images, int64 targets), decoded once """
+    if args.dataset == 'cifar10':
+        dataset = datasets.CIFAR10(root='./data', train=train, download=True)
+        images, targets = dataset.data.transpose((0, 3, 1, 2)), dataset.targets
+    elif args.dataset == 'cifar100':
+        dataset = datasets.CIFAR100(root='./data', train=train, download=True)
+        images, targets = dataset.data.transpose((0, 3, 1, 2)), dataset.targets
+    else:
+        dataset = datasets.SVHN(root='./data', split='train' if train else 'test', download=True)
+        images, targets = dataset.data, dataset.labels
+    return torch.from_numpy(np.ascontiguousarray(images)), torch.as_tensor(np.asarray(targets), dtype=torch.int64)
+
+
+def normalize_uint8(images, mean, std):
+    return (images.float().div_(255) - mean) / std
+
+
+def random_crop_and_flip(images, padding=4):
+    """ RandomCrop(32, padding) and RandomHorizontalFlip of a uint8 NCHW batch, with per-sample offsets and flips """
+    batch, _, height, width = images.shape
+    padded = torch.nn.functional.pad(images, (padding, padding, padding, padding))
+
+    # Per-sample crop offsets; flipping is folded into the column indices
+    top = torch.randint(0, 2 * padding + 1, (batch, 1), device=images.device)
+    left = torch.randint(0, 2 * padding + 1, (batch, 1), device=images.device)
+    rows = top + torch.arange(height, device=images.device)
+    cols = torch.arange(width, device=images.device).repeat(batch, 1)
+    flip = torch.rand(batch, device=images.device) < 0.5
+    cols[flip] = cols[flip].flip(1)
+    cols = cols + left
+
+    index = torch.arange(batch, device=images.device).view(-1, 1, 1)
+    cropped = padded.permute(0, 2, 3, 1)[index, rows.unsqueeze(-1), cols.unsqueeze(1)]
+    return cropped.permute(0, 3, 1, 2)
+
+
+class TensorImageDataset(torch.utils.data.Dataset):
+    """
+        Map-style view of an in-memory uint8 split, applying TensorDataLoader's transforms per sample.
+        Used where a Dataset is needed (DDP's cluster sampler, proxy validation's subsets).
+    """
+    def __init__(self, images, targets, normalizer, augment=False, padding=4):
+        self.images = images
+        self.targets = targets
+        self.augment = augment
+        self.padding = padding
+        self.mean = torch.tensor(normalizer.mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(normalizer.std).view(1, -1, 1, 1)
+
+    def __len__(self):
+        return self.images.size(0)
+
+    def __getitem__(self, index):
+        images = self.images[index:index + 1]
+        if self.augment:
+            images = random_crop_and_flip(images, self.padding)
+        return normalize_uint8(images, self.mean, self.std)[0], self.targets[index]
+
+
+class TensorDataLoader(object):
+    """
+        In-memory uint8 loader for CIFAR/SVHN.
+        RandomCrop(padding=4), RandomHorizontalFlip, ToTensor and Normalize are applied batch-wise,
+        so there is no per-sample PIL work. Its dataset is a TensorImageDataset of the same storage.
+    """
+    def __init__(self, images, targets, normalizer, batch_size=128, shuffle=False, augment=False, padding=4,
+                 device='cpu'):
+        self.dataset = TensorImageDataset(images, targets, normalizer, augment, padding)
+        self.images = images
+        self.targets = targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.padding = padding
+        self.device = device
+        self.mean = self.dataset.mean.to(device)
+        self.std = self.dataset.std.to(device)
+
+    def __len__(self):
+        return (self.images.size(0) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n_data = self.images.size(0)
+        order = torch.randperm(n_data) if self.shuffle else torch.arange(n_data)
+        for start in range(0, n_data, self.batch_size):
+            indices = order[start:start + self.batch_size]
+            images = self.images[indices].to(self.device, non_blocking=True)
+            targets = self.targets[indices].to(self.device, non_blocking=True)
+            if self.augment:
+                images = random_crop_and_flip(images, self.padding)
+            yield normalize_uint8(images, self.mean, self.std), targets
+
+
+def get_tensor_data_loaders(args, normalizer):
+    test_images, test_targets = get_tensor_dataset(args, train=False)
+    test_loader = TensorDataLoader(test_images, test_targets, normalizer, batch_size=args.val_batch)
+    if args.mode == 'eval':
+        return test_loader
+
+    # Augmented and non-augmented loaders share the same uint8 storage
+    train_images, train_targets = get_tensor_dataset(args, train=True)
+    clustering_train_loader = None
+    if (args.cluster > 1 or args.mode == 'kselect') and not args.clustering_path:
+        clustering_train_loader = TensorDataLoader(train_images, train_targets, normalizer, batch_size=256,
+                                                   shuffle=True)
+    train_loader = TensorDataLoader(train_images, train_targets, normalizer, batch_size=args.batch,
+                                    shuffle=True, augment=True)
+    return {'aug_train': train_loader, 'test': test_loader, 'non_aug_train': clustering_train_loader}
+
+
+def measure_data_loader_throughput(args, n_steps=100):
+    """ Steps/sec and images/sec of the torchvision loaders vs. TensorDataLoader """
+    normalizer = get_normalizer(args.dataset)
+    images, targets = get_tensor_dataset(args, train=True)
+    loaders = {
+        'torchvision aug': get_data_loader(get_augmented_train_dataset(args, normalizer), batch_size=args.batch,
+                                           shuffle=True, workers=args.worker),
+        'torchvision non-aug': get_data_loader(get_non_augmented_train_dataset(args, normalizer),
+                                               batch_size=args.batch, shuffle=True, workers=args.worker),
+        'tensor aug': TensorDataLoader(images, targets, normalizer, batch_size=args.batch, shuffle=True,
+                                       augment=True),
+        'tensor non-aug': TensorDataLoader(images, targets, normalizer, batch_size=args.batch, shuffle=True),
+    }
+
+    result = {}
+    for name, loader in loaders.items():
+        n_images, step = 0, 0
+        start = time.time()
+        for step, batch in enumerate(loader):
+            n_images += batch[-1].size(0)
+            if step + 1 == n_steps:
+                break
+        elapsed = time.time() - start
+        result[name] = ((step + 1) / elapsed, n_images / elapsed)
+        print("[{}] {:.1f} steps/sec, {:.0f} images/sec".format(name, *result[name]))
+    return result
+
+
+def set_loader_epoch(loader, epoch):
+    """ Reseeds the shuffle of samplers that shuffle per epoch (ShardedCacheSampler, ClusterDistributedBatchSampler) """
+    for sampler in (getattr(loader, 'sampler', None), getattr(loader, 'batch_sampler', None)):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+
 def get_data_loader(dataset, batch_size=128, shuffle=False, workers=4):
     return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=workers)
 
 
 def get_data_loaders(args):
     normalizer = get_normalizer(args.dataset)
+    if args.tensor_dataset and args.dataset != 'imagenet':
+        return get_tensor_data_loaders(args, normalizer)
 
-    test_dataset = get_test_dataset(args, normalizer)
-    test_loader = get_data_loader(test_dataset, batch_size=args.val_batch, shuffle=False, workers=args.worker)
+    if args.dataset == 'imagenet' and args.imagenet_cache:
+        from .imagenet_cache import get_cached_data_loader
+        test_loader = get_cached_data_loader(args, 'val', normalizer, batch_size=args.val_batch)
+    else:
+        test_dataset = get_test_dataset(args, normalizer)
+        test_loader = get_data_loader(test_dataset, batch_size=args.val_batch, shuffle=False, workers=args.worker)
     if args.mode == 'eval':
         return test_loader
 
     clustering_train_loader = None
     aug_train_dataset = get_augmented_train_dataset(args, normalizer)
-    non_aug_train_dataset = get_non_augmented_train_dataset(args, normalizer)
-    if args.cluster > 1 and not args.clustering_path:
-        clustering_train_loader = get_data_loader(non_aug_train_dataset, batch_size=256, shuffle=True,
-                                                  workers=args.worker)
+    if (args.cluster > 1 or args.mode == 'kselect') and not args.clustering_path:
+        if args.dataset == 'imagenet' and args.imagenet_cache:
+            clustering_train_loader = get_cached_data_loader(args, 'train', normalizer, batch_size=256, shuffle=True)
+        else:
+            non_aug_train_dataset = get_non_augmented_train_dataset(args, normalizer)
+            clustering_train_loader = get_data_loader(non_aug_train_dataset, batch_size=256, shuffle=True,
+                                                      workers=args.worker)
     train_loader = get_data_loader(aug_train_dataset, batch_size=args.batch, shuffle=True, workers=args.worker)
     return {'aug_train': train_loader, 'test': test_loader, 'non_aug_train': clustering_train_loader}
     